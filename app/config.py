@@ -2,6 +2,10 @@
 AMOCRM_DOMAIN = 
 AMOCRM_TOKEN = 
 AMOCRM_CATALOG_ID =
+WEBHOOK_LEAD_CONCURRENCY = 8  # leads from webhooks processed at the same time
+WEBHOOK_MAX_IN_FLIGHT = 64  # leads accepted but not finished; webhooks beyond this get 503
+WEBHOOK_RETRY_AFTER = 30  # seconds amoCRM is asked to wait before redelivering a shed webhook
+WEBHOOK_DEDUP_TTL = 600  # seconds an accepted lead ID is acknowledged as duplicate without processing
 
 # iiko
 IIKO_API_KEY = 
@@ -10,7 +14,117 @@ IIKO_TERMINAL_GROUP_ID =
 IIKO_MENU_ID = 
 IIKO_BASE_URL = 
 IIKO_MENU_URL = 
+IIKO_TOKEN_TTL = 1800  # seconds an access token is reused (iiko tokens live 60 minutes)
+TERMINAL_HEARTBEAT_INTERVAL = 30  # seconds between batched terminal liveness checks
+TERMINAL_STATUS_MAX_AGE = 120  # cached liveness older than this is re-checked before an order
+ORDER_STATUS_TICK = 2  # seconds between batched deliveries/by_id checks of orders waiting to be closed
+ORDER_STATUS_TIMEOUT = 360  # seconds an order may take to reach creationStatus Success before closing is abandoned
+# Orders parked while iiko is unreachable, sent again once it recovers
+OUTBOX_DRAIN_INTERVAL = 10  # seconds between checks whether iiko is back
+OUTBOX_DRAIN_CONCURRENCY = 4  # branches drained at a time; each branch's orders are sent one by one, in arrival order
+OUTBOX_MAX_ATTEMPTS = 5  # sends of one order before it is given up
+
+# Logging
+LOG_LEVEL = "INFO"
+LOG_PAYLOAD_SAMPLE_RATE = 0.1  # share of raw webhook bodies written to the log
+LOG_PAYLOAD_MAX_CHARS = 2000  # longer payloads are truncated
+
+# Synthetic provider probes
+PROBE_INTERVAL = 60  # seconds between probe rounds
+PROBE_WINDOW = 60  # probe results kept per provider for percentiles
+PROBE_ADDRESS = "проспект Республики, 1"  # fixed destination of the Yandex check-price probe
+PROBE_SLOW_MS = 3000  # p90 latency at which a provider is reported as degraded
+PROBE_DEGRADED_ERROR_RATE = 0.2  # error rate at which a provider is reported as degraded
+
+# Profiling of pipeline stages (off until enabled through /admin/profiling)
+ADMIN_TOKEN = None  # /admin endpoints require it in the X-Admin-Token header and are refused while unset
+PROFILER_SAMPLE_RATE = 0.1  # share of pipeline runs profiled while profiling is on
+PROFILER_INTERVAL = 0.005  # seconds between stack samples of profiled threads (wall clock and CPU)
+PROFILER_MAX_STACKS = 20000  # distinct collapsed stacks kept
+
+# Order pipeline
+ORDER_DEADLINE = 480  # seconds from webhook receipt until the order must be handed to a courier
+HTTP_TIMEOUT = 10  # longest single request to amoCRM, iiko or Yandex
+DELIVERY_TRACKING_BUDGET = 5400  # seconds a dispatched delivery is tracked
+PIPELINE_STAGE_WORKERS = 24  # threads running order pipeline stages across all leads
+PIPELINE_STAGE_TIMEOUT = 60  # seconds a pipeline stage may take unless overridden below
+PIPELINE_STAGE_TIMEOUTS = {
+    "child_lead": 120,  # child lead lookup retries 5 times, 20s apart
+    "iiko_close": ORDER_STATUS_TIMEOUT + 60,  # waits for iiko creationStatus, then closes (up to 3 attempts)
+    "claim_accept": 30
+}
+
+# Thread pools per workload class, so trackers or a catalog sync cannot starve order processing.
+# queue_limit bounds tasks waiting for a thread; notes run on single-thread shards to keep their order per lead.
+EXECUTORS = {
+    "orders": {"workers": WEBHOOK_LEAD_CONCURRENCY, "queue_limit": WEBHOOK_MAX_IN_FLIGHT * 2},
+    "order_stages": {"workers": PIPELINE_STAGE_WORKERS},
+    "tracking": {"workers": 64, "queue_limit": 500},
+    "catalog": {"workers": 2, "queue_limit": 4},
+    "notes": {"workers": 4, "shards": 4, "queue_limit": 2000},
+    "outbox": {"workers": OUTBOX_DRAIN_CONCURRENCY}
+}
+
+# Branches: value of the amoCRM "Филиал" field -> iiko organization, terminal, menu and Yandex pickup point.
+# Orders with an unknown or empty branch go to DEFAULT_BRANCH.
+DEFAULT_BRANCH = "Туран"
+BRANCHES = {
+    DEFAULT_BRANCH: {
+        "organization_id": IIKO_ORGANIZATION_ID,
+        "terminal_group_id": IIKO_TERMINAL_GROUP_ID,
+        "menu_id": IIKO_MENU_ID,
+        "pickup": {
+            "fullname": "Казахстан, Астана, проспект Туран, 24, Italita",
+            "street": "проспект Туран",
+            "building": "24",
+            "coordinates": [71.423219, 51.128207],
+            "phone": "+7 (778) 333 12 56"
+        }
+    }
+}
 
 # Yandex
 YANDEX_BASE_URL = "https://b2b.taxi.yandex.net/b2b/cargo/integration/v2"
 YANDEX_API_KEY = 
+
+# Delivery tracking. With YANDEX_CALLBACK_URL set (the public URL of /yandex/callback), Yandex reports
+# status changes and claims are only polled every DELIVERY_RECONCILE_INTERVAL as a safety net
+YANDEX_CALLBACK_URL = None
+YANDEX_CALLBACK_TOKEN = None  # shared secret added to the callback URL and checked on every callback
+DELIVERY_POLL_INTERVAL = 30  # seconds between claims/info polls without callbacks
+DELIVERY_RECONCILE_INTERVAL = 300  # seconds between safety-net polls with callbacks
+
+# Delivery quotes (/api/calculate_price)
+YANDEX_QUOTE_TIMEOUT = 5.0  # seconds for the whole /check-price round trip
+YANDEX_QUOTE_CONNECT_TIMEOUT = 2.0
+YANDEX_QUOTE_MAX_CONCURRENCY = 8
+YANDEX_QUOTE_QUEUE_TIMEOUT = 0.5  # seconds a quote may wait for a free slot
+YANDEX_QUOTE_DEADLINE = 6.0  # overall budget when comparing several tariffs
+YANDEX_QUOTE_MAX_TARIFFS = 6
+YANDEX_QUOTE_CACHE_TTL = 120  # seconds a quote is reused for the same address and tariff
+YANDEX_QUOTE_CACHE_SIZE = 2048
+YANDEX_BATCH_CONCURRENCY = 4  # quotes in flight per batch request
+YANDEX_BATCH_MAX_ITEMS = 200
+
+# Address geocoding (CSV: street, building, lon, lat), built from OpenStreetMap with scripts/build_gazetteer.py
+GAZETTEER_PATH = "app/data/astana_gazetteer.csv"
+ADDRESS_HISTORY_PATH = "app/data/delivered_addresses.txt"
+
+# Local storage
+SQLITE_PATH = "app/data/italita.db"
+RECENT_ORDERS_SIZE = 500  # orders kept in memory
+ORDER_RETENTION_DAYS = 90  # orders kept on disk
+
+# Live order dashboard (/events/orders)
+EVENTS_CLIENT_BUFFER = 100  # events buffered per client before it is dropped
+
+# Local price estimator
+ESTIMATOR_CELL_DEGREES = 0.01  # grid cell size, roughly 1.1 km north-south
+ESTIMATOR_HISTORY_DAYS = 60
+
+# Startup warm-up and readiness
+WARMUP_TIMEOUT = 30  # seconds per warm-up attempt
+WARMUP_RETRY_INTERVAL = 15  # seconds between attempts of a failed required warm-up
+BREAKER_FAILURE_THRESHOLD = 5  # consecutive failures that open a provider circuit
+BREAKER_RESET_TIMEOUT = 30  # seconds before an open circuit lets a trial call through
+CATALOG_CACHE_TTL = 300  # seconds a warmed amoCRM catalog may be reused
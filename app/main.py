@@ -1,30 +1,79 @@
-from fastapi import FastAPI, Request, BackgroundTasks
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
 from fastapi.exceptions import RequestValidationError
 from contextlib import asynccontextmanager
-from fastapi.staticfiles import StaticFiles
-from datetime import datetime, timedelta, timezone
-import requests
+from typing import Optional
+import asyncio
+import hmac
 import logging
 import traceback
+import json
 
 # Services
-from services.webhook_service import process_webhook, get_last_order_data
-from services.iiko_service import get_payload, load_menu_from_iiko
-from services.sync_service import update_amo_prices_with_iiko
-from config import YANDEX_API_KEY
+from services.webhook_service import process_webhook, extract_lead_ids, deliver_parked_order
+from services.outbox_service import start_outbox_drainer, stop_outbox_drainer, outbox_snapshot
+from services.admission_service import admit, release, forget, admission_snapshot
+from services.metrics_service import inc, render as render_metrics
+from services.executor_service import get_executor, executor_snapshots, ExecutorFull
+from services.probe_service import start_probes, provider_status
+from services.logging_service import setup_logging, stop_logging
+from services.profiling_service import configure as configure_profiling, reset as reset_profiling, status as profiling_status, collapsed_stacks, pstats_dump
+from services.iiko_service import (
+    load_menu_from_iiko,
+    get_iiko_token,
+    is_menu_loaded,
+    start_terminal_heartbeat,
+    stop_terminal_heartbeat,
+    terminal_statuses,
+    is_iiko_available
+)
+from services.health_service import start_warmups, liveness, readiness
+from services.order_service import get_latest_order, get_order, query_orders, get_active_orders
+from services.events_service import bind_event_loop, subscribe, stream_events
+from services.static_service import PrecompressedStaticFiles
+from services.sync_service import update_amo_prices_with_iiko, warm_catalog
+from services.geocoding_service import load_gazetteer, suggest_addresses
+from services.quote_service import quote_address, estimate_quote, compare_tariffs, stream_batch_quotes, close_quote_client
+from services.estimator_service import load_quote_history
+from services.yandex_service import resume_delivery_tracking, notify_claim_update
+from config import YANDEX_BATCH_MAX_ITEMS, WEBHOOK_RETRY_AFTER, ADMIN_TOKEN, YANDEX_CALLBACK_TOKEN
 
-logging.basicConfig(level=logging.INFO)
+setup_logging()
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    warmups = None
+    probes = None
     try:
-        logging.info("🚀 Server starting up… loading menu from iiko")
-        load_menu_from_iiko()
+        logging.info("🚀 Server starting up… warming up menu, catalog and tokens in the background")
+        bind_event_loop(asyncio.get_running_loop())
+        warmups = start_warmups(
+            {
+                "iiko_token": lambda: get_iiko_token() is not None,
+                "iiko_menu": load_menu_from_iiko,
+                "amocrm_catalog": warm_catalog,
+                "gazetteer": load_gazetteer,
+                "quote_history": load_quote_history
+            },
+            required=("iiko_menu",)
+        )
+        start_terminal_heartbeat()
+        resume_delivery_tracking()
+        start_outbox_drainer(deliver_parked_order, is_iiko_available)
+        probes = start_probes()
         yield
     except Exception as e:
         logging.error(f"❌ Exception during application startup: {str(e)}")
         yield
+    finally:
+        if warmups:
+            warmups.cancel()
+        if probes:
+            probes.cancel()
+        stop_terminal_heartbeat()
+        stop_outbox_drainer()
+        await close_quote_client()
+        stop_logging()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -35,142 +84,330 @@ async def home():
     except Exception as e:
         logging.error(f"❌ Error in home endpoint: {str(e)}")
         return JSONResponse(content={"error": str(e)}, status_code=500)
-    
-app.mount("/", StaticFiles(directory="app/static/build", html=True), name="static")
+
+
+@app.get("/healthz")
+async def healthz():
+    """
+    Liveness: the process is up and serving requests. Also reports the
+    provider circuit breakers, which never affect liveness or readiness.
+    """
+    return liveness()
+
+@app.get("/readyz")
+async def readyz():
+    """
+    Readiness: the menu snapshot is loaded and the required warm-ups finished.
+    Also reports the per-dependency warm-up timings.
+    """
+    status = readiness({"menu_loaded": is_menu_loaded})
+    status["terminals"] = terminal_statuses()
+    status["webhooks"] = admission_snapshot()
+    status["executors"] = executor_snapshots()
+    status["iiko_outbox"] = outbox_snapshot()
+    return JSONResponse(content=status, status_code=200 if status["ready"] else 503)
 
 @app.get("/last-order")
 async def get_last_order():
     """
-    Returns the last parsed order from the global variable stored in webhook_service.
+    Returns the most recently updated order from the order store.
     """
     try:
-        last_order = get_last_order_data()
-        payload_iiko = get_payload()
-        if last_order or payload_iiko:
+        order = get_latest_order()
+        if order:
             return {
-                "last_order": last_order,
-                "payload": payload_iiko
+                "last_order": order.get("parsed_order"),
+                "payload": order.get("iiko_payload")
             }
         return {"message": "No order received yet"}
     except Exception as e:
         logging.error(f"❌ Error retrieving last order: {str(e)}")
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
+@app.get("/status/providers")
+async def providers_status():
+    """Rolling latency percentiles, error rates and degraded flags from the synthetic provider probes."""
+    return provider_status()
+
+@app.get("/orders")
+async def list_orders(
+    phone: Optional[str] = None,
+    status: Optional[str] = None,
+    since: Optional[float] = None,
+    until: Optional[float] = None,
+    limit: int = 50,
+    offset: int = 0
+):
+    """
+    Lists recent orders, newest first.
+    Filters: phone, status (pipeline stage), since/until (unix seconds); paginated with limit/offset.
+    """
+    try:
+        orders = query_orders(phone=phone, status=status, since=since, until=until, limit=limit, offset=offset)
+        return {"orders": orders, "limit": limit, "offset": offset}
+    except Exception as e:
+        logging.error(f"❌ Error listing orders: {str(e)}")
+        return JSONResponse(content={"error": str(e)}, status_code=500)
+
+@app.get("/orders/{lead_id}")
+async def get_order_by_lead(lead_id: int):
+    """
+    Returns the stored order for a lead: parsed order, iiko payload, claim ID and stage timestamps.
+    """
+    try:
+        order = get_order(lead_id)
+        if not order:
+            return JSONResponse(content={"error": "Order not found"}, status_code=404)
+        return order
+    except Exception as e:
+        logging.error(f"❌ Error retrieving order {lead_id}: {str(e)}")
+        return JSONResponse(content={"error": str(e)}, status_code=500)
+
+@app.get("/events/orders")
+async def order_events():
+    """
+    Server-sent events for the live order board: a snapshot of active orders,
+    then every stage transition as it happens.
+    """
+    subscriber = subscribe()
+    return StreamingResponse(
+        stream_events(subscriber, get_active_orders()),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+def process_admitted_webhook(decoded_body: str, lead_ids: list):
+    # Each lead is released when its own job ends. Lead jobs go into the "orders" slots reserved
+    # before the webhook was acknowledged; slots of leads that were never queued are given back
+    queued = []
+    try:
+        queued = process_webhook(decoded_body, lead_ids, on_lead_done=lambda lead_id: release([lead_id]), reserved=True)
+    finally:
+        unqueued = [lead_id for lead_id in lead_ids if lead_id not in queued]
+        get_executor("orders").unreserve(len(unqueued))
+        forget(unqueued)
+
 @app.post("/webhook")
-async def receive_webhook(request: Request, background_tasks: BackgroundTasks):
+async def receive_webhook(request: Request):
     """
     Receives an AmoCRM webhook.  
     Immediately responds with JSON.  
-    Processing occurs in the background.
+    Processing occurs in the background on the "orders" executor.
+    Leads already in flight or recently accepted are acknowledged without
+    processing; when the in-flight budget is exhausted the webhook is
+    refused with 503 and Retry-After so amoCRM delivers it again later.
     """
     try:
         logging.info("✅ Webhook received")
         raw_body = await request.body()
         decoded_body = raw_body.decode("utf-8")
 
-        # Send an immediate "OK" response to AmoCRM
-        response = JSONResponse(content={"status": "received"}, status_code=200)
-
-        # Schedule background processing
-        background_tasks.add_task(process_webhook, decoded_body, background_tasks)
+        decision, lead_ids = admit(extract_lead_ids(decoded_body))
+        if decision == "duplicate":
+            return JSONResponse(content={"status": "duplicate"}, status_code=200)
+        if decision == "accepted":
+            # Processing runs on the "orders" executor, not the shared request threadpool. Slots for
+            # the batch job and every lead job are reserved before acknowledging, so an acknowledged
+            # lead is never refused later; without room the webhook is refused and amoCRM retries
+            executor = get_executor("orders")
+            if executor.reserve(len(lead_ids) + 1):
+                executor.submit_reserved(process_admitted_webhook, decoded_body, lead_ids)
+            else:
+                forget(lead_ids)
+                decision = "shed"
+        if decision == "shed":
+            return JSONResponse(
+                content={"status": "busy"},
+                status_code=503,
+                headers={"Retry-After": str(WEBHOOK_RETRY_AFTER)}
+            )
 
-        return response
+        # Send an immediate "OK" response to AmoCRM
+        return JSONResponse(content={"status": "received"}, status_code=200)
     except Exception as e:
         logging.error(f"❌ Error processing webhook: {str(e)}")
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
+@app.post("/yandex/callback")
+async def yandex_callback(claim_id: Optional[str] = None, updated_ts: Optional[str] = None, token: str = ""):
+    """
+    Status change callback registered with every Yandex claim.
+    The callback only says that the claim changed: its tracker is woken to
+    fetch claims/info and apply the same transitions as a poll would.
+    """
+    if YANDEX_CALLBACK_TOKEN and not hmac.compare_digest(token, YANDEX_CALLBACK_TOKEN):
+        inc("yandex_callbacks_total", help="Yandex status callbacks by outcome", outcome="forbidden")
+        return JSONResponse(content={"error": "forbidden"}, status_code=403)
+    if not claim_id:
+        inc("yandex_callbacks_total", help="Yandex status callbacks by outcome", outcome="invalid")
+        return JSONResponse(content={"error": "claim_id is required"}, status_code=400)
+
+    tracked = notify_claim_update(claim_id)
+    logging.info(f"🔔 Yandex callback for claim {claim_id} (updated {updated_ts}){'' if tracked else ', not tracked'}")
+    inc("yandex_callbacks_total", help="Yandex status callbacks by outcome", outcome="applied" if tracked else "ignored")
+    return {"status": "ok" if tracked else "ignored"}
+
+@app.get("/metrics")
+async def metrics():
+    """Counters and gauges in the Prometheus text format."""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+def is_admin(request: Request) -> bool:
+    # Admin endpoints stay closed until an ADMIN_TOKEN is configured
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(request.headers.get("X-Admin-Token", ""), ADMIN_TOKEN)
+
+@app.get("/admin/profiling")
+async def get_profiling(request: Request):
+    """Profiling settings and per-stage totals (runs, wall and CPU seconds, stack samples)."""
+    if not is_admin(request):
+        return JSONResponse(content={"error": "forbidden"}, status_code=403)
+    return profiling_status()
+
+@app.post("/admin/profiling")
+async def set_profiling(request: Request):
+    """
+    Toggles profiling of pipeline stages and delivery tracking at runtime:
+    {"enabled": true, "sample_rate": 0.2}. {"reset": true} drops collected profiles.
+    """
+    if not is_admin(request):
+        return JSONResponse(content={"error": "forbidden"}, status_code=403)
+    data = await request.json()
+    if data.get("reset"):
+        reset_profiling()
+    return configure_profiling(data.get("enabled"), data.get("sample_rate"))
+
+@app.get("/admin/profiling/download")
+async def download_profile(request: Request, format: str = "collapsed", stage: Optional[str] = None):
+    """
+    Collected profiles, optionally for one stage: format=collapsed gives
+    wall-clock collapsed stacks for flame graphs, format=pstats the sampled
+    CPU profile loadable with pstats.Stats / snakeviz.
+    """
+    if not is_admin(request):
+        return JSONResponse(content={"error": "forbidden"}, status_code=403)
+    name = f"pipeline-{stage or 'all'}"
+    if format == "pstats":
+        dump = pstats_dump(stage)
+        if dump is None:
+            return JSONResponse(content={"error": "no CPU profile recorded"}, status_code=404)
+        return Response(
+            content=dump,
+            media_type="application/octet-stream",
+            headers={"Content-Disposition": f'attachment; filename="{name}.pstats"'}
+        )
+    if format == "collapsed":
+        return PlainTextResponse(
+            collapsed_stacks(stage),
+            headers={"Content-Disposition": f'attachment; filename="{name}.collapsed"'}
+        )
+    return JSONResponse(content={"error": "format must be 'collapsed' or 'pstats'"}, status_code=400)
+
 @app.get("/update_menu_price")
 async def update_menu_price():
     """
     Syncs product prices in AmoCRM catalog with prices from the current iiko menu.
+    Runs on the "catalog" executor; refused with 503 while it is saturated.
     """
     try:
-        result = update_amo_prices_with_iiko()
+        result = await asyncio.wrap_future(get_executor("catalog").submit(update_amo_prices_with_iiko))
         return {"status": "completed", "updated": result}
+    except ExecutorFull:
+        return JSONResponse(content={"error": "Catalog sync queue is full"}, status_code=503, headers={"Retry-After": str(WEBHOOK_RETRY_AFTER)})
     except Exception as e:
         logging.error(f"❌ Error updating menu prices: {str(e)}")
         return JSONResponse(content={"error": str(e)}, status_code=500)
     
 
-YANDEX_BASE_URL = "https://b2b.taxi.yandex.net/b2b/cargo/integration/v2"
-
-# Serve static files (React build)
-app.mount("/", StaticFiles(directory="app/static/build", html=True), name="static")
-
 @app.post("/api/calculate_price")
 async def calculate_price(request: Request):
+    """
+    Quotes a delivery to the given address, from the optional "branch" (default branch otherwise).
+    With an optional "tariffs" list (e.g. [{"taxi_class": "express"},
+    {"taxi_class": "courier", "cargo_options": []}]) all tariffs are quoted
+    concurrently and returned as a comparison.
+    """
     data = await request.json()
     address = data.get("address")
     time_minutes = data.get("time")
+    tariffs = data.get("tariffs")
+    branch = data.get("branch")
 
-    # Set due time
-    due_time = datetime.now(timezone.utc) + timedelta(minutes=time_minutes)
-    due = due_time.strftime("%Y-%m-%dT%H:%M:%S+00:00")
+    if tariffs:
+        if not isinstance(tariffs, list) or not all(isinstance(t, dict) for t in tariffs):
+            return JSONResponse({"error": "tariffs must be a list of requirement objects"}, status_code=422)
+        return JSONResponse(await compare_tariffs(address, time_minutes, tariffs, branch=branch))
 
-    # Yandex API Request Body
-    body = {
-        "route_points": [
+    result = await quote_address(address, time_minutes, branch=branch)
+
+    if result["status"] == "ok":
+        return JSONResponse({"price": result["price"], "cached": result["cached"]})
+    if result["status"] in ("busy", "timeout", "unavailable"):
+        # Yandex is saturated or slow: answer at once with the local estimate instead of queueing
+        return JSONResponse(
             {
-                "id": 1,
-                "coordinates": [71.423219, 51.128207],
-                "fullname": "Казахстан, Астана, проспект Туран, 24, Italita",
-                "country": "Казахстан",
-                "city": "Астана",
-                "street": "проспект Туран",
-                "building": "24",
-                "comment": "Ресторан Italita",
-                "contact": {
-                    "name": "Italita",
-                    "phone": "+7 (778) 333 12 56"
-                }
+                "price": None,
+                "fallback": True,
+                "estimate": estimate_quote(address, time_minutes, branch=branch),
+                "error": "Delivery quotes are temporarily unavailable"
             },
-            {
-                "id": 2,
-                "coordinates": [71.401911, 51.132355],
-                "fullname": address,
-                "country": "Казахстан",
-                "city": "Астана",
-                "street": address.split(',')[0],  # Extract street from address
-                "building": address.split(',')[1] if ',' in address else "",
-                "comment": "Получатель",
-                "contact": {
-                    "name": "Получатель",
-                    "phone": "+7 (777) 777 77 77"
-                }
-            }
-        ],
-        "requirements": {
-            "taxi_class": "courier",
-            "cargo_options": ["thermobag"],
-            "pro_courier": True,
-            "door_to_door": True
-        },
-        "delivery_description": "Доставка готовой еды",
-        "recipient_info": {
-            "phone": "+7 (777) 777 77 77",
-            "name": "Получатель"
-        },
-        "skip_door_to_door": False,
-        "client_requirements": {
-            "send_tracking_link": True,
-            "cargo_loaders": 1
-        },
-        "due": due
-    }
-
-    headers = {
-        "Authorization": f"Bearer {YANDEX_API_KEY}",
-        "Accept-Language": "ru",
-        "Content-Type": "application/json"
-    }
+            status_code=503,
+            headers={"Retry-After": "2"}
+        )
+    return JSONResponse({"error": result.get("error"), "estimate": estimate_quote(address, time_minutes, branch=branch)}, status_code=500)
+
+
+@app.post("/api/estimate_price")
+async def estimate_delivery_price(request: Request):
+    """
+    Instant local delivery price estimate built from past Yandex quotes,
+    without calling Yandex. Returns {"estimate": null} when there is no history nearby.
+    """
+    data = await request.json()
+    try:
+        return {"estimate": estimate_quote(data.get("address"), data.get("time"), data.get("tariff"), data.get("branch"))}
+    except Exception as e:
+        logging.error(f"❌ Error estimating delivery price: {str(e)}")
+        return JSONResponse(content={"error": str(e)}, status_code=500)
+
+
+@app.post("/api/calculate_price/batch")
+async def calculate_price_batch(request: Request):
+    """
+    Quotes many addresses at once: {"items": [{"address": ..., "time": ...}, ...]}.
+    Results are streamed as they complete, as NDJSON by default or as
+    server-sent events when the client accepts text/event-stream.
+    """
+    data = await request.json()
+    items = data.get("items")
+    if not isinstance(items, list) or not all(isinstance(i, dict) and i.get("address") for i in items):
+        return JSONResponse({"error": "items must be a list of {address, time} objects"}, status_code=422)
+    if len(items) > YANDEX_BATCH_MAX_ITEMS:
+        return JSONResponse({"error": f"At most {YANDEX_BATCH_MAX_ITEMS} items per batch"}, status_code=422)
+
+    items = [{"address": i["address"], "time": int(i.get("time") or 0), "branch": i.get("branch") or data.get("branch")} for i in items]
+    sse = "text/event-stream" in request.headers.get("accept", "")
+
+    async def stream():
+        async for result in stream_batch_quotes(items):
+            line = json.dumps(result, ensure_ascii=False)
+            yield f"data: {line}\n\n" if sse else f"{line}\n"
+        if sse:
+            yield "event: done\ndata: {}\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream" if sse else "application/x-ndjson")
+
 
+@app.get("/api/address_suggest")
+async def address_suggest(q: str = "", limit: int = 10):
+    """
+    Autocomplete for the price calculator: known streets and buildings
+    matching the typed prefix, most frequently delivered first.
+    """
     try:
-        response = requests.post(f"{YANDEX_BASE_URL}/check-price", json=body, headers=headers)
-        response.raise_for_status()
-        price = response.json().get("offer", {}).get("price")
-        return JSONResponse({"price": price})
+        return {"suggestions": suggest_addresses(q, max(1, min(limit, 20)))}
     except Exception as e:
-        return JSONResponse({"error": str(e)}, status_code=500)
+        logging.error(f"❌ Error suggesting addresses: {str(e)}")
+        return JSONResponse(content={"error": str(e)}, status_code=500)
 
 
 @app.exception_handler(RequestValidationError)
@@ -182,3 +419,6 @@ async def validation_exception_handler(request, exc):
 async def global_exception_handler(request, exc):
     logging.error(f"❌ Unhandled exception: {traceback.format_exc()}")
     return JSONResponse(content={"error": "Internal server error"}, status_code=500)
+
+# Serve the React build last so every API route above takes precedence
+app.mount("/", PrecompressedStaticFiles(directory="app/static/build"), name="static")
@@ -0,0 +1,79 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Tuple
+
+from app.config import WEBHOOK_MAX_IN_FLIGHT, WEBHOOK_DEDUP_TTL
+from services.metrics_service import inc, register_gauge
+from services.order_service import known_leads
+
+# Leads currently being processed, and lead ID -> admission time of recently accepted leads
+_in_flight = set()
+_recent: "OrderedDict[int, float]" = OrderedDict()
+_lock = threading.Lock()
+
+register_gauge("webhook_leads_in_flight", lambda: len(_in_flight), help="Webhook leads currently being processed")
+register_gauge("webhook_in_flight_limit", lambda: WEBHOOK_MAX_IN_FLIGHT, help="Maximum webhook leads processed at once")
+register_gauge("webhook_saturation", lambda: len(_in_flight) / WEBHOOK_MAX_IN_FLIGHT, help="Share of the in-flight budget in use")
+
+
+def admit(lead_ids: List[int]) -> Tuple[str, List[int]]:
+    """
+    Decides whether a webhook is processed. Returns (decision, lead IDs to process):
+    - "duplicate": every lead is in flight, was accepted within WEBHOOK_DEDUP_TTL
+      or already has an order (later edits of a lead, including the pipeline's
+      own price and name updates, never start a second order)
+    - "shed": the new leads do not fit into the WEBHOOK_MAX_IN_FLIGHT budget;
+      nothing is recorded, so amoCRM's retry is admitted once load drops
+    - "accepted": the new leads are now in flight and must be release()d
+    """
+    processed = set(known_leads(lead_ids))
+    now = time.monotonic()
+    with _lock:
+        while _recent and next(iter(_recent.values())) < now - WEBHOOK_DEDUP_TTL:
+            _recent.popitem(last=False)
+
+        new_ids = [
+            lead_id for lead_id in lead_ids
+            if lead_id not in _in_flight and lead_id not in _recent and lead_id not in processed
+        ]
+        if lead_ids and not new_ids:
+            decision = "duplicate"
+        elif len(_in_flight) + len(new_ids) > WEBHOOK_MAX_IN_FLIGHT:
+            decision = "shed"
+        else:
+            decision = "accepted"
+            for lead_id in new_ids:
+                _in_flight.add(lead_id)
+                _recent[lead_id] = now
+
+    inc("webhook_requests_total", help="amoCRM webhooks by admission decision", decision=decision)
+    if decision == "shed":
+        logging.warning(f"⚠️ Webhook shed: {len(_in_flight)}/{WEBHOOK_MAX_IN_FLIGHT} leads in flight, {len(new_ids)} more offered")
+    elif decision == "duplicate":
+        logging.info(f"🔹 Duplicate webhook for leads {lead_ids} acknowledged")
+    return decision, new_ids if decision == "accepted" else []
+
+
+def release(lead_ids: List[int]):
+    """Frees the in-flight budget taken by admitted leads; they stay deduplicated until the TTL ends."""
+    with _lock:
+        for lead_id in lead_ids:
+            _in_flight.discard(lead_id)
+
+
+def forget(lead_ids: List[int]):
+    """Frees admitted leads that were never processed and drops them from deduplication, so amoCRM's redelivery is admitted."""
+    with _lock:
+        for lead_id in lead_ids:
+            _in_flight.discard(lead_id)
+            _recent.pop(lead_id, None)
+
+
+def admission_snapshot() -> dict:
+    return {
+        "in_flight": len(_in_flight),
+        "limit": WEBHOOK_MAX_IN_FLIGHT,
+        "deduplicated": len(_recent)
+    }
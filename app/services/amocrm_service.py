@@ -1,22 +1,30 @@
+import contextvars
 import requests
 import logging
 import time
-from app.config import AMOCRM_DOMAIN, AMOCRM_TOKEN
+from typing import Dict, List, Optional
+from app.config import AMOCRM_DOMAIN, AMOCRM_TOKEN, ORDER_DEADLINE, HTTP_TIMEOUT
+from services.health_service import get_breaker
+from services.deadline_service import Deadline, DeadlineExceeded
+from services.executor_service import get_executor, ExecutorFull
 
-def get_child_lead_id(lead_id: int):
+def get_child_lead_id(lead_id: int, deadline: Optional[Deadline] = None):
     """
     Fetches the child lead ID from the latest note with note_type 'lead_auto_created'.
+    The note appears a few seconds after the parent lead, so the lookup is
+    retried with jittered backoff (slower while amoCRM probes are slow)
+    until MAX_RETRIES or the deadline.
     
     Parameters:
     - lead_id (int): The ID of the parent lead.
-    - max_retries (int): Maximum number of attempts to fetch the child lead ID.
-    - wait_time (int): Time in seconds to wait between retries.
+    - deadline (Deadline, optional): The order's time budget (ORDER_DEADLINE if omitted).
     
     Returns:
     - int: The ID of the latest child lead if found, otherwise None.
     """
     MAX_RETRIES = 5
-    WAIT_TIME = 20
+    WAIT_TIME = 20  # wait between attempts
+    deadline = deadline or Deadline(ORDER_DEADLINE)
 
     try:
         for attempt in range(MAX_RETRIES):
@@ -27,7 +35,7 @@ def get_child_lead_id(lead_id: int):
                     "Content-Type": "application/json"
                 }
 
-                response = requests.get(url, headers=headers)
+                response = requests.get(url, headers=headers, timeout=deadline.timeout())
                 response.raise_for_status()  # Raise an exception for HTTP errors
 
                 notes = response.json().get("_embedded", {}).get("notes", [])
@@ -48,21 +56,20 @@ def get_child_lead_id(lead_id: int):
                         return child_lead_id
 
                 logging.warning(f"⚠️ Attempt {attempt+1}/{MAX_RETRIES}: No 'lead_auto_created' note found for lead {lead_id}.")
-                time.sleep(WAIT_TIME)
 
             except requests.RequestException as e:
                 logging.error(f"❌ Network error while fetching notes for lead {lead_id} (attempt {attempt+1}/{MAX_RETRIES}): {str(e)}")
-                time.sleep(WAIT_TIME)
+
+            # amoCRM needs time to write the note, so waits keep the baseline's 20s (± jitter) rather than backing off from 0
+            if attempt + 1 < MAX_RETRIES and not deadline.sleep(WAIT_TIME):
+                logging.error(f"❌ Order deadline reached while looking up the child lead of {lead_id}.")
+                return None
         
         logging.error(f"❌ Unable to find 'lead_auto_created' note after {MAX_RETRIES} attempts for lead {lead_id}.")
         return None
 
-    except Exception as e:
-        logging.error(f"❌ Unexpected error in get_child_lead_id: {str(e)}")
-        return None
-
-    except requests.RequestException as e:
-        logging.error(f"❌ Network error while fetching notes for lead {lead_id}: {str(e)}")
+    except DeadlineExceeded as e:
+        logging.error(f"❌ Child lead lookup for lead {lead_id} stopped: {str(e)}")
         return None
     except Exception as e:
         logging.error(f"❌ Unexpected error in get_child_lead_id: {str(e)}")
@@ -71,6 +78,9 @@ def get_child_lead_id(lead_id: int):
 def add_note_to_amocrm(lead_id: int, text: str, service: str = ""):
     """
     Sends a note to a specific lead in AmoCRM.
+    The note is queued on the "notes" executor and posted in the background;
+    notes of the same lead keep their order. If the queue is full the note
+    is posted right away instead.
     
     Parameters:
     - lead_id (int): The ID of the lead to add the note to.
@@ -78,6 +88,17 @@ def add_note_to_amocrm(lead_id: int, text: str, service: str = ""):
     - service (str, optional): The name of the service (e.g., "iiko"). 
       If empty, note_type will be "common".
     """
+    if not lead_id:
+        logging.warning(f"⚠️ Note without a lead dropped: {text}")
+        return
+    try:
+        # Lead IDs arrive as str (webhook) and int (parsed); one key type keeps a lead on one shard
+        get_executor("notes").submit(contextvars.copy_context().run, _post_note, lead_id, text, service, key=int(lead_id))
+    except ExecutorFull:
+        _post_note(lead_id, text, service)
+
+def _post_note(lead_id: int, text: str, service: str = ""):
+    """Posts one note; runs on the "notes" executor."""
     url = f"https://{AMOCRM_DOMAIN}/api/v4/leads/{lead_id}/notes"
     headers = {
         "Authorization": f"Bearer {AMOCRM_TOKEN}",
@@ -105,7 +126,7 @@ def add_note_to_amocrm(lead_id: int, text: str, service: str = ""):
     ]
 
     try:
-        response = requests.post(url, headers=headers, json=payload)
+        response = requests.post(url, headers=headers, json=payload, timeout=HTTP_TIMEOUT)
         response.raise_for_status()  # Raise an exception for HTTP errors
         logging.info(f"✅ Note added to lead {lead_id} with type '{note_type}' and text: {text}")
         return response.json()
@@ -113,11 +134,75 @@ def add_note_to_amocrm(lead_id: int, text: str, service: str = ""):
         logging.error(f"❌ Failed to add note to lead {lead_id}: {str(e)}")
         return None
 
-def get_lead_data(lead_id: str):
+def _attach_linked_products(lead_id, lead_data: dict, base_url: str, headers: dict, deadline: Deadline) -> dict:
+    """Fetches the catalog products linked to a lead and stores them under _embedded.products."""
+    links_url = f"{base_url}/leads/{lead_id}/links"
+    try:
+        links_response = requests.get(links_url, headers=headers, timeout=deadline.timeout())
+        links_response.raise_for_status()
+    except requests.RequestException as e:
+        logging.warning(f"⚠️ No linked products found: {str(e)}")
+        add_note_to_amocrm(lead_id, f"Нет связанных товаров", "amoCRM")
+        lead_data["_embedded"] = {"products": []}
+        return lead_data
+
+    linked_items = links_response.json().get("_embedded", {}).get("links", [])
+    enriched_products = []
+
+    for link in linked_items:
+        if link.get("to_entity_type") != "catalog_elements":
+            continue
+
+        catalog_id = link["metadata"].get("catalog_id")
+        element_id = link["to_entity_id"]
+        quantity = link["metadata"].get("quantity", 1)
+
+        # Fetch catalog element
+        element_url = f"{base_url}/catalogs/{catalog_id}/elements/{element_id}"
+        try:
+            element_response = requests.get(element_url, headers=headers, timeout=deadline.timeout())
+            element_response.raise_for_status()
+        except requests.RequestException as e:
+            logging.warning(f"⚠️ Could not fetch catalog element {element_id}: {str(e)}")
+            add_note_to_amocrm(lead_id, f"Не удалось получить элемент каталога {element_id}", "amoCRM")
+            continue
+
+        element = element_response.json()
+        custom_fields = element.get("custom_fields_values", [])
+        product_id = None
+        size_id = None
+
+        for field in custom_fields:
+            try:
+                if field.get("field_name") == "productId":
+                    product_id = field["values"][0]["value"]
+                elif field.get("field_name") == "sizeId":
+                    size_id = field["values"][0]["value"]
+            except (IndexError, KeyError) as e:
+                logging.warning(f"⚠️ Error parsing field {field.get('field_name')}: {str(e)}")
+                add_note_to_amocrm(lead_id, f"Ошибка при разборе поля {field.get('field_name')}", "amoCRM")
+
+        if not product_id:
+            logging.warning(f"⚠️ Catalog element {element_id} has no productId, skipping")
+            add_note_to_amocrm(lead_id, f"Элемент каталога {element_id} не имеет productId, пропущено", "amoCRM")
+            continue
+
+        enriched_products.append({
+            "productId": product_id,
+            "sizeId": size_id,
+            "quantity": quantity
+        })
+
+    lead_data["_embedded"] = {"products": enriched_products}
+    return lead_data
+
+def get_lead_data(lead_id: str, lead_data: Optional[dict] = None, deadline: Optional[Deadline] = None):
     """
     Fetches lead data and attached catalog products via the /links endpoint.
     Uses custom fields "productId" and "sizeId" instead of external_uid.
+    Pass lead_data already fetched by get_leads_data to only resolve the products.
     """
+    deadline = deadline or Deadline(ORDER_DEADLINE)
     try:
         base_url = f"https://{AMOCRM_DOMAIN}/api/v4"
         headers = {
@@ -125,84 +210,64 @@ def get_lead_data(lead_id: str):
             "Content-Type": "application/json"
         }
 
+        if lead_data is not None:
+            return _attach_linked_products(lead_id, dict(lead_data), base_url, headers, deadline)
+
         # Step 1: Fetch lead info
         lead_url = f"{base_url}/leads/{lead_id}"
         try:
-            lead_response = requests.get(lead_url, headers=headers)
+            lead_response = requests.get(lead_url, headers=headers, timeout=deadline.timeout())
             lead_response.raise_for_status()
+            get_breaker("amocrm").record_success()
         except requests.RequestException as e:
+            get_breaker("amocrm").record_failure()
             logging.error(f"❌ Failed to fetch lead: {str(e)}")
             add_note_to_amocrm(lead_id, f"Ошибка при получении данных сделки", "amoCRM")
             return None
 
-        lead_data = lead_response.json()
-
         # Step 2: Fetch linked catalog items
-        links_url = f"{base_url}/leads/{lead_id}/links"
-        try:
-            links_response = requests.get(links_url, headers=headers)
-            links_response.raise_for_status()
-        except requests.RequestException as e:
-            logging.warning(f"⚠️ No linked products found: {str(e)}")
-            add_note_to_amocrm(lead_id, f"Нет связанных товаров", "amoCRM")
-            lead_data["_embedded"] = {"products": []}
-            return lead_data
-
-        linked_items = links_response.json().get("_embedded", {}).get("links", [])
-        enriched_products = []
-
-        for link in linked_items:
-            if link.get("to_entity_type") != "catalog_elements":
-                continue
-
-            catalog_id = link["metadata"].get("catalog_id")
-            element_id = link["to_entity_id"]
-            quantity = link["metadata"].get("quantity", 1)
-
-            # Fetch catalog element
-            element_url = f"{base_url}/catalogs/{catalog_id}/elements/{element_id}"
-            try:
-                element_response = requests.get(element_url, headers=headers)
-                element_response.raise_for_status()
-            except requests.RequestException as e:
-                logging.warning(f"⚠️ Could not fetch catalog element {element_id}: {str(e)}")
-                add_note_to_amocrm(lead_id, f"Не удалось получить элемент каталога {element_id}", "amoCRM")
-                continue
-
-            element = element_response.json()
-            custom_fields = element.get("custom_fields_values", [])
-            product_id = None
-            size_id = None
-
-            for field in custom_fields:
-                try:
-                    if field.get("field_name") == "productId":
-                        product_id = field["values"][0]["value"]
-                    elif field.get("field_name") == "sizeId":
-                        size_id = field["values"][0]["value"]
-                except (IndexError, KeyError) as e:
-                    logging.warning(f"⚠️ Error parsing field {field.get('field_name')}: {str(e)}")
-                    add_note_to_amocrm(lead_id, f"Ошибка при разборе поля {field.get('field_name')}", "amoCRM")
-
-            if not product_id:
-                logging.warning(f"⚠️ Catalog element {element_id} has no productId, skipping")
-                add_note_to_amocrm(lead_id, f"Элемент каталога {element_id} не имеет productId, пропущено", "amoCRM")
-                continue
-
-            enriched_products.append({
-                "productId": product_id,
-                "sizeId": size_id,
-                "quantity": quantity
-            })
-
-        lead_data["_embedded"] = {"products": enriched_products}
-        return lead_data
+        return _attach_linked_products(lead_id, lead_response.json(), base_url, headers, deadline)
 
+    except DeadlineExceeded as e:
+        logging.error(f"❌ Fetching lead {lead_id} stopped: {str(e)}")
+        return None
     except Exception as e:
         logging.error(f"❌ Unexpected error in get_lead_data: {str(e)}")
         add_note_to_amocrm(lead_id, f"Непредвиденная ошибка в получении данных сделки", "amoCRM")
         return None
 
+def get_leads_data(lead_ids: List) -> Dict[int, dict]:
+    """
+    Fetches several leads in one filtered /api/v4/leads request.
+    Returns lead ID -> lead info without linked products; leads missing from
+    the response (or all of them, if the request fails) are left out.
+    """
+    if not lead_ids:
+        return {}
+    try:
+        response = requests.get(
+            f"https://{AMOCRM_DOMAIN}/api/v4/leads",
+            headers={
+                "Authorization": f"Bearer {AMOCRM_TOKEN}",
+                "Content-Type": "application/json"
+            },
+            params={"filter[id][]": [int(lead_id) for lead_id in lead_ids], "limit": 250},
+            timeout=HTTP_TIMEOUT
+        )
+        response.raise_for_status()
+        get_breaker("amocrm").record_success()
+    except requests.RequestException as e:
+        get_breaker("amocrm").record_failure()
+        logging.error(f"❌ Failed to fetch {len(lead_ids)} leads: {str(e)}")
+        return {}
+
+    # amoCRM answers 204 with an empty body when no lead matched the filter
+    if response.status_code == 204:
+        return {}
+    leads = response.json().get("_embedded", {}).get("leads", [])
+    logging.info(f"✅ Fetched {len(leads)}/{len(lead_ids)} leads in one request")
+    return {lead["id"]: lead for lead in leads}
+
 
 def update_lead_status_in_amocrm(lead_id: int, status: int):
     """
@@ -220,7 +285,7 @@ def update_lead_status_in_amocrm(lead_id: int, status: int):
         }
 
         try:
-            response = requests.patch(url, headers=headers, json=payload)
+            response = requests.patch(url, headers=headers, json=payload, timeout=HTTP_TIMEOUT)
             response.raise_for_status()
         except requests.RequestException as e:
             logging.error(f"❌ Failed to update lead {lead_id} status: {str(e)}")
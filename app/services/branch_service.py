@@ -0,0 +1,32 @@
+import logging
+from typing import Optional, Tuple
+
+from app.config import BRANCHES, DEFAULT_BRANCH
+
+
+def _normalize(name: str) -> str:
+    return " ".join(name.lower().replace("ё", "е").replace(",", " ").split())
+
+
+def resolve_branch(name: Optional[str]) -> Tuple[str, dict]:
+    """
+    Maps the amoCRM "Филиал" value to a configured branch: exact name first,
+    then case-insensitive, then a name contained in the value ("Italita Туран 24").
+    Falls back to DEFAULT_BRANCH.
+    """
+    if name:
+        if name in BRANCHES:
+            return name, BRANCHES[name]
+        normalized = _normalize(name)
+        for key, branch in BRANCHES.items():
+            if _normalize(key) == normalized:
+                return key, branch
+        for key, branch in BRANCHES.items():
+            if _normalize(key) in normalized:
+                return key, branch
+        logging.warning(f"⚠️ Unknown branch '{name}', using {DEFAULT_BRANCH}")
+    return DEFAULT_BRANCH, BRANCHES[DEFAULT_BRANCH]
+
+
+def all_branches() -> dict:
+    return BRANCHES
@@ -0,0 +1,60 @@
+import random
+import threading
+import time
+from typing import Optional
+
+from app.config import HTTP_TIMEOUT
+
+
+class DeadlineExceeded(Exception):
+    """Raised when an order's time budget ran out before a call could be made."""
+
+
+class Deadline:
+    """
+    The time budget of one order, created when its webhook is received and
+    passed to every outbound call and retry loop working on it. Calls get
+    timeouts capped by what is left, and retry waits never outlive it.
+    """
+
+    def __init__(self, budget: float, started_at: Optional[float] = None):
+        # started_at is a time.time() timestamp; time spent before now counts against the budget
+        elapsed = time.time() - started_at if started_at else 0.0
+        self.budget = budget
+        self.expires_at = time.monotonic() + budget - elapsed
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def timeout(self, cap: float = HTTP_TIMEOUT) -> float:
+        """Timeout for one request: cap, shortened to the remaining budget."""
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded(f"order budget of {self.budget}s is spent")
+        return min(cap, remaining)
+
+    def sleep(self, seconds: float, jitter: float = 0.2, wake: Optional[threading.Event] = None) -> bool:
+        """
+        Sleeps seconds ± jitter (a fraction), or until wake is set. Returns
+        False without sleeping when the budget would run out before the next
+        attempt could start.
+        """
+        delay = seconds * random.uniform(1 - jitter, 1 + jitter)
+        if delay >= self.remaining():
+            return False
+        if wake is None:
+            time.sleep(delay)
+        elif wake.wait(delay):
+            wake.clear()
+        return True
+
+    def backoff(self, attempt: int, base: float, cap: float) -> bool:
+        """Full-jitter exponential backoff for retry attempt (0-based); False when out of budget."""
+        delay = random.uniform(0, min(cap, base * 2 ** attempt))
+        if delay >= self.remaining():
+            return False
+        time.sleep(delay)
+        return True
@@ -0,0 +1,146 @@
+import logging
+import sqlite3
+import statistics
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from typing import Deque, Dict, Optional, Tuple
+
+from app.config import SQLITE_PATH, ESTIMATOR_CELL_DEGREES, ESTIMATOR_HISTORY_DAYS
+
+# Local (Astana, UTC+5) hours grouped into price tiers
+_TIME_TIERS = (
+    (0, 7, "night"),
+    (7, 11, "morning"),
+    (11, 17, "day"),
+    (17, 22, "evening"),
+    (22, 24, "late")
+)
+SAMPLES_PER_BUCKET = 50
+HIGH_CONFIDENCE_SAMPLES = 5
+
+# (cell, tier, tariff) -> recent prices
+_buckets: Dict[Tuple[Tuple[int, int], str, str], Deque[float]] = {}
+_lock = threading.Lock()
+_db: Optional[sqlite3.Connection] = None
+
+
+def _get_db() -> sqlite3.Connection:
+    global _db
+    if _db is None:
+        _db = sqlite3.connect(SQLITE_PATH, check_same_thread=False)
+        _db.execute("PRAGMA journal_mode=WAL")
+        _db.execute("PRAGMA synchronous=NORMAL")
+        _db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS quote_history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                quoted_at REAL NOT NULL,
+                lon REAL NOT NULL,
+                lat REAL NOT NULL,
+                due_offset INTEGER NOT NULL,
+                tariff TEXT NOT NULL,
+                price REAL NOT NULL
+            )
+            """
+        )
+        _db.execute("CREATE INDEX IF NOT EXISTS idx_quote_history_quoted_at ON quote_history (quoted_at)")
+        _db.commit()
+    return _db
+
+
+def _cell(lon: float, lat: float) -> Tuple[int, int]:
+    return int(lat // ESTIMATOR_CELL_DEGREES), int(lon // ESTIMATOR_CELL_DEGREES)
+
+
+def _tier(quoted_at: float, due_offset: int) -> str:
+    due = datetime.fromtimestamp(quoted_at, timezone.utc) + timedelta(hours=5, minutes=due_offset)
+    for start, end, name in _TIME_TIERS:
+        if start <= due.hour < end:
+            return name
+    return "day"
+
+
+def _add_sample(lon: float, lat: float, quoted_at: float, due_offset: int, tariff: str, price: float):
+    key = (_cell(lon, lat), _tier(quoted_at, due_offset), tariff)
+    with _lock:
+        bucket = _buckets.get(key)
+        if bucket is None:
+            bucket = _buckets[key] = deque(maxlen=SAMPLES_PER_BUCKET)
+        bucket.append(price)
+
+
+def load_quote_history():
+    """Rebuilds the in-memory price grid from the last ESTIMATOR_HISTORY_DAYS of recorded quotes."""
+    try:
+        since = time.time() - ESTIMATOR_HISTORY_DAYS * 86400
+        with _lock:
+            rows = _get_db().execute(
+                "SELECT lon, lat, quoted_at, due_offset, tariff, price FROM quote_history "
+                "WHERE quoted_at >= ? ORDER BY quoted_at",
+                (since,)
+            ).fetchall()
+        for row in rows:
+            _add_sample(*row)
+        logging.info(f"✅ Price estimator loaded {len(rows)} historical quotes into {len(_buckets)} buckets")
+    except Exception as e:
+        logging.error(f"❌ Error loading quote history: {str(e)}")
+
+
+def record_quote(coordinates: list, due_offset: int, tariff: str, price):
+    """Stores a live Yandex quote and feeds it into the estimator."""
+    try:
+        lon, lat = float(coordinates[0]), float(coordinates[1])
+        price = float(price)
+        quoted_at = time.time()
+        with _lock:
+            db = _get_db()
+            db.execute(
+                "INSERT INTO quote_history (quoted_at, lon, lat, due_offset, tariff, price) VALUES (?, ?, ?, ?, ?, ?)",
+                (quoted_at, lon, lat, int(due_offset or 0), tariff, price)
+            )
+            db.commit()
+        _add_sample(lon, lat, quoted_at, int(due_offset or 0), tariff, price)
+    except Exception as e:
+        logging.error(f"❌ Error recording quote: {str(e)}")
+
+
+def estimate_price(coordinates: list, due_offset: int, tariff: str) -> Optional[dict]:
+    """
+    Estimates a delivery price from recorded quotes.
+
+    Looks at the exact grid cell and time tier first, then the surrounding
+    cells in the same tier, then the same cell at any time of day. Returns
+    {"price", "confidence" ("high" / "medium" / "low"), "samples"} or None
+    when nothing nearby has been quoted yet.
+    """
+    try:
+        lat_cell, lon_cell = _cell(float(coordinates[0]), float(coordinates[1]))
+        tier = _tier(time.time(), int(due_offset or 0))
+
+        with _lock:
+            exact = list(_buckets.get(((lat_cell, lon_cell), tier, tariff), ()))
+            if len(exact) >= HIGH_CONFIDENCE_SAMPLES:
+                return {"price": round(statistics.median(exact)), "confidence": "high", "samples": len(exact)}
+
+            nearby = list(exact)
+            for d_lat in (-1, 0, 1):
+                for d_lon in (-1, 0, 1):
+                    if d_lat or d_lon:
+                        nearby.extend(_buckets.get(((lat_cell + d_lat, lon_cell + d_lon), tier, tariff), ()))
+            if nearby:
+                return {"price": round(statistics.median(nearby)), "confidence": "medium", "samples": len(nearby)}
+
+            any_time = [
+                price
+                for (cell, _, bucket_tariff), bucket in _buckets.items()
+                if cell == (lat_cell, lon_cell) and bucket_tariff == tariff
+                for price in bucket
+            ]
+        if any_time:
+            return {"price": round(statistics.median(any_time)), "confidence": "low", "samples": len(any_time)}
+        return None
+    except Exception as e:
+        logging.error(f"❌ Error estimating price: {str(e)}")
+        return None
@@ -0,0 +1,90 @@
+import asyncio
+import json
+import logging
+import threading
+from typing import Optional, Set
+
+from app.config import EVENTS_CLIENT_BUFFER
+
+# Stage transitions are published from worker threads (webhook processing,
+# delivery trackers) and fanned out to SSE clients on the event loop.
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_subscribers: Set["Subscriber"] = set()
+_lock = threading.Lock()
+
+
+class Subscriber:
+    """One SSE client: a bounded queue that is dropped once it overflows."""
+
+    def __init__(self, maxsize: int = EVENTS_CLIENT_BUFFER):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self.dropped = False
+
+    def offer(self, event: dict):
+        if self.dropped:
+            return
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # Slow consumer: cut it off instead of buffering without limit
+            self.dropped = True
+            unsubscribe(self)
+            logging.warning("⚠️ Dropping slow order-events subscriber")
+
+
+def bind_event_loop(loop: asyncio.AbstractEventLoop):
+    """Remembers the server event loop so worker threads can publish into it."""
+    global _loop
+    _loop = loop
+
+
+def subscribe() -> Subscriber:
+    subscriber = Subscriber()
+    with _lock:
+        _subscribers.add(subscriber)
+    return subscriber
+
+
+def unsubscribe(subscriber: Subscriber):
+    with _lock:
+        _subscribers.discard(subscriber)
+
+
+def subscriber_count() -> int:
+    return len(_subscribers)
+
+
+def _fan_out(event: dict):
+    with _lock:
+        subscribers = list(_subscribers)
+    for subscriber in subscribers:
+        subscriber.offer(event)
+
+
+def publish(event: dict):
+    """Publishes an event to every subscriber; safe to call from any thread."""
+    try:
+        if _loop is None or _loop.is_closed() or not _subscribers:
+            return
+        _loop.call_soon_threadsafe(_fan_out, event)
+    except Exception as e:
+        logging.error(f"❌ Error publishing order event: {str(e)}")
+
+
+async def stream_events(subscriber: Subscriber, snapshot: list, keepalive: float = 15.0):
+    """
+    Yields SSE frames: first a snapshot of active orders, then every stage
+    transition, with a comment line as keepalive. Stops when the
+    subscriber was dropped for falling behind.
+    """
+    try:
+        yield f"event: snapshot\ndata: {json.dumps(snapshot, ensure_ascii=False)}\n\n"
+        while not subscriber.dropped:
+            try:
+                event = await asyncio.wait_for(subscriber.queue.get(), timeout=keepalive)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            yield f"event: stage\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+    finally:
+        unsubscribe(subscriber)
@@ -0,0 +1,154 @@
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Optional
+
+from app.config import EXECUTORS
+from services.metrics_service import inc, register_gauge
+
+
+class ExecutorFull(RuntimeError):
+    """Raised when a workload's queue limit is reached; the caller decides whether to drop or retry."""
+
+
+class BoundedExecutor:
+    """
+    A thread pool for one workload class with its own size and queue limit,
+    so a burst in one workload (e.g. 90-minute delivery trackers) cannot take
+    the threads another one needs. With shards > 1 it is made of
+    single-thread pools and tasks with the same key always run in order on
+    the same one (used for amoCRM notes, which must keep their order per lead).
+    """
+
+    def __init__(self, name: str, workers: int, queue_limit: Optional[int] = None, shards: int = 1):
+        self.name = name
+        self.workers = workers
+        self.queue_limit = queue_limit
+        if shards > 1:
+            self._pools = [ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"{name}-{i}") for i in range(shards)]
+        else:
+            self._pools = [ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)]
+        self.active = 0
+        self.queued = 0
+        self.reserved = 0
+        self._waits = deque(maxlen=200)
+        self._round_robin = itertools.count()
+        self._lock = threading.Lock()
+
+    def submit(self, fn: Callable, *args, key=None, **kwargs) -> Future:
+        return self._submit(fn, args, kwargs, key, reserved=False)
+
+    def submit_reserved(self, fn: Callable, *args, key=None, **kwargs) -> Future:
+        """Submits a task into a slot taken earlier with reserve(); never raises ExecutorFull."""
+        return self._submit(fn, args, kwargs, key, reserved=True)
+
+    def reserve(self, tasks: int) -> bool:
+        """
+        Takes queue slots for tasks to be submitted later with
+        submit_reserved(). Returns False, taking nothing, if they do not fit
+        next to the queued and already reserved tasks. Slots that end up
+        unused must be given back with unreserve().
+        """
+        with self._lock:
+            if self.queue_limit is not None and self.queued + self.reserved + tasks > self.queue_limit:
+                inc("executor_rejected_total", help="Tasks refused because the executor queue was full", pool=self.name)
+                return False
+            self.reserved += tasks
+            return True
+
+    def unreserve(self, tasks: int):
+        with self._lock:
+            self.reserved -= tasks
+
+    def _submit(self, fn: Callable, args: tuple, kwargs: dict, key, reserved: bool) -> Future:
+        with self._lock:
+            if reserved:
+                self.reserved -= 1
+            elif self.queue_limit is not None and self.queued + self.reserved >= self.queue_limit:
+                inc("executor_rejected_total", help="Tasks refused because the executor queue was full", pool=self.name)
+                raise ExecutorFull(f"{self.name} executor queue is full ({self.queue_limit})")
+            self.queued += 1
+        submitted_at = time.monotonic()
+
+        def run():
+            with self._lock:
+                self.queued -= 1
+                self.active += 1
+                self._waits.append(time.monotonic() - submitted_at)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.active -= 1
+                inc("executor_completed_total", help="Tasks finished per executor", pool=self.name)
+
+        if len(self._pools) == 1:
+            pool = self._pools[0]
+        elif key is not None:
+            pool = self._pools[hash(key) % len(self._pools)]
+        else:
+            pool = self._pools[next(self._round_robin) % len(self._pools)]
+        future = pool.submit(run)
+        future.add_done_callback(self._forget_cancelled)
+        return future
+
+    def _forget_cancelled(self, future: Future):
+        # A task cancelled while queued never runs, so it has to leave the queue count here
+        if future.cancelled():
+            with self._lock:
+                self.queued -= 1
+
+    def wait_ms(self, fraction: float) -> Optional[float]:
+        """Queue wait of the recent tasks at the given percentile (0.5 = median)."""
+        with self._lock:
+            waits = sorted(self._waits)
+        if not waits:
+            return None
+        return round(waits[min(len(waits) - 1, int(fraction * len(waits)))] * 1000, 1)
+
+    def snapshot(self) -> dict:
+        return {
+            "workers": self.workers,
+            "active": self.active,
+            "queued": self.queued,
+            "reserved": self.reserved,
+            "queue_limit": self.queue_limit,
+            "utilization": round(self.active / self.workers, 3),
+            "wait_p50_ms": self.wait_ms(0.5),
+            "wait_p90_ms": self.wait_ms(0.9)
+        }
+
+
+_executors: Dict[str, BoundedExecutor] = {}
+_executors_lock = threading.Lock()
+
+
+def get_executor(name: str) -> BoundedExecutor:
+    """The executor of a workload class configured in EXECUTORS, created on first use."""
+    executor = _executors.get(name)
+    if executor is not None:
+        return executor
+    with _executors_lock:
+        if name in _executors:
+            return _executors[name]
+        settings = EXECUTORS[name]
+        executor = _executors[name] = BoundedExecutor(
+            name,
+            settings["workers"],
+            settings.get("queue_limit"),
+            settings.get("shards", 1)
+        )
+        register_gauge("executor_workers", lambda e=executor: e.workers, help="Threads per executor", pool=name)
+        register_gauge("executor_active", lambda e=executor: e.active, help="Tasks running per executor", pool=name)
+        register_gauge("executor_queued", lambda e=executor: e.queued, help="Tasks waiting for a thread per executor", pool=name)
+        register_gauge("executor_utilization", lambda e=executor: e.active / e.workers, help="Share of executor threads busy", pool=name)
+        register_gauge("executor_wait_ms", lambda e=executor: e.wait_ms(0.9), help="p90 queue wait of recent tasks", pool=name, quantile="0.9")
+        logging.info(f"✅ Executor '{name}' ready with {executor.workers} threads")
+    return executor
+
+
+def executor_snapshots() -> dict:
+    return {name: executor.snapshot() for name, executor in _executors.items()}
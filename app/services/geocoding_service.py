@@ -0,0 +1,306 @@
+import bisect
+import csv
+import heapq
+import logging
+import re
+import threading
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+from app.config import GAZETTEER_PATH, ADDRESS_HISTORY_PATH
+
+# Words that carry no information for matching a street name
+_NOISE_WORDS = {
+    "казахстан", "республика", "астана", "нур-султан", "г", "город",
+    "улица", "ул", "проспект", "пр", "пр-т", "пр-кт", "просп",
+    "шоссе", "ш", "переулок", "пер", "бульвар", "б-р", "бул",
+    "микрорайон", "мкр", "мкрн", "м-н", "жилой", "массив", "жм",
+    "дом", "д", "здание", "зд"
+}
+
+_BUILDING_RE = re.compile(r"^\d+[а-яa-z]?(?:[/\-]\d+[а-яa-z]?)?$")
+_TOKEN_RE = re.compile(r"[0-9a-zа-я/\-]+")
+
+# Sorted normalized street names, and per street: display name,
+# buildings -> (lon, lat) and the street centroid used when the
+# building is unknown.
+_street_keys: List[str] = []
+_streets: Dict[str, dict] = {}
+
+# Autocomplete index: sorted normalized "street building" keys and, per key,
+# the display address, coordinates and how many past orders went there.
+_suggest_keys: List[str] = []
+_suggestions: Dict[str, dict] = {}
+_suggest_lock = threading.Lock()
+
+SUGGEST_SCAN_LIMIT = 5000  # keys examined per query, keeps one-letter prefixes fast
+GAZETTEER_MIN_STREETS = 100  # fewer streets than this means the city gazetteer was not built
+
+
+def normalize_street(name: str) -> str:
+    """Lowercases a street name and drops street-type and city words."""
+    name = name.lower().replace("ё", "е")
+    tokens = [t.strip("-") for t in _TOKEN_RE.findall(name)]
+    return " ".join(t for t in tokens if t and t not in _NOISE_WORDS)
+
+
+def normalize_building(building: str) -> str:
+    return re.sub(r"[\s.]+", "", building.lower().replace("ё", "е"))
+
+
+def split_address(address: str) -> Tuple[str, str]:
+    """
+    Splits a free-text address into a normalized (street, building) pair.
+    Handles both "Кенесары, 40, 2, 5" and "ул. Кенесары 40".
+    """
+    street = ""
+    building = ""
+    for part in address.split(","):
+        tokens = [t for t in _TOKEN_RE.findall(part.lower().replace("ё", "е")) if t not in _NOISE_WORDS]
+        if not tokens:
+            continue
+        if not street:
+            # A trailing number on the street part is the building
+            if len(tokens) > 1 and _BUILDING_RE.match(tokens[-1]):
+                building = tokens[-1]
+                tokens = tokens[:-1]
+            if any(not _BUILDING_RE.match(t) for t in tokens):
+                street = " ".join(tokens)
+                if building:
+                    break
+                continue
+        if street and not building and _BUILDING_RE.match(tokens[0]):
+            building = tokens[0]
+            break
+    return street, normalize_building(building)
+
+
+def load_gazetteer(path: str = GAZETTEER_PATH):
+    """
+    Loads the street/building gazetteer (CSV: street, building, lon, lat)
+    into the in-memory index.
+    """
+    global _street_keys, _streets
+    streets: Dict[str, dict] = {}
+    try:
+        with open(path, encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                try:
+                    key = normalize_street(row["street"])
+                    if not key:
+                        continue
+                    lon, lat = float(row["lon"]), float(row["lat"])
+                    entry = streets.setdefault(key, {"name": row["street"].strip(), "buildings": {}})
+                    building = normalize_building(row.get("building") or "")
+                    if building:
+                        entry["buildings"][building] = (lon, lat)
+                    else:
+                        entry["centroid"] = (lon, lat)
+                except (KeyError, ValueError) as e:
+                    logging.warning(f"⚠️ Skipping malformed gazetteer row {row}: {str(e)}")
+    except OSError as e:
+        logging.error(f"❌ Could not load gazetteer from {path}: {str(e)}")
+        _build_suggestions()
+        return
+
+    for entry in streets.values():
+        if "centroid" not in entry and entry["buildings"]:
+            points = entry["buildings"].values()
+            entry["centroid"] = (
+                sum(p[0] for p in points) / len(points),
+                sum(p[1] for p in points) / len(points)
+            )
+
+    _streets = streets
+    _street_keys = sorted(streets)
+    geocode_address.cache_clear()
+    logging.info(f"✅ Gazetteer loaded with {len(_street_keys)} streets")
+    if len(_street_keys) < GAZETTEER_MIN_STREETS:
+        logging.warning(f"⚠️ Gazetteer at {path} only has {len(_street_keys)} streets; build it with scripts/build_gazetteer.py")
+
+    _build_suggestions()
+
+
+def _edit_distance(a: str, b: str, limit: int) -> int:
+    """Levenshtein distance, giving up once it exceeds limit."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+def match_street(street: str) -> Optional[str]:
+    """
+    Finds the gazetteer key for a normalized street name: exact match first,
+    then the closest name among streets sharing its first three letters,
+    then among streets sharing its first letter and of similar length.
+    """
+    if not street or not _street_keys:
+        return None
+
+    i = bisect.bisect_left(_street_keys, street)
+    if i < len(_street_keys) and _street_keys[i] == street:
+        return street
+
+    limit = max(1, len(street) // 4)
+    for prefix in (street[:3], street[:1]):
+        lo = bisect.bisect_left(_street_keys, prefix)
+        hi = bisect.bisect_right(_street_keys, prefix + "\uffff")
+        best, best_distance = None, limit + 1
+        for candidate in _street_keys[lo:hi]:
+            if abs(len(candidate) - len(street)) > limit:
+                continue
+            distance = _edit_distance(street, candidate, limit)
+            if distance < best_distance:
+                best, best_distance = candidate, distance
+        if best:
+            return best
+    return None
+
+
+@lru_cache(maxsize=4096)
+def geocode_address(address: str) -> Optional[dict]:
+    """
+    Resolves a free-text Astana address to coordinates using the local gazetteer.
+
+    Returns a dict with "coordinates" ([lon, lat] as Yandex expects),
+    canonical "street", "building" and "precision" ("building" or "street"),
+    or None if the street is unknown.
+    """
+    try:
+        street, building = split_address(address or "")
+        key = match_street(street)
+        if not key:
+            return None
+
+        entry = _streets[key]
+        if building in entry["buildings"]:
+            lon, lat = entry["buildings"][building]
+            precision = "building"
+        else:
+            lon, lat = entry["centroid"]
+            precision = "street"
+
+        return {
+            "coordinates": [lon, lat],
+            "street": entry["name"],
+            "building": building,
+            "precision": precision
+        }
+    except Exception as e:
+        logging.error(f"❌ Error geocoding address '{address}': {str(e)}")
+        return None
+
+
+def _add_suggestion(key: str, address: str, coordinates: Optional[list], count: int = 0):
+    entry = _suggestions.get(key)
+    if entry is None:
+        _suggestions[key] = {"address": address, "coordinates": coordinates, "count": count}
+        bisect.insort(_suggest_keys, key)
+    else:
+        entry["count"] += count
+        if coordinates and not entry["coordinates"]:
+            entry["coordinates"] = coordinates
+
+
+def _history_suggestion(address: str) -> Optional[Tuple[str, str, Optional[list]]]:
+    """Reduces a delivered address to its street and building for the suggest index."""
+    street, building = split_address(address)
+    if not street or not building:
+        return None
+    location = geocode_address(address)
+    if location:
+        display = f"{location['street']}, {building}"
+        coordinates = location["coordinates"] if location["precision"] == "building" else None
+        key = f"{normalize_street(location['street'])} {building}"
+    else:
+        display = f"{address.split(',')[0].strip()}, {building}"
+        coordinates = None
+        key = f"{street} {building}"
+    return key, display, coordinates
+
+
+def _build_suggestions():
+    """Rebuilds the autocomplete index from the gazetteer and the delivered-address history."""
+    global _suggest_keys, _suggestions
+    with _suggest_lock:
+        _suggest_keys = []
+        _suggestions = {}
+
+        for key, entry in _streets.items():
+            _suggestions[key] = {"address": entry["name"], "coordinates": None, "count": 0}
+            for building, point in entry["buildings"].items():
+                _suggestions[f"{key} {building}"] = {
+                    "address": f"{entry['name']}, {building}",
+                    "coordinates": list(point),
+                    "count": 0
+                }
+        _suggest_keys = sorted(_suggestions)
+
+        try:
+            with open(ADDRESS_HISTORY_PATH, encoding="utf-8") as f:
+                for line in f:
+                    suggestion = _history_suggestion(line.strip())
+                    if suggestion:
+                        _add_suggestion(*suggestion, count=1)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logging.error(f"❌ Could not read address history from {ADDRESS_HISTORY_PATH}: {str(e)}")
+
+    logging.info(f"✅ Address suggestions indexed: {len(_suggest_keys)} entries")
+
+
+def remember_delivered_address(address: str):
+    """
+    Records the address of an accepted order so it ranks higher in suggestions,
+    both in memory and in the history file mined at startup.
+    """
+    try:
+        if not address:
+            return
+        suggestion = _history_suggestion(address)
+        if not suggestion:
+            return
+        with _suggest_lock:
+            _add_suggestion(*suggestion, count=1)
+            with open(ADDRESS_HISTORY_PATH, "a", encoding="utf-8") as f:
+                f.write(address.replace("\n", " ").strip() + "\n")
+    except Exception as e:
+        logging.error(f"❌ Error remembering delivered address '{address}': {str(e)}")
+
+
+def suggest_addresses(query: str, limit: int = 10) -> List[dict]:
+    """
+    Returns up to `limit` known addresses starting with the typed text,
+    most frequently delivered first, then buildings before bare streets.
+    """
+    street, building = split_address(query or "")
+    prefix = f"{street} {building}" if building else street
+    if len(prefix) < 2:
+        return []
+
+    lo = bisect.bisect_left(_suggest_keys, prefix)
+    hi = min(bisect.bisect_right(_suggest_keys, prefix + "\uffff"), lo + SUGGEST_SCAN_LIMIT)
+    keys = _suggest_keys[lo:hi]
+
+    ranked = heapq.nsmallest(
+        limit,
+        keys,
+        key=lambda k: (-_suggestions[k]["count"], _suggestions[k]["coordinates"] is None, len(k), k)
+    )
+    return [
+        {
+            "address": _suggestions[k]["address"],
+            "coordinates": _suggestions[k]["coordinates"],
+            "deliveries": _suggestions[k]["count"]
+        }
+        for k in ranked
+    ]
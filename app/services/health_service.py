@@ -0,0 +1,168 @@
+import asyncio
+import logging
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+from app.config import (
+    BREAKER_FAILURE_THRESHOLD,
+    BREAKER_RESET_TIMEOUT,
+    WARMUP_TIMEOUT,
+    WARMUP_RETRY_INTERVAL
+)
+
+STARTED_AT = time.time()
+
+
+class CircuitBreaker:
+    """
+    Counts consecutive failures of one provider. After
+    BREAKER_FAILURE_THRESHOLD failures the breaker opens and callers should
+    skip the provider; after BREAKER_RESET_TIMEOUT seconds one trial call is
+    let through (half-open) and its outcome closes or re-opens the breaker.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = BREAKER_FAILURE_THRESHOLD, reset_timeout: float = BREAKER_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        """True if a call to the provider may be attempted now."""
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half_open" and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                logging.info(f"✅ {self.name} circuit closed")
+            self.failures = 0
+            self.opened_at = None
+            self._trial_in_flight = False
+
+    def release_trial(self):
+        """Ends a half-open trial that never reached the provider, without counting it either way."""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_in_flight = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    logging.error(f"❌ {self.name} circuit opened after {self.failures} consecutive failures")
+                self.opened_at = time.monotonic()
+
+    def snapshot(self) -> dict:
+        return {"state": self.state, "consecutive_failures": self.failures}
+
+
+breakers: Dict[str, CircuitBreaker] = {
+    "amocrm": CircuitBreaker("amoCRM"),
+    "iiko": CircuitBreaker("iiko"),
+    "yandex": CircuitBreaker("Yandex")
+}
+
+
+def get_breaker(provider: str) -> CircuitBreaker:
+    return breakers[provider]
+
+
+# Warm-up name -> {"status": pending/running/ok/failed/timeout, "attempts", "duration_ms", "error"}
+_warmups: Dict[str, dict] = {}
+
+
+async def _run_warmup(name: str, fn: Callable[[], bool], required: bool):
+    state = _warmups[name]
+    while True:
+        state["status"] = "running"
+        state["attempts"] += 1
+        started = time.monotonic()
+        try:
+            ok = await asyncio.wait_for(asyncio.to_thread(fn), timeout=WARMUP_TIMEOUT)
+            state["status"] = "ok" if ok is not False else "failed"
+            state["error"] = None if ok is not False else "returned no data"
+        except asyncio.TimeoutError:
+            state["status"] = "timeout"
+            state["error"] = f"did not finish within {WARMUP_TIMEOUT}s"
+        except Exception as e:
+            state["status"] = "failed"
+            state["error"] = str(e)
+        state["duration_ms"] = round((time.monotonic() - started) * 1000)
+
+        if state["status"] == "ok":
+            logging.info(f"✅ Warm-up '{name}' finished in {state['duration_ms']} ms")
+            return
+        logging.error(f"❌ Warm-up '{name}' {state['status']}: {state['error']}")
+        if not required:
+            return
+        await asyncio.sleep(WARMUP_RETRY_INTERVAL)
+
+
+def start_warmups(warmups: Dict[str, Callable[[], bool]], required: tuple = ()) -> asyncio.Task:
+    """
+    Runs every warm-up concurrently in worker threads without blocking startup.
+    A warm-up returning False or raising counts as failed; required warm-ups
+    are retried every WARMUP_RETRY_INTERVAL seconds until they succeed.
+    """
+    for name in warmups:
+        _warmups[name] = {"status": "pending", "attempts": 0, "duration_ms": None, "error": None, "required": name in required}
+    return asyncio.ensure_future(asyncio.gather(
+        *(_run_warmup(name, fn, name in required) for name, fn in warmups.items())
+    ))
+
+
+def liveness() -> dict:
+    """Process is up; provider breaker states are reported for information only."""
+    return {
+        "status": "alive",
+        "uptime_s": round(time.time() - STARTED_AT),
+        "breakers": {name: breaker.snapshot() for name, breaker in breakers.items()}
+    }
+
+
+def readiness(checks: Dict[str, Callable[[], bool]]) -> dict:
+    """
+    Ready when every check passes (e.g. menu snapshot loaded) and every
+    required warm-up succeeded. Open provider breakers do not make the
+    instance unready: webhooks must still be accepted while iiko or Yandex
+    is down (orders wait in the iiko outbox), and no other instance would do
+    better. Breaker states are included for information.
+    """
+    check_results = {}
+    for name, check in checks.items():
+        try:
+            check_results[name] = bool(check())
+        except Exception as e:
+            logging.error(f"❌ Readiness check '{name}' failed: {str(e)}")
+            check_results[name] = False
+
+    ready = (
+        all(check_results.values())
+        and all(w["status"] == "ok" for w in _warmups.values() if w["required"])
+    )
+    return {
+        "ready": ready,
+        "checks": check_results,
+        "breakers": {name: breaker.snapshot() for name, breaker in breakers.items()},
+        "warmups": _warmups
+    }
@@ -2,17 +2,29 @@ import requests
 import logging
 from app.config import (
     IIKO_API_KEY,
-    IIKO_ORGANIZATION_ID,
-    IIKO_TERMINAL_GROUP_ID,
-    IIKO_MENU_ID,
     IIKO_BASE_URL,
-    IIKO_MENU_URL
+    IIKO_MENU_URL,
+    IIKO_TOKEN_TTL,
+    TERMINAL_HEARTBEAT_INTERVAL,
+    TERMINAL_STATUS_MAX_AGE,
+    ORDER_STATUS_TICK,
+    ORDER_STATUS_TIMEOUT,
+    HTTP_TIMEOUT
 )
 from typing import Optional, Dict, Tuple
 import json
 import time
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 from services.amocrm_service import add_note_to_amocrm
+from services.health_service import get_breaker
+from services.branch_service import resolve_branch, all_branches
+from services.order_service import save_order
+from services.deadline_service import Deadline, DeadlineExceeded
+from services.probe_service import record_probe, retry_interval
+from services.outbox_service import park_order, has_waiting, wake_outbox_drainer
 
 combo_mapping = {
     "1e2b0ce9-2c7a-4142-ab25-feb1bd703852": [
@@ -55,25 +67,65 @@ combo_mapping = {
     ]
 }
 
-payload_iiko = {}
+# Terminal group ID -> {"alive", "checked_at", "changed_at"} kept fresh by the heartbeat thread,
+# and the liveness last reported in a lead note
+_terminal_status: Dict[str, dict] = {}
+_noted_status: Dict[str, bool] = {}
+_terminal_lock = threading.Lock()
+_heartbeat_stop = threading.Event()
+_heartbeat_thread: Optional[threading.Thread] = None
 
-_menu_lookup: Dict[Tuple[str, Optional[str]], dict] = {}
+# iiko order ID -> waiter {"organization_id", "deadline", "event", "ready"} polled by the order-status watcher
+_pending_orders: Dict[str, dict] = {}
+_watch_lock = threading.Lock()
+_watch_wakeup = threading.Event()
+_watch_thread: Optional[threading.Thread] = None
+
+# Branch name -> (productId, sizeId) -> menu item
+_menus: Dict[str, Dict[Tuple[str, Optional[str]], dict]] = {}
+
+_token_cache = {"token": None, "expires_at": 0.0}
+_token_lock = threading.Lock()
+
+class IikoUnavailable(Exception):
+    """iiko or the branch terminal cannot take orders right now; the order is parked and sent later."""
 
 def get_iiko_token() -> Optional[str]:
-    """Fetch authentication token from iiko API."""
-    try:
-        url = f"{IIKO_BASE_URL}/access_token"
-        payload = {"apiLogin": IIKO_API_KEY}
-        response = requests.post(url, json=payload)
+    """
+    Fetch authentication token from iiko API.
+    Tokens are reused for IIKO_TOKEN_TTL seconds; no request is made while the iiko circuit is open.
+    """
+    with _token_lock:
+        if _token_cache["token"] and time.monotonic() < _token_cache["expires_at"]:
+            return _token_cache["token"]
 
-        response.raise_for_status()
-        return response.json().get("token")
-    except requests.RequestException as e:
-        logging.error(f"❌ Failed to fetch iiko token: {str(e)}")
-        return None
+        breaker = get_breaker("iiko")
+        if not breaker.allow():
+            logging.warning("⚠️ iiko circuit is open, skipping token request")
+            return None
+
+        try:
+            url = f"{IIKO_BASE_URL}/access_token"
+            payload = {"apiLogin": IIKO_API_KEY}
+            response = requests.post(url, json=payload, timeout=HTTP_TIMEOUT)
+
+            response.raise_for_status()
+            token = response.json().get("token")
+            breaker.record_success()
+            _token_cache["token"] = token
+            _token_cache["expires_at"] = time.monotonic() + IIKO_TOKEN_TTL
+            return token
+        except requests.RequestException as e:
+            breaker.record_failure()
+            logging.error(f"❌ Failed to fetch iiko token: {str(e)}")
+            return None
     
-def is_terminal_group_alive(lead_id) -> bool:
-    """Check if the terminal group is alive."""
+def poll_terminal_liveness() -> bool:
+    """
+    Checks every configured terminal group in one batched is_alive request
+    and refreshes the liveness cache. Returns False if the request failed.
+    """
+    branches = all_branches()
     try:
         token = get_iiko_token()
         if not token:
@@ -82,45 +134,134 @@ def is_terminal_group_alive(lead_id) -> bool:
         headers = {"Authorization": f"Bearer {token}"}
         url = f"{IIKO_BASE_URL}/terminal_groups/is_alive"
         payload = {
-            "organizationIds": [IIKO_ORGANIZATION_ID],
-            "terminalGroupIds": [IIKO_TERMINAL_GROUP_ID]
+            "organizationIds": sorted({b["organization_id"] for b in branches.values()}),
+            "terminalGroupIds": sorted({b["terminal_group_id"] for b in branches.values()})
         }
 
-        response = requests.post(url, json=payload, headers=headers)
-        response.raise_for_status()
+        started, ok = time.monotonic(), False
+        try:
+            response = requests.post(url, json=payload, headers=headers, timeout=HTTP_TIMEOUT)
+            response.raise_for_status()
+            ok = True
+        finally:
+            # The heartbeat doubles as the iiko is_alive latency probe
+            record_probe("iiko_is_alive", (time.monotonic() - started) * 1000, ok)
+
+        now = time.monotonic()
+        alive_by_terminal = {
+            status.get("terminalGroupId"): bool(status.get("isAlive"))
+            for status in response.json().get("isAliveStatus", [])
+        }
+        with _terminal_lock:
+            for terminal_group_id in payload["terminalGroupIds"]:
+                alive = alive_by_terminal.get(terminal_group_id, False)
+                previous = _terminal_status.get(terminal_group_id)
+                if previous is None or previous["alive"] != alive:
+                    log = logging.info if alive else logging.error
+                    log(f"{'✅' if alive else '❌'} Terminal group {terminal_group_id} is {'alive' if alive else 'not alive'}.")
+                    _terminal_status[terminal_group_id] = {"alive": alive, "checked_at": now, "changed_at": now}
+                    if alive and previous is not None:
+                        wake_outbox_drainer()
+                else:
+                    previous["checked_at"] = now
+        return True
+    except Exception as e:
+        logging.error(f"❌ Error checking terminal group status: {str(e)}")
+        return False
 
-        is_alive_status = response.json().get("isAliveStatus", [])
-        if is_alive_status and is_alive_status[0].get("isAlive"):
-            logging.info(f"✅ Terminal group {IIKO_TERMINAL_GROUP_ID} is alive.")
-            add_note_to_amocrm(lead_id, f"Терминал активен", "iiko")
-            return True
-        else:
-            logging.error(f"❌ Terminal group {IIKO_TERMINAL_GROUP_ID} is not alive.")
-            add_note_to_amocrm(lead_id, f"Терминал неактивен")
+def get_terminal_status(branch: Optional[str] = None) -> Optional[dict]:
+    """Cached liveness of the branch terminal group, refreshed synchronously only if stale."""
+    _, branch_config = resolve_branch(branch)
+    terminal_group_id = branch_config["terminal_group_id"]
+    status = _terminal_status.get(terminal_group_id)
+    if status is None or time.monotonic() - status["checked_at"] > TERMINAL_STATUS_MAX_AGE:
+        poll_terminal_liveness()
+        status = _terminal_status.get(terminal_group_id)
+    return status
+
+def terminal_statuses() -> dict:
+    """Liveness of every terminal group with seconds since last check, for status endpoints."""
+    now = time.monotonic()
+    return {
+        terminal_group_id: {
+            "alive": status["alive"],
+            "checked_s_ago": round(now - status["checked_at"]),
+            "changed_s_ago": round(now - status["changed_at"])
+        }
+        for terminal_group_id, status in _terminal_status.items()
+    }
+
+def _terminal_heartbeat():
+    while not _heartbeat_stop.is_set():
+        poll_terminal_liveness()
+        _heartbeat_stop.wait(TERMINAL_HEARTBEAT_INTERVAL)
+
+def start_terminal_heartbeat():
+    """Starts the background thread polling terminal liveness every TERMINAL_HEARTBEAT_INTERVAL seconds."""
+    global _heartbeat_thread
+    if _heartbeat_thread and _heartbeat_thread.is_alive():
+        return
+    _heartbeat_stop.clear()
+    _heartbeat_thread = threading.Thread(target=_terminal_heartbeat, name="iiko-terminal-heartbeat", daemon=True)
+    _heartbeat_thread.start()
+
+def stop_terminal_heartbeat():
+    _heartbeat_stop.set()
+
+def is_terminal_group_alive(lead_id, branch: Optional[str] = None) -> bool:
+    """
+    Check if the terminal group of the order's branch is alive, from the heartbeat cache.
+    "Терминал активен" is noted only when liveness changed since the last note;
+    an order refused because the terminal is down is always noted.
+    """
+    try:
+        _, branch_config = resolve_branch(branch)
+        terminal_group_id = branch_config["terminal_group_id"]
+        status = get_terminal_status(branch)
+        if status is None:
+            add_note_to_amocrm(lead_id, f"Не удалось получить статус терминала", "iiko")
             return False
+
+        with _terminal_lock:
+            changed = _noted_status.get(terminal_group_id) != status["alive"]
+            _noted_status[terminal_group_id] = status["alive"]
+
+        if status["alive"]:
+            if changed:
+                add_note_to_amocrm(lead_id, f"Терминал активен", "iiko")
+            return True
+        add_note_to_amocrm(lead_id, f"Терминал неактивен")
+        return False
     except Exception as e:
         logging.error(f"❌ Error checking terminal group status: {str(e)}")
         add_note_to_amocrm(lead_id, f"Не удалось получить статус терминала", "iiko")
         return False
 
-def load_menu_from_iiko():
-    """Fetch and store the menu from the iiko API."""
-    global _menu_lookup
+def load_branch_menu(branch_name: str) -> bool:
+    """Fetch and store the menu of one branch from the iiko API. Returns True once it is loaded."""
+    branch_config = all_branches()[branch_name]
+    organization_id = branch_config["organization_id"]
     try:
         token = get_iiko_token()
         if not token:
-            return
+            return False
 
         headers = {"Authorization": f"Bearer {token}"}
         url = f"{IIKO_MENU_URL}/menu/by_id"
         body = {
-            "externalMenuId": IIKO_MENU_ID,
-            "organizationIds": [IIKO_ORGANIZATION_ID]
+            "externalMenuId": branch_config["menu_id"],
+            "organizationIds": [organization_id]
         }
 
-        response = requests.post(url, headers=headers, json=body)
-        response.raise_for_status()
-
+        try:
+            response = requests.post(url, headers=headers, json=body, timeout=HTTP_TIMEOUT)
+            response.raise_for_status()
+        except requests.RequestException:
+            get_breaker("iiko").record_failure()
+            raise
+        get_breaker("iiko").record_success()
+
+        menu_lookup: Dict[Tuple[str, Optional[str]], dict] = {}
         menu_data = response.json()
         for category in menu_data.get("itemCategories", []):
             for item in category.get("items", []):
@@ -129,33 +270,64 @@ def load_menu_from_iiko():
                     size_id = size.get("sizeId")
                     price_info = size.get("prices", [])[0] if size.get("prices") else None
                     key = (item_id, size_id if size_id else None)
-                    _menu_lookup[key] = {
+                    menu_lookup[key] = {
                         "name": item.get("name"),
                         "price": price_info["price"] if price_info else 0,
-                        "organizationId": price_info["organizationId"] if price_info else IIKO_ORGANIZATION_ID
+                        "organizationId": price_info["organizationId"] if price_info else organization_id
                     }
-        logging.info(f"✅ Menu loaded from iiko with {len(_menu_lookup)} items")
+        # Swap in the whole snapshot so readers never see a half-loaded menu
+        _menus[branch_name] = menu_lookup
+        logging.info(f"✅ Menu for {branch_name} loaded from iiko with {len(menu_lookup)} items")
+        return bool(menu_lookup)
     except Exception as e:
-        logging.error(f"❌ Error loading menu from iiko: {str(e)}")
+        logging.error(f"❌ Error loading menu for {branch_name} from iiko: {str(e)}")
+        return False
+
+def load_menu_from_iiko() -> bool:
+    """Fetch the menus of all branches in parallel. Returns True once every branch menu is loaded."""
+    branch_names = list(all_branches())
+    with ThreadPoolExecutor(max_workers=len(branch_names)) as executor:
+        results = list(executor.map(load_branch_menu, branch_names))
+    return all(results)
+
+def is_menu_loaded() -> bool:
+    return all(_menus.get(branch_name) for branch_name in all_branches())
 
-def get_menu_item(product_id: str, size_id: Optional[str] = None) -> Optional[dict]:
+def get_menu_item(product_id: str, size_id: Optional[str] = None, branch: Optional[str] = None) -> Optional[dict]:
+    """Looks up a product in the branch menu snapshot (default branch when not given)."""
     try:
         key = (product_id, size_id if size_id else None)
-        return _menu_lookup.get(key)
+        branch_name, _ = resolve_branch(branch)
+        return _menus.get(branch_name, {}).get(key)
     except Exception as e:
         logging.error(f"❌ Error retrieving menu item: {str(e)}")
         return None
 
+def is_iiko_available(branch: Optional[str] = None) -> bool:
+    """Whether iiko can take orders of the branch now: circuit not open and terminal group alive."""
+    if get_breaker("iiko").state == "open":
+        return False
+    status = get_terminal_status(branch)
+    return bool(status and status["alive"])
+
+def iiko_order_key(lead_id) -> str:
+    """Idempotency key of a lead's iiko order, sent as its client-side order ID so a resend never creates it twice."""
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"amocrm-lead:{lead_id}"))
+
 def create_iiko_order_from_amocrm(order: dict, lead_id: str) -> Optional[dict]:
+    """
+    Builds the iiko delivery for the order and sends it. While iiko or the
+    branch terminal is unreachable, or older orders of the branch are still
+    parked, the order is parked in the outbox instead and {"parked": True}
+    is returned. The lead ID is the order's idempotency key, so an order
+    without one is refused.
+    """
+    if not lead_id:
+        logging.error("❌ Cannot create an iiko order without a lead ID")
+        return None
     try:
-        token = get_iiko_token()
-        if not token:
-            return None
+        branch_name, branch_config = resolve_branch(order.get("branch"))
 
-        if not is_terminal_group_alive(lead_id):
-            return None
-
-        headers = {"Authorization": f"Bearer {token}"}
         items = []
         for item in order.get("menu", []):
             try:
@@ -163,7 +335,7 @@ def create_iiko_order_from_amocrm(order: dict, lead_id: str) -> Optional[dict]:
                 size_id = item.get("sizeId")
                 quantity = item.get("quantity", 1)
 
-                menu_item = get_menu_item(product_id, size_id)
+                menu_item = get_menu_item(product_id, size_id, branch_name)
                 if not menu_item:
                     continue
 
@@ -229,9 +401,10 @@ def create_iiko_order_from_amocrm(order: dict, lead_id: str) -> Optional[dict]:
         }
 
         payload = {
-            "organizationId": IIKO_ORGANIZATION_ID,
-            "terminalGroupId": IIKO_TERMINAL_GROUP_ID,
+            "organizationId": branch_config["organization_id"],
+            "terminalGroupId": branch_config["terminal_group_id"],
             "order": {
+                "id": iiko_order_key(lead_id),
                 "orderTypeId": "5b1508f9-fe5b-d6af-cb8d-043af587d5c2",  # Update with actual order type ID
                 "comment": order.get("comment"),
                 "phone": "+" + order.get("phone"),
@@ -241,142 +414,217 @@ def create_iiko_order_from_amocrm(order: dict, lead_id: str) -> Optional[dict]:
             }
         }
 
-        global payload_iiko
-        payload_iiko = payload
-
-        # url = f"{IIKO_BASE_URL}/deliveries/create"
-        # response = requests.post(url, json=payload, headers=headers)
+        save_order(lead_id, iiko_payload=payload)
 
-        # # Check if the response is not successful
-        # if response.status_code != 200:
-        #     logging.error(f"❌ iiko order creation failed with status {response.status_code}: {response.text}")
-        #     add_note_to_amocrm(lead_id, f"Ошибка создания заказа в iiko со статусом {response.status_code}: {response.text}", "iiko")
-        #     return None
-
-        # response.raise_for_status()
-
-        # logging.info("✅ iiko order created successfully")
-        # add_note_to_amocrm(lead_id, f"Заказ в iiko был успешно создан", "iiko")
-        # return response.json()
+        if has_waiting(branch_name):
+            raise IikoUnavailable("older orders of the branch are still parked")
+        return submit_iiko_order(payload, lead_id, branch_name)
+    except IikoUnavailable as e:
+        logging.warning(f"⚠️ iiko cannot take the order of lead {lead_id} now: {str(e)}")
+        park_order(lead_id, payload["order"]["id"], branch_name, order, payload)
+        add_note_to_amocrm(lead_id, "iiko недоступен: заказ сохранен и будет отправлен автоматически после восстановления связи", "iiko")
+        return {"parked": True}
     except Exception as e:
         logging.error(f"❌ Error creating iiko order: {str(e)}")
         add_note_to_amocrm(lead_id, f"Ошибка при создании заказа в iiko", "iiko")
         return None
-    
-def check_order_status(order_id: str) -> bool:
-    """
-    Check the status of the order before closing it.
-    The status is considered valid for closing if 'creationStatus' is 'Success'.
-    
-    Parameters:
-    - order_id (str): The ID of the order to check.
 
-    Returns:
-    - bool: True if the order can be closed, False otherwise.
+def _post_to_iiko(path: str, payload: dict, token: str, timeout: float) -> requests.Response:
+    """
+    POSTs to iiko. Transport errors and 5xx count against the iiko circuit
+    and raise IikoUnavailable; any other response is returned to the caller.
+    """
+    breaker = get_breaker("iiko")
+    try:
+        response = requests.post(f"{IIKO_BASE_URL}/{path}", json=payload, headers={"Authorization": f"Bearer {token}"}, timeout=timeout)
+    except requests.RequestException as e:
+        breaker.record_failure()
+        raise IikoUnavailable(f"{path} failed: {str(e)}")
+    if response.status_code >= 500:
+        breaker.record_failure()
+        raise IikoUnavailable(f"{path} answered {response.status_code}")
+    breaker.record_success()
+    return response
+
+def submit_iiko_order(payload: dict, lead_id, branch: Optional[str] = None) -> Optional[dict]:
+    """
+    Sends a built order to iiko deliveries/create. Raises IikoUnavailable
+    when there is no token (circuit open), the terminal group is down, or
+    iiko fails with a transport error or 5xx; returns None when iiko
+    rejects the order.
     """
     token = get_iiko_token()
     if not token:
-        logging.error("❌ No valid iiko token found to check the order status.")
-        return False
+        raise IikoUnavailable("no iiko token")
 
-    headers = {"Authorization": f"Bearer {token}"}
-    
-    # Prepare the payload for checking the order status
+    if not is_terminal_group_alive(lead_id, branch):
+        raise IikoUnavailable("terminal group is not alive")
+
+    response = _post_to_iiko("deliveries/create", payload, token, HTTP_TIMEOUT)
+
+    # Check if the response is not successful
+    if response.status_code != 200:
+        logging.error(f"❌ iiko order creation failed with status {response.status_code}: {response.text}")
+        add_note_to_amocrm(lead_id, f"Ошибка создания заказа в iiko со статусом {response.status_code}: {response.text}", "iiko")
+        return None
+
+    logging.info("✅ iiko order created successfully")
+    add_note_to_amocrm(lead_id, f"Заказ в iiko был успешно создан", "iiko")
+    return response.json()
+
+def _poll_order_statuses():
+    """
+    One watcher tick: asks deliveries/by_id about every pending order in a
+    single request per organization and wakes the waiters whose orders
+    reached a final creationStatus or ran out of time.
+    """
+    with _watch_lock:
+        by_organization: Dict[str, list] = {}
+        for order_id, waiter in _pending_orders.items():
+            by_organization.setdefault(waiter["organization_id"], []).append(order_id)
+
+    token = get_iiko_token()
+    if not token:
+        logging.error("❌ No valid iiko token found to check order statuses.")
+    else:
+        headers = {"Authorization": f"Bearer {token}"}
+        url = f"{IIKO_BASE_URL}/deliveries/by_id"
+        for organization_id, order_ids in by_organization.items():
+            try:
+                response = requests.post(url, json={"organizationId": organization_id, "orderIds": order_ids}, headers=headers, timeout=HTTP_TIMEOUT)
+                response.raise_for_status()
+                for order_info in response.json().get("orders", []):
+                    status = order_info.get("creationStatus")
+                    if status not in ("Success", "Error"):
+                        continue
+                    with _watch_lock:
+                        waiter = _pending_orders.pop(order_info.get("id"), None)
+                    if waiter:
+                        waiter["ready"] = status == "Success"
+                        waiter["event"].set()
+            except Exception as e:
+                logging.error(f"❌ Error checking status of {len(order_ids)} iiko orders: {str(e)}")
+
+    now = time.monotonic()
+    with _watch_lock:
+        expired = [order_id for order_id, waiter in _pending_orders.items() if now >= waiter["deadline"]]
+        for order_id in expired:
+            _pending_orders.pop(order_id)["event"].set()
+
+def _watch_order_statuses():
+    while True:
+        _watch_wakeup.wait()
+        _watch_wakeup.clear()
+        while _pending_orders:
+            _poll_order_statuses()
+            time.sleep(ORDER_STATUS_TICK)
+
+def wait_for_order_ready(order_id: str, branch: Optional[str] = None, timeout: float = ORDER_STATUS_TIMEOUT) -> bool:
+    """
+    Blocks until the shared watcher sees creationStatus 'Success' for the order.
+    Returns False if iiko reports 'Error' or the order is not ready within timeout seconds.
+    """
+    global _watch_thread
+    waiter = {
+        "organization_id": resolve_branch(branch)[1]["organization_id"],
+        "deadline": time.monotonic() + timeout,
+        "event": threading.Event(),
+        "ready": False
+    }
+    with _watch_lock:
+        _pending_orders[order_id] = waiter
+        if _watch_thread is None or not _watch_thread.is_alive():
+            _watch_thread = threading.Thread(target=_watch_order_statuses, name="iiko-order-watcher", daemon=True)
+            _watch_thread.start()
+    _watch_wakeup.set()
+
+    waiter["event"].wait(timeout + ORDER_STATUS_TICK * 2)
+    with _watch_lock:
+        _pending_orders.pop(order_id, None)
+    return waiter["ready"]
+
+def build_close_payload(order_id: str, branch: Optional[str] = None, cheque_additional_info: Optional[dict] = None) -> dict:
     payload = {
-        "organizationId": IIKO_ORGANIZATION_ID,
-        "orderIds": [order_id]
+        "organizationId": resolve_branch(branch)[1]["organization_id"],
+        "orderId": order_id,
     }
 
-    # Send request to check order status
-    url = f"{IIKO_BASE_URL}/deliveries/by_id"
-    response = requests.post(url, json=payload, headers=headers)
-
-    if response.status_code == 200:
-        order_info = response.json().get("orders", [])
-        if order_info:
-            order_status = order_info[0].get("creationStatus")
-            if order_status == "Success":
-                logging.info(f"✅ Order {order_id} is ready to be closed.")
-                return True
-            else:
-                logging.error(f"❌ Order {order_id} cannot be closed, status is {order_status}.")
-                return False
-        else:
-            logging.error(f"❌ No order information found for order ID {order_id}.")
-            return False
-    else:
-        logging.error(f"❌ Failed to fetch order status for {order_id}: {response.status_code} - {response.text}")
-        return False
+    # Optionally include chequeAdditionalInfo if it's provided
+    if cheque_additional_info:
+        payload["chequeAdditionalInfo"] = cheque_additional_info
+    return payload
+
+def submit_iiko_close(payload: dict, lead_id, timeout: float = HTTP_TIMEOUT) -> Optional[dict]:
+    """
+    Sends one deliveries/close request. Raises IikoUnavailable when there is
+    no token or iiko fails with a transport error or 5xx; returns None when
+    iiko rejects the close.
+    """
+    token = get_iiko_token()
+    if not token:
+        raise IikoUnavailable("no iiko token")
 
+    response = _post_to_iiko("deliveries/close", payload, token, timeout)
+    if response.status_code != 200:
+        logging.error(f"❌ iiko rejected closing order {payload['orderId']} with status {response.status_code}: {response.text}")
+        add_note_to_amocrm(lead_id, f"Ошибка при закрытии заказа в iiko", "iiko")
+        return None
 
-def close_order_in_iiko(order_id: str, lead_id: str, cheque_additional_info: Optional[dict] = None) -> Optional[dict]:
+    logging.info(f"✅ Order {payload['orderId']} successfully closed in iiko.")
+    add_note_to_amocrm(lead_id, f"Заказ в iiko был успешно закрыт", "iiko")
+    return response.json()
+
+def park_iiko_close(order_id: str, lead_id, parsed_order: dict):
+    """Parks the close of an order iiko could not be reached for; the outbox sends it once iiko is back."""
+    branch_name = resolve_branch(parsed_order.get("branch"))[0]
+    payload = build_close_payload(order_id, branch_name)
+    park_order(lead_id, f"close:{order_id}", branch_name, parsed_order, payload, kind="close")
+    add_note_to_amocrm(lead_id, "iiko недоступен: закрытие заказа сохранено и будет отправлено автоматически после восстановления связи", "iiko")
+
+def close_order_in_iiko(
+    order_id: str,
+    lead_id: str,
+    cheque_additional_info: Optional[dict] = None,
+    branch: Optional[str] = None,
+    deadline: Optional[Deadline] = None
+) -> Optional[dict]:
     """
     Close the order in iiko system after ensuring that the order status is 'Success'.
-    Uses adaptive waiting with retry logic to check the status before proceeding to close the order.
+    Readiness comes from the shared order-status watcher, which checks all
+    pending orders together every ORDER_STATUS_TICK seconds. The close
+    itself is tried up to 3 times; if iiko is still unreachable after that,
+    IikoUnavailable is raised so the caller can park the close.
 
     Parameters:
     - order_id (str): The ID of the order to close.
     - cheque_additional_info (dict, optional): Optional info for the cheque, such as receipt information.
+    - branch (str, optional): The branch the order was sent to.
+    - deadline (Deadline, optional): The order's time budget; waiting never outlasts it.
     """
-    MAX_RETRIES = 10
-    WAIT_TIME = 2  # Initial wait time in seconds
-
-    # Retry logic with adaptive waiting
-    for attempt in range(MAX_RETRIES):
-        try:
-            # Check the status of the order
-            if check_order_status(order_id):
-                logging.info(f"✅ Order {order_id} is ready to be closed.")
-                break
-            else:
-                logging.warning(f"Attempt {attempt + 1}/{MAX_RETRIES}: Order {order_id} not ready to be closed.")
-                time.sleep(WAIT_TIME)
-                WAIT_TIME = min(WAIT_TIME * 2, 60)  # Exponential backoff
-        except Exception as e:
-            logging.error(f"❌ Error checking order status on attempt {attempt + 1}/{MAX_RETRIES}: {str(e)}")
-            time.sleep(WAIT_TIME)
-            WAIT_TIME = min(WAIT_TIME * 2, 60)  # Exponential backoff
+    timeout = min(ORDER_STATUS_TIMEOUT, deadline.remaining()) if deadline else ORDER_STATUS_TIMEOUT
+    if wait_for_order_ready(order_id, branch, timeout):
+        logging.info(f"✅ Order {order_id} is ready to be closed.")
     else:
-        logging.error(f"❌ Order {order_id} could not be closed after {MAX_RETRIES} attempts.")
+        logging.error(f"❌ Order {order_id} could not be closed: creation failed or did not finish within {round(timeout)}s.")
         return None
 
+    MAX_ATTEMPTS = 3
+    deadline = deadline or Deadline(ORDER_STATUS_TIMEOUT)
     try:
-        # Proceed to close the order if status is 'Success'
-        token = get_iiko_token()
-        if not token:
-            logging.error("❌ No valid iiko token found to close the order.")
-            return None
-
-        headers = {"Authorization": f"Bearer {token}"}
-
-        # Construct the payload for closing the order
-        payload = {
-            "organizationId": IIKO_ORGANIZATION_ID,
-            "orderId": order_id,
-        }
-
-        # Optionally include chequeAdditionalInfo if it's provided
-        if cheque_additional_info:
-            payload["chequeAdditionalInfo"] = cheque_additional_info
-
-        # Sending request to close the order in iiko
-        url = f"{IIKO_BASE_URL}/deliveries/close"
-        response = requests.post(url, json=payload, headers=headers)
-
-        # Check for HTTP errors
-        response.raise_for_status()
-
-        logging.info(f"✅ Order {order_id} successfully closed in iiko.")
-        add_note_to_amocrm(lead_id, f"Заказ в iiko был успешно закрыт", "iiko")
-        return response.json()
-    except requests.RequestException as e:
-        logging.error(f"❌ Failed to close order {order_id} in iiko: {str(e)}")
-        add_note_to_amocrm(lead_id, f"Ошибка при закрытии заказа в iiko", "iiko")
+        payload = build_close_payload(order_id, branch, cheque_additional_info)
+        for attempt in range(MAX_ATTEMPTS):
+            try:
+                return submit_iiko_close(payload, lead_id, deadline.timeout())
+            except IikoUnavailable as e:
+                logging.error(f"❌ Failed to close order {order_id} in iiko: {str(e)}")
+                if attempt + 1 == MAX_ATTEMPTS or not deadline.backoff(attempt, retry_interval("iiko", 2), 16):
+                    raise
+    except DeadlineExceeded as e:
+        logging.error(f"❌ Order {order_id} was not closed in iiko: {str(e)}")
         return None
+    except IikoUnavailable:
+        raise
     except Exception as e:
         logging.error(f"❌ Unexpected error while closing order {order_id}: {str(e)}")
         add_note_to_amocrm(lead_id, f"Непредвиденная ошибка при закрытии заказа в iiko", "iiko")
         return None
-
-def get_payload():
-    return payload_iiko
\ No newline at end of file
@@ -0,0 +1,124 @@
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import random
+from contextlib import contextmanager
+from typing import Optional
+
+from app.config import LOG_LEVEL, LOG_PAYLOAD_SAMPLE_RATE, LOG_PAYLOAD_MAX_CHARS
+
+# Correlation IDs of the order being processed; copied into every record logged in this context
+lead_id_var: contextvars.ContextVar = contextvars.ContextVar("lead_id", default=None)
+claim_id_var: contextvars.ContextVar = contextvars.ContextVar("claim_id", default=None)
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+class ContextFilter(logging.Filter):
+    """Stamps records with the lead and claim IDs of the calling context."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.lead_id = lead_id_var.get()
+        record.claim_id = claim_id_var.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line; the message is %-formatted here, in the listener thread."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "msg": record.getMessage()
+        }
+        lead_id = getattr(record, "lead_id", None)
+        claim_id = getattr(record, "claim_id", None)
+        if lead_id is not None:
+            entry["lead_id"] = lead_id
+        if claim_id is not None:
+            entry["claim_id"] = claim_id
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    Enqueues the record as is instead of formatting it in the calling thread
+    (the stock QueueHandler does). Only exception tracebacks are rendered
+    up front, since the frames they reference do not survive the hand-off.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def setup_logging():
+    """
+    Routes the root logger through a queue: callers only stamp and enqueue
+    records, and a listener thread formats them as JSON and writes them out.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    output = logging.StreamHandler()
+    output.setFormatter(JsonFormatter())
+
+    handler = LazyQueueHandler(log_queue)
+    handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(LOG_LEVEL)
+
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+
+
+def stop_logging():
+    """Flushes queued records; call on shutdown."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+@contextmanager
+def log_context(lead_id=None, claim_id=None):
+    """Binds correlation IDs for the records logged inside the block."""
+    tokens = []
+    if lead_id is not None:
+        tokens.append((lead_id_var, lead_id_var.set(lead_id)))
+    if claim_id is not None:
+        tokens.append((claim_id_var, claim_id_var.set(claim_id)))
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
+def log_payload(label: str, payload: str):
+    """
+    Logs a raw payload for a LOG_PAYLOAD_SAMPLE_RATE share of calls (every
+    call when the DEBUG level is enabled), cut to LOG_PAYLOAD_MAX_CHARS.
+    """
+    debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+    if not debug and random.random() >= LOG_PAYLOAD_SAMPLE_RATE:
+        return
+    size = len(payload)
+    if size > LOG_PAYLOAD_MAX_CHARS:
+        payload = payload[:LOG_PAYLOAD_MAX_CHARS]
+    logging.info("🔹 %s (%d chars%s): %s", label, size, ", truncated" if size > LOG_PAYLOAD_MAX_CHARS else "", payload)
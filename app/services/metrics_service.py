@@ -0,0 +1,64 @@
+import threading
+from typing import Callable, Dict, Tuple
+
+# (metric name, sorted label pairs) -> value
+_counters: Dict[Tuple[str, tuple], float] = {}
+_gauges: Dict[Tuple[str, tuple], Callable[[], float]] = {}
+_help: Dict[str, str] = {}
+_lock = threading.Lock()
+
+
+def _key(name: str, labels: dict) -> Tuple[str, tuple]:
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name: str, value: float = 1, help: str = "", **labels):
+    """Increments a counter; safe to call from any thread."""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+        if help:
+            _help.setdefault(name, help)
+
+
+def register_gauge(name: str, fn: Callable[[], float], help: str = "", **labels):
+    """Registers a gauge whose value is read from fn on every scrape."""
+    with _lock:
+        _gauges[_key(name, labels)] = fn
+        if help:
+            _help.setdefault(name, help)
+
+
+def counter_value(name: str, **labels) -> float:
+    return _counters.get(_key(name, labels), 0)
+
+
+def _format(name: str, labels: tuple, value: float) -> str:
+    if labels:
+        rendered = ",".join(f'{k}="{str(v)}"' for k, v in labels)
+        return f"{name}{{{rendered}}} {value:g}"
+    return f"{name} {value:g}"
+
+
+def render() -> str:
+    """All counters and gauges in the Prometheus text exposition format."""
+    with _lock:
+        counters = sorted(_counters.items())
+        gauges = sorted(_gauges.items(), key=lambda item: item[0])
+
+    lines = []
+    for metrics, kind in ((counters, "counter"), (gauges, "gauge")):
+        seen = set()
+        for (name, labels), value in metrics:
+            if name not in seen:
+                seen.add(name)
+                if name in _help:
+                    lines.append(f"# HELP {name} {_help[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+            if kind == "gauge":
+                try:
+                    value = float(value())
+                except Exception:
+                    continue
+            lines.append(_format(name, labels, value))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,288 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
+from app.config import SQLITE_PATH, RECENT_ORDERS_SIZE, ORDER_RETENTION_DAYS
+from services.events_service import publish
+
+# Order stages in pipeline order; the latest one reached is the order status
+STAGES = (
+    "received",
+    "lead_resolved",
+    "iiko_queued",
+    "iiko_created",
+    "iiko_close_queued",
+    "iiko_closed",
+    "claim_created",
+    "courier_found",
+    "delivered"
+)
+FINAL_STATUSES = ("delivered", "returned", "failed", "expired")
+
+# Most recent orders by lead ID, oldest first; bounded to RECENT_ORDERS_SIZE
+_recent: "OrderedDict[int, dict]" = OrderedDict()
+_lock = threading.RLock()
+_db: Optional[sqlite3.Connection] = None
+_writes_since_prune = 0
+PRUNE_EVERY_WRITES = 500
+
+
+def _get_db() -> sqlite3.Connection:
+    global _db
+    if _db is None:
+        _db = sqlite3.connect(SQLITE_PATH, check_same_thread=False)
+        _db.row_factory = sqlite3.Row
+        _db.execute("PRAGMA journal_mode=WAL")
+        _db.execute("PRAGMA synchronous=NORMAL")
+        _db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS orders (
+                lead_id INTEGER PRIMARY KEY,
+                parent_lead_id INTEGER,
+                phone TEXT,
+                status TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                iiko_order_id TEXT,
+                claim_id TEXT,
+                parsed_order TEXT,
+                iiko_payload TEXT,
+                stages TEXT
+            )
+            """
+        )
+        _db.execute("CREATE INDEX IF NOT EXISTS idx_orders_phone ON orders (phone, created_at)")
+        _db.execute("CREATE INDEX IF NOT EXISTS idx_orders_status ON orders (status, created_at)")
+        _db.execute("CREATE INDEX IF NOT EXISTS idx_orders_created_at ON orders (created_at)")
+        _db.execute("CREATE INDEX IF NOT EXISTS idx_orders_parent_lead_id ON orders (parent_lead_id)")
+        _db.commit()
+    return _db
+
+
+def _row_to_order(row: sqlite3.Row) -> dict:
+    return {
+        "lead_id": row["lead_id"],
+        "parent_lead_id": row["parent_lead_id"],
+        "phone": row["phone"],
+        "status": row["status"],
+        "created_at": row["created_at"],
+        "updated_at": row["updated_at"],
+        "iiko_order_id": row["iiko_order_id"],
+        "claim_id": row["claim_id"],
+        "parsed_order": json.loads(row["parsed_order"]) if row["parsed_order"] else None,
+        "iiko_payload": json.loads(row["iiko_payload"]) if row["iiko_payload"] else None,
+        "stages": json.loads(row["stages"]) if row["stages"] else {}
+    }
+
+
+def _load(lead_id: int) -> Optional[dict]:
+    order = _recent.get(lead_id)
+    if order is not None:
+        _recent.move_to_end(lead_id)
+        return order
+    row = _get_db().execute("SELECT * FROM orders WHERE lead_id = ?", (lead_id,)).fetchone()
+    return _row_to_order(row) if row else None
+
+
+def _persist(order: dict):
+    global _writes_since_prune
+    db = _get_db()
+    db.execute(
+        """
+        INSERT INTO orders (lead_id, parent_lead_id, phone, status, created_at, updated_at,
+                            iiko_order_id, claim_id, parsed_order, iiko_payload, stages)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(lead_id) DO UPDATE SET
+            parent_lead_id = excluded.parent_lead_id,
+            phone = excluded.phone,
+            status = excluded.status,
+            updated_at = excluded.updated_at,
+            iiko_order_id = excluded.iiko_order_id,
+            claim_id = excluded.claim_id,
+            parsed_order = excluded.parsed_order,
+            iiko_payload = excluded.iiko_payload,
+            stages = excluded.stages
+        """,
+        (
+            order["lead_id"],
+            order.get("parent_lead_id"),
+            order.get("phone"),
+            order.get("status"),
+            order["created_at"],
+            order["updated_at"],
+            order.get("iiko_order_id"),
+            order.get("claim_id"),
+            json.dumps(order["parsed_order"], ensure_ascii=False) if order.get("parsed_order") else None,
+            json.dumps(order["iiko_payload"], ensure_ascii=False) if order.get("iiko_payload") else None,
+            json.dumps(order.get("stages") or {})
+        )
+    )
+
+    _writes_since_prune += 1
+    if _writes_since_prune >= PRUNE_EVERY_WRITES:
+        _writes_since_prune = 0
+        db.execute("DELETE FROM orders WHERE created_at < ?", (time.time() - ORDER_RETENTION_DAYS * 86400,))
+    db.commit()
+
+
+def save_order(lead_id, **fields) -> Optional[dict]:
+    """
+    Creates or updates the stored order for a lead.
+    Accepted fields: parent_lead_id, phone, status, iiko_order_id, claim_id,
+    parsed_order, iiko_payload.
+    """
+    try:
+        if not lead_id:
+            return None
+        lead_id = int(lead_id)
+        now = time.time()
+        with _lock:
+            order = _load(lead_id) or {"lead_id": lead_id, "created_at": now, "stages": {}}
+            order.update(fields)
+            if fields.get("parsed_order") and not order.get("phone"):
+                order["phone"] = fields["parsed_order"].get("phone")
+            order["updated_at"] = now
+
+            _recent[lead_id] = order
+            _recent.move_to_end(lead_id)
+            while len(_recent) > RECENT_ORDERS_SIZE:
+                _recent.popitem(last=False)
+
+            _persist(order)
+        return order
+    except Exception as e:
+        logging.error(f"❌ Error saving order for lead {lead_id}: {str(e)}")
+        return None
+
+
+def mark_stage(lead_id, stage: str, at: Optional[float] = None, **fields) -> Optional[dict]:
+    """
+    Records that an order reached a pipeline stage (see STAGES) or a terminal
+    status such as "failed" or "returned", together with any extra fields.
+    """
+    try:
+        if not lead_id:
+            return None
+        with _lock:
+            existing = _load(int(lead_id))
+            stages = dict(existing.get("stages") or {}) if existing else {}
+            stages[stage] = at or time.time()
+            # Stages can finish out of order when they run concurrently; the status never moves back
+            status = existing.get("status") if existing else None
+            if stage not in STAGES or status not in STAGES or STAGES.index(stage) > STAGES.index(status):
+                status = stage
+            order = save_order(lead_id, status=status, stages=stages, **fields)
+        if order:
+            publish({"stage": stage, "at": stages[stage], **order_summary(order)})
+        return order
+    except Exception as e:
+        logging.error(f"❌ Error marking stage '{stage}' for lead {lead_id}: {str(e)}")
+        return None
+
+
+def order_summary(order: dict) -> dict:
+    """The compact view of an order pushed to the live dashboard."""
+    parsed = order.get("parsed_order") or {}
+    return {
+        "lead_id": order["lead_id"],
+        "status": order.get("status"),
+        "name": parsed.get("name"),
+        "address": parsed.get("address"),
+        "iiko_order_id": order.get("iiko_order_id"),
+        "claim_id": order.get("claim_id"),
+        "stages": order.get("stages") or {}
+    }
+
+
+def get_active_orders() -> List[dict]:
+    """Summaries of in-memory orders that have not reached a final status, oldest first."""
+    with _lock:
+        active = [o for o in _recent.values() if o.get("status") not in FINAL_STATUSES]
+    return [order_summary(o) for o in sorted(active, key=lambda o: o["created_at"])]
+
+
+def get_order(lead_id) -> Optional[dict]:
+    try:
+        with _lock:
+            return _load(int(lead_id))
+    except Exception as e:
+        logging.error(f"❌ Error fetching order for lead {lead_id}: {str(e)}")
+        return None
+
+
+def known_leads(lead_ids: List[int]) -> List[int]:
+    """The leads an order was already taken for, either as the webhook's lead or as its child lead."""
+    if not lead_ids:
+        return []
+    try:
+        placeholders = ", ".join("?" for _ in lead_ids)
+        with _lock:
+            rows = _get_db().execute(
+                f"SELECT lead_id, parent_lead_id FROM orders WHERE lead_id IN ({placeholders}) OR parent_lead_id IN ({placeholders})",
+                (*lead_ids, *lead_ids)
+            ).fetchall()
+        seen = {row["lead_id"] for row in rows} | {row["parent_lead_id"] for row in rows}
+        return [lead_id for lead_id in lead_ids if lead_id in seen]
+    except Exception as e:
+        logging.error(f"❌ Error looking up known leads {lead_ids}: {str(e)}")
+        return []
+
+
+def get_latest_order() -> Optional[dict]:
+    """Returns the most recently updated order that has been parsed (replaces the old last_order global)."""
+    try:
+        with _lock:
+            parsed = [o for o in _recent.values() if o.get("parsed_order")]
+            if parsed:
+                return max(parsed, key=lambda o: o["updated_at"])
+            row = _get_db().execute(
+                "SELECT * FROM orders WHERE parsed_order IS NOT NULL ORDER BY updated_at DESC LIMIT 1"
+            ).fetchone()
+            return _row_to_order(row) if row else None
+    except Exception as e:
+        logging.error(f"❌ Error fetching latest order: {str(e)}")
+        return None
+
+
+def query_orders(
+    phone: Optional[str] = None,
+    status: Optional[str] = None,
+    since: Optional[float] = None,
+    until: Optional[float] = None,
+    limit: int = 50,
+    offset: int = 0
+) -> List[dict]:
+    """
+    Returns stored orders, newest first, filtered by phone, status and a
+    created_at time range (unix seconds). Every filter is served by an index.
+    """
+    clauses, params = [], []
+    if phone:
+        clauses.append("phone = ?")
+        params.append(phone.lstrip("+"))
+    if status:
+        clauses.append("status = ?")
+        params.append(status)
+    if since is not None:
+        clauses.append("created_at >= ?")
+        params.append(since)
+    if until is not None:
+        clauses.append("created_at < ?")
+        params.append(until)
+
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    params.extend([max(1, min(limit, 200)), max(0, offset)])
+    try:
+        with _lock:
+            rows = _get_db().execute(
+                f"SELECT * FROM orders {where} ORDER BY created_at DESC LIMIT ? OFFSET ?",
+                params
+            ).fetchall()
+        return [_row_to_order(row) for row in rows]
+    except Exception as e:
+        logging.error(f"❌ Error querying orders: {str(e)}")
+        return []
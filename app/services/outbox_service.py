@@ -0,0 +1,266 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+from app.config import (
+    SQLITE_PATH,
+    ORDER_RETENTION_DAYS,
+    OUTBOX_DRAIN_INTERVAL,
+    OUTBOX_MAX_ATTEMPTS
+)
+from services.amocrm_service import add_note_to_amocrm
+from services.executor_service import get_executor
+from services.order_service import mark_stage
+from services.metrics_service import inc, register_gauge
+
+# Orders (kind "create") and order closes (kind "close") parked while iiko is unreachable, in arrival order.
+# Status: pending -> sending -> sent / failed
+_lock = threading.Lock()
+_db: Optional[sqlite3.Connection] = None
+_drain_stop = threading.Event()
+_drain_wakeup = threading.Event()
+_drain_thread: Optional[threading.Thread] = None
+
+
+def _get_db() -> sqlite3.Connection:
+    global _db
+    if _db is None:
+        _db = sqlite3.connect(SQLITE_PATH, check_same_thread=False)
+        _db.row_factory = sqlite3.Row
+        _db.execute("PRAGMA journal_mode=WAL")
+        _db.execute("PRAGMA synchronous=NORMAL")
+        _db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS iiko_outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                idempotency_key TEXT NOT NULL UNIQUE,
+                kind TEXT NOT NULL DEFAULT 'create',
+                lead_id INTEGER NOT NULL,
+                branch TEXT,
+                parsed_order TEXT NOT NULL,
+                iiko_payload TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                last_error TEXT
+            )
+            """
+        )
+        _db.execute("CREATE INDEX IF NOT EXISTS idx_iiko_outbox_status ON iiko_outbox (status, id)")
+        _db.commit()
+    return _db
+
+
+def _row_to_entry(row: sqlite3.Row) -> dict:
+    return {
+        "id": row["id"],
+        "idempotency_key": row["idempotency_key"],
+        "kind": row["kind"],
+        "lead_id": row["lead_id"],
+        "branch": row["branch"],
+        "parsed_order": json.loads(row["parsed_order"]),
+        "iiko_payload": json.loads(row["iiko_payload"]),
+        "status": row["status"],
+        "attempts": row["attempts"],
+        "created_at": row["created_at"],
+        "last_error": row["last_error"]
+    }
+
+
+def park_order(lead_id, idempotency_key: str, branch: Optional[str], parsed_order: dict, iiko_payload: dict, kind: str = "create") -> bool:
+    """
+    Stores an order (or, with kind="close", an order close) iiko could not
+    take right now. Returns False if it (same idempotency key) was already
+    parked. An order without a lead is refused: its key would not tell it
+    apart from other orders.
+    """
+    if not lead_id:
+        raise ValueError("Cannot park an order without a lead ID")
+    now = time.time()
+    with _lock:
+        db = _get_db()
+        cursor = db.execute(
+            """
+            INSERT OR IGNORE INTO iiko_outbox (idempotency_key, kind, lead_id, branch, parsed_order, iiko_payload, status, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, 'pending', ?, ?)
+            """,
+            (
+                idempotency_key,
+                kind,
+                int(lead_id),
+                branch,
+                json.dumps(parsed_order, ensure_ascii=False),
+                json.dumps(iiko_payload, ensure_ascii=False),
+                now,
+                now
+            )
+        )
+        db.commit()
+    if cursor.rowcount:
+        inc("iiko_outbox_parked_total", help="Orders parked while iiko was unreachable", kind=kind)
+        logging.warning(f"📦 {'Close of the order' if kind == 'close' else 'Order'} of lead {lead_id} parked in the iiko outbox")
+    return bool(cursor.rowcount)
+
+
+def has_waiting(branch: Optional[str] = None) -> bool:
+    """True while parked orders (of the branch, if given) wait to be sent; new orders queue behind them."""
+    with _lock:
+        query = "SELECT 1 FROM iiko_outbox WHERE status IN ('pending', 'sending')"
+        params = ()
+        if branch is not None:
+            query += " AND branch IS ?"
+            params = (branch,)
+        return _get_db().execute(query + " LIMIT 1", params).fetchone() is not None
+
+
+def _pending_entries() -> List[dict]:
+    with _lock:
+        rows = _get_db().execute("SELECT * FROM iiko_outbox WHERE status = 'pending' ORDER BY id").fetchall()
+    return [_row_to_entry(row) for row in rows]
+
+
+def _set_status(entry_id: int, status: str, error: Optional[str] = None, attempted: bool = False):
+    with _lock:
+        db = _get_db()
+        db.execute(
+            """
+            UPDATE iiko_outbox SET status = ?, last_error = COALESCE(?, last_error), attempts = attempts + ?, updated_at = ?
+            WHERE id = ?
+            """,
+            (status, error, int(attempted), time.time(), entry_id)
+        )
+        db.commit()
+
+
+def outbox_snapshot() -> dict:
+    """Parked orders per status, and the age of the oldest waiting one."""
+    with _lock:
+        db = _get_db()
+        counts = dict(db.execute("SELECT status, COUNT(*) FROM iiko_outbox GROUP BY status").fetchall())
+        oldest = db.execute("SELECT MIN(created_at) FROM iiko_outbox WHERE status IN ('pending', 'sending')").fetchone()[0]
+    return {
+        "pending": counts.get("pending", 0),
+        "sending": counts.get("sending", 0),
+        "sent": counts.get("sent", 0),
+        "failed": counts.get("failed", 0),
+        "oldest_waiting_s": round(time.time() - oldest) if oldest else None
+    }
+
+
+def _drain_branch(entries: List[dict], deliver: Callable[[dict], str]) -> Tuple[int, bool]:
+    """
+    Sends the parked entries of one branch one after another, so iiko gets
+    them in arrival order. Stops at the first "retry"; returns the number
+    sent and whether iiko became unreachable again.
+    """
+    sent = 0
+    for entry in entries:
+        if _drain_stop.is_set():
+            break
+        _set_status(entry["id"], "sending")
+        try:
+            result = deliver(entry)
+        except Exception as e:
+            logging.exception(f"❌ Error sending parked order of lead {entry['lead_id']}")
+            result, error = "retry", str(e)
+        else:
+            error = None if result == "sent" else f"delivery {result}"
+        if result == "retry" and entry["attempts"] + 1 >= OUTBOX_MAX_ATTEMPTS:
+            result = "failed"
+            logging.error(f"❌ Parked order of lead {entry['lead_id']} given up after {OUTBOX_MAX_ATTEMPTS} attempts")
+            add_note_to_amocrm(entry["lead_id"], f"Заказ не удалось отправить в iiko после {OUTBOX_MAX_ATTEMPTS} попыток", "iiko")
+            mark_stage(entry["lead_id"], "failed")
+        inc("iiko_outbox_drained_total", help="Parked orders leaving the iiko outbox by outcome", outcome=result)
+        if result == "retry":
+            _set_status(entry["id"], "pending", error=error, attempted=True)
+            return sent, True
+        _set_status(entry["id"], result, error=error, attempted=True)
+        sent += result == "sent"
+    return sent, False
+
+
+def drain_outbox(deliver: Callable[[dict], str], is_available: Callable[[Optional[str]], bool]) -> int:
+    """
+    Sends parked entries, one job per branch on the "outbox" executor
+    (OUTBOX_DRAIN_CONCURRENCY threads). Within a branch they go strictly in
+    arrival order, one at a time, so a kitchen never gets a newer order
+    before an older one. deliver(entry)
+    returns "sent", "failed" (given up) or "retry" (iiko is unreachable
+    again, which stops that branch's drain). Branches whose iiko is still
+    unavailable are skipped. Returns the number of entries sent.
+    """
+    by_branch = {}
+    for entry in _pending_entries():
+        by_branch.setdefault(entry["branch"], []).append(entry)
+
+    jobs = {}
+    for branch, entries in by_branch.items():
+        if is_available(branch):
+            jobs[branch] = get_executor("outbox").submit(_drain_branch, entries, deliver)
+
+    sent = 0
+    for branch, job in jobs.items():
+        branch_sent, outage = job.result()
+        sent += branch_sent
+        if outage:
+            logging.warning(f"⚠️ iiko became unreachable again while draining the outbox of branch {branch}")
+
+    if sent:
+        logging.info(f"✅ Sent {sent} parked orders to iiko")
+    return sent
+
+
+def _drain_loop(deliver: Callable[[dict], str], is_available: Callable[[Optional[str]], bool]):
+    while not _drain_stop.is_set():
+        try:
+            if has_waiting():
+                drain_outbox(deliver, is_available)
+        except Exception as e:
+            logging.error(f"❌ Error draining the iiko outbox: {str(e)}")
+        _drain_wakeup.wait(OUTBOX_DRAIN_INTERVAL)
+        _drain_wakeup.clear()
+
+
+def start_outbox_drainer(deliver: Callable[[dict], str], is_available: Callable[[Optional[str]], bool]):
+    """
+    Starts the thread that drains the outbox whenever iiko is available,
+    checking every OUTBOX_DRAIN_INTERVAL seconds. Orders left "sending" by a
+    crash go back to pending: the idempotency key keeps iiko from creating
+    them twice.
+    """
+    global _drain_thread
+    if _drain_thread and _drain_thread.is_alive():
+        return
+    with _lock:
+        db = _get_db()
+        db.execute("UPDATE iiko_outbox SET status = 'pending' WHERE status = 'sending'")
+        db.execute(
+            "DELETE FROM iiko_outbox WHERE status IN ('sent', 'failed') AND created_at < ?",
+            (time.time() - ORDER_RETENTION_DAYS * 86400,)
+        )
+        db.commit()
+    _drain_stop.clear()
+    _drain_thread = threading.Thread(target=_drain_loop, args=(deliver, is_available), name="iiko-outbox-drainer", daemon=True)
+    _drain_thread.start()
+
+
+def wake_outbox_drainer():
+    """Drains at once instead of at the next interval, e.g. when a terminal comes back."""
+    _drain_wakeup.set()
+
+
+def stop_outbox_drainer():
+    _drain_stop.set()
+    _drain_wakeup.set()
+
+
+def _waiting_count() -> int:
+    snapshot = outbox_snapshot()
+    return snapshot["pending"] + snapshot["sending"]
+
+
+register_gauge("iiko_outbox_waiting", _waiting_count, help="Parked orders waiting for iiko")
@@ -0,0 +1,111 @@
+import contextvars
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from typing import Callable, Dict, List, Optional
+
+from app.config import PIPELINE_STAGE_TIMEOUT
+from services.executor_service import get_executor
+from services.deadline_service import Deadline
+from services.profiling_service import should_profile, run_profiled
+
+FAILED_OUTCOMES = ("failed", "timeout", "expired", "skipped")
+
+
+class Stage:
+    """
+    One step of the order pipeline. fn receives the shared context dict and
+    returns False (or raises) on failure. A stage starts once every stage in
+    requires has finished; when a critical stage fails, its dependents are
+    skipped, while a failed non-critical stage still lets them run.
+    """
+
+    def __init__(self, name: str, fn: Callable[[dict], object], requires: tuple = (), timeout: float = PIPELINE_STAGE_TIMEOUT, critical: bool = True):
+        self.name = name
+        self.fn = fn
+        self.requires = requires
+        self.timeout = timeout
+        self.critical = critical
+
+
+def run_stages(stages: List[Stage], context: dict, deadline: Optional[Deadline] = None) -> Dict[str, str]:
+    """
+    Runs the stage graph with every stage started as soon as its
+    dependencies allow. Returns stage name -> "ok" / "failed" / "timeout" /
+    "expired" / "skipped". A stage's timeout counts from when a worker
+    thread picks it up, not from when it was queued. A timed-out stage that
+    has not started yet is cancelled; one already running keeps running in
+    its worker thread but counts as failed, and its later writes to context
+    are ignored by dependents. With a deadline, no stage waits past it,
+    stages failing after it passed count as "expired" and nothing new is
+    started.
+    """
+    by_name = {stage.name: stage for stage in stages}
+    outcomes: Dict[str, str] = {}
+    pending = dict(by_name)
+    running: Dict[Future, tuple] = {}
+
+    def expires_at(stage: Stage, start: dict) -> float:
+        # A stage still queued cannot time out before stage.timeout from now, only the deadline can end it
+        own = start["at"] + stage.timeout if "at" in start else time.monotonic() + stage.timeout
+        return min(own, deadline.expires_at) if deadline else own
+
+    def satisfied(name: str) -> bool:
+        return outcomes.get(name) == "ok" or (name in outcomes and not by_name[name].critical)
+
+    # Profiling is decided per run so a sampled order is profiled in every stage
+    profiled = should_profile()
+
+    while pending or running:
+        for name, stage in list(pending.items()):
+            if deadline and deadline.expired():
+                outcomes[name] = "expired"
+                del pending[name]
+            elif any(outcomes.get(r) in FAILED_OUTCOMES and by_name[r].critical for r in stage.requires):
+                outcomes[name] = "skipped"
+                del pending[name]
+            elif all(satisfied(r) for r in stage.requires):
+                # Stages inherit the caller's log correlation IDs. All orders share the "order_stages"
+                # executor; stages never submit work themselves, so it cannot deadlock
+                start = {}
+                call = (run_profiled, stage.name, stage.fn) if profiled else (stage.fn,)
+                running[get_executor("order_stages").submit(contextvars.copy_context().run, _run_stage, start, *call, context)] = (stage, start)
+                del pending[name]
+
+        if not running:
+            # Left-over stages depend on something that never ran
+            for name in pending:
+                outcomes[name] = "skipped"
+            break
+
+        next_deadline = min(expires_at(stage, start) for stage, start in running.values())
+        done, _ = wait(running, timeout=max(0.0, next_deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+
+        for future in done:
+            stage, start = running.pop(future)
+            try:
+                outcomes[stage.name] = "failed" if future.result() is False else "ok"
+            except Exception as e:
+                logging.error("❌ Stage '%s' raised: %s", stage.name, e)
+                outcomes[stage.name] = "failed"
+            if outcomes[stage.name] == "failed" and deadline and deadline.expired():
+                outcomes[stage.name] = "expired"
+            logging.info("🔹 Stage '%s' %s in %d ms", stage.name, outcomes[stage.name], (time.monotonic() - start["at"]) * 1000)
+
+        now = time.monotonic()
+        for future, (stage, start) in list(running.items()):
+            if now >= expires_at(stage, start):
+                del running[future]
+                cancelled = future.cancel()
+                outcomes[stage.name] = "expired" if deadline and deadline.expired() else "timeout"
+                logging.error(
+                    "❌ Stage '%s' did not finish within %.1fs (%s%s)",
+                    stage.name, stage.timeout, outcomes[stage.name], ", cancelled before it started" if cancelled else ""
+                )
+
+    return outcomes
+
+
+def _run_stage(start: dict, fn: Callable, *args):
+    start["at"] = time.monotonic()
+    return fn(*args)
@@ -0,0 +1,182 @@
+import asyncio
+import logging
+import statistics
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, Tuple
+
+import requests
+
+from app.config import (
+    AMOCRM_DOMAIN,
+    AMOCRM_TOKEN,
+    IIKO_API_KEY,
+    IIKO_BASE_URL,
+    HTTP_TIMEOUT,
+    PROBE_INTERVAL,
+    PROBE_WINDOW,
+    PROBE_ADDRESS,
+    PROBE_SLOW_MS,
+    PROBE_DEGRADED_ERROR_RATE
+)
+from services.metrics_service import register_gauge
+from services.health_service import get_breaker
+from services.quote_service import build_check_price_body, check_yandex_price
+
+PROBES = ("amocrm_account", "iiko_token", "iiko_is_alive", "yandex_check_price")
+# Which provider each probe speaks for when the pipeline asks about retry intervals
+PROVIDER_PROBES = {
+    "amocrm": ("amocrm_account",),
+    "iiko": ("iiko_token", "iiko_is_alive"),
+    "yandex": ("yandex_check_price",)
+}
+
+# Probe name -> last PROBE_WINDOW results as (latency_ms, ok)
+_results: Dict[str, Deque[Tuple[float, bool]]] = {name: deque(maxlen=PROBE_WINDOW) for name in PROBES}
+_degraded: Dict[str, bool] = {}
+_lock = threading.Lock()
+
+
+def record_probe(name: str, latency_ms: float, ok: bool):
+    """Adds one probe result; also fed by real calls that double as probes (the terminal heartbeat)."""
+    with _lock:
+        _results[name].append((latency_ms, ok))
+    stats = probe_stats(name)
+    degraded = _is_degraded(stats)
+    if degraded != _degraded.get(name, False):
+        _degraded[name] = degraded
+        if degraded:
+            logging.warning(
+                f"⚠️ Provider probe '{name}' degraded: p90 {stats['p90_ms']} ms, error rate {stats['error_rate']}"
+            )
+        else:
+            logging.info(f"✅ Provider probe '{name}' recovered")
+
+
+def _percentile(sorted_values: list, fraction: float) -> float:
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def probe_stats(name: str) -> dict:
+    """Rolling latency percentiles (successful probes) and error rate over the last PROBE_WINDOW probes."""
+    with _lock:
+        results = list(_results[name])
+    latencies = sorted(latency for latency, ok in results if ok)
+    stats = {
+        "samples": len(results),
+        "error_rate": round(sum(1 for _, ok in results if not ok) / len(results), 3) if results else None,
+        "p50_ms": None,
+        "p90_ms": None,
+        "p99_ms": None,
+        "last_ms": round(results[-1][0]) if results else None
+    }
+    if latencies:
+        stats["p50_ms"] = round(statistics.median(latencies))
+        stats["p90_ms"] = round(_percentile(latencies, 0.9))
+        stats["p99_ms"] = round(_percentile(latencies, 0.99))
+    return stats
+
+
+def _is_degraded(stats: dict) -> bool:
+    if not stats["samples"]:
+        return False
+    return (stats["error_rate"] or 0) >= PROBE_DEGRADED_ERROR_RATE or (stats["p90_ms"] or 0) >= PROBE_SLOW_MS
+
+
+def provider_status() -> dict:
+    """Per-probe statistics with a degraded flag, for the status endpoint."""
+    return {name: {**probe_stats(name), "degraded": _degraded.get(name, False)} for name in PROBES}
+
+
+def is_degraded(provider: str) -> bool:
+    return any(_degraded.get(name, False) for name in PROVIDER_PROBES[provider])
+
+
+def retry_interval(provider: str, base: float) -> float:
+    """
+    Wait before retrying a call to the provider: base, stretched to twice
+    the provider's probed p90 latency and doubled while it is degraded,
+    at most 8 × base.
+    """
+    p90s = [probe_stats(name)["p90_ms"] for name in PROVIDER_PROBES[provider]]
+    p90_s = max((p90 for p90 in p90s if p90 is not None), default=0) / 1000
+    interval = max(base, 2 * p90_s)
+    if is_degraded(provider):
+        interval *= 2
+    return min(interval, base * 8)
+
+
+def _timed(name: str, fn) -> bool:
+    started = time.monotonic()
+    try:
+        ok = bool(fn())
+    except Exception as e:
+        logging.warning(f"⚠️ Provider probe '{name}' failed: {str(e)}")
+        ok = False
+    record_probe(name, (time.monotonic() - started) * 1000, ok)
+    return ok
+
+
+def _probe_amocrm() -> bool:
+    # Also drives the amoCRM breaker, which otherwise only lead fetches would close again
+    try:
+        response = requests.get(
+            f"https://{AMOCRM_DOMAIN}/api/v4/account",
+            headers={"Authorization": f"Bearer {AMOCRM_TOKEN}"},
+            timeout=HTTP_TIMEOUT
+        )
+        response.raise_for_status()
+    except requests.RequestException:
+        get_breaker("amocrm").record_failure()
+        raise
+    get_breaker("amocrm").record_success()
+    return True
+
+
+def _probe_iiko_token() -> bool:
+    # A fresh token request on purpose: the cached token hides iiko auth latency
+    response = requests.post(f"{IIKO_BASE_URL}/access_token", json={"apiLogin": IIKO_API_KEY}, timeout=HTTP_TIMEOUT)
+    response.raise_for_status()
+    return bool(response.json().get("token"))
+
+
+async def _probe_yandex():
+    result = await check_yandex_price(build_check_price_body(PROBE_ADDRESS, 30))
+    if result["status"] == "busy":
+        return  # our own concurrency cap, not a Yandex signal
+    record_probe("yandex_check_price", result.get("latency_ms") or 0, result["status"] == "ok")
+
+
+async def _probe_loop():
+    while True:
+        await asyncio.gather(
+            asyncio.to_thread(_timed, "amocrm_account", _probe_amocrm),
+            asyncio.to_thread(_timed, "iiko_token", _probe_iiko_token),
+            _probe_yandex(),
+            return_exceptions=True
+        )
+        await asyncio.sleep(PROBE_INTERVAL)
+
+
+def start_probes() -> asyncio.Task:
+    """Runs the read-only provider probes every PROBE_INTERVAL seconds; iiko is_alive comes from the terminal heartbeat."""
+    return asyncio.ensure_future(_probe_loop())
+
+
+for _name in PROBES:
+    for _quantile in ("p50_ms", "p90_ms", "p99_ms"):
+        register_gauge(
+            "provider_probe_latency_ms",
+            lambda name=_name, quantile=_quantile: probe_stats(name)[quantile],
+            help="Rolling latency percentiles of synthetic provider probes",
+            probe=_name,
+            quantile=_quantile[:-3]
+        )
+    register_gauge(
+        "provider_probe_error_rate",
+        lambda name=_name: probe_stats(name)["error_rate"],
+        help="Share of failed synthetic provider probes in the rolling window",
+        probe=_name
+    )
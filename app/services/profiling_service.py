@@ -0,0 +1,185 @@
+import logging
+import marshal
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Callable, Dict, Optional, Tuple
+
+from app.config import PROFILER_SAMPLE_RATE, PROFILER_INTERVAL, PROFILER_MAX_STACKS
+
+# Profiles come from sampling the stacks of profiled threads only. cProfile is not used: on
+# Python 3.12 it runs on sys.monitoring, is interpreter-wide and allows one profiler at a time,
+# so concurrent stages would block each other and every profile would include all threads.
+
+# Off by default; toggled at runtime through /admin/profiling
+_settings = {"enabled": False, "sample_rate": PROFILER_SAMPLE_RATE}
+
+# Thread ident -> (stage currently running there under the profiler, CPU clock of the thread)
+_active: Dict[int, Tuple[str, int]] = {}
+# Thread ident -> thread CPU time at the previous sample
+_last_cpu: Dict[int, float] = {}
+# (stage, "frame;frame;...") -> wall-clock samples
+_stacks: Counter = Counter()
+# (stage, ((file, line, function), ...) root first) -> [samples, CPU seconds] with that stack on CPU
+_cpu_stacks: Dict[tuple, list] = {}
+# Stage -> {"runs", "wall_s", "cpu_s"}
+_totals: Dict[str, dict] = {}
+_lock = threading.Lock()
+_sampler: Optional[threading.Thread] = None
+
+
+def configure(enabled: Optional[bool] = None, sample_rate: Optional[float] = None) -> dict:
+    """Turns profiling on or off and sets the share of pipeline runs profiled."""
+    global _sampler
+    if sample_rate is not None:
+        _settings["sample_rate"] = min(1.0, max(0.0, float(sample_rate)))
+    if enabled is not None:
+        _settings["enabled"] = bool(enabled)
+        logging.info(f"🔹 Profiling {'enabled' if enabled else 'disabled'} at sample rate {_settings['sample_rate']}")
+    if _settings["enabled"] and (_sampler is None or not _sampler.is_alive()):
+        _sampler = threading.Thread(target=_sample_stacks, name="profiler-sampler", daemon=True)
+        _sampler.start()
+    return status()
+
+
+def should_profile() -> bool:
+    """Decides once per pipeline run whether its stages are profiled."""
+    return _settings["enabled"] and random.random() < _settings["sample_rate"]
+
+
+def reset():
+    with _lock:
+        _stacks.clear()
+        _cpu_stacks.clear()
+        _totals.clear()
+
+
+def _frames(frame) -> Tuple[tuple, ...]:
+    """The stack below run_profiled as (file, line, function) entries, root first."""
+    entries = []
+    while frame is not None and frame.f_code is not run_profiled.__code__:
+        code = frame.f_code
+        entries.append((code.co_filename, code.co_firstlineno, code.co_name))
+        frame = frame.f_back
+    return tuple(reversed(entries))
+
+
+def _collapse(frames: Tuple[tuple, ...]) -> str:
+    return ";".join(f"{filename.rsplit('/', 1)[-1]}:{name}" for filename, _, name in frames)
+
+
+def _sample_stacks():
+    """
+    Stack sampler: records where every profiled thread is (wall clock,
+    waiting included) and, when the thread used CPU since the previous
+    sample, charges that CPU time to the stack (CPU profile).
+    """
+    while _settings["enabled"]:
+        if _active:
+            frames = sys._current_frames()
+            with _lock:
+                for ident, (stage, cpu_clock) in list(_active.items()):
+                    frame = frames.get(ident)
+                    if frame is None:
+                        continue
+                    stack = _frames(frame)
+                    key = (stage, _collapse(stack))
+                    if key in _stacks or len(_stacks) < PROFILER_MAX_STACKS:
+                        _stacks[key] += 1
+                    try:
+                        cpu = time.clock_gettime(cpu_clock)
+                    except OSError:
+                        # The thread ended between the frame snapshot and now
+                        continue
+                    used = cpu - _last_cpu.get(ident, cpu)
+                    _last_cpu[ident] = cpu
+                    if used > 0 and ((stage, stack) in _cpu_stacks or len(_cpu_stacks) < PROFILER_MAX_STACKS):
+                        sample = _cpu_stacks.setdefault((stage, stack), [0, 0.0])
+                        sample[0] += 1
+                        sample[1] += used
+        time.sleep(PROFILER_INTERVAL)
+
+
+def run_profiled(stage: str, fn: Callable, *args, **kwargs):
+    """
+    Runs fn while the sampler records its thread's stack, and adds the
+    samples and the run's wall and CPU time to the profile of the stage.
+    Only this thread is sampled, so stages profiled at the same time (and
+    long runs such as delivery tracking) never get in each other's way.
+    """
+    ident = threading.get_ident()
+    started_wall, started_cpu = time.perf_counter(), time.thread_time()
+    with _lock:
+        _last_cpu[ident] = started_cpu
+        _active[ident] = (stage, time.pthread_getcpuclockid(ident))
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        with _lock:
+            _active.pop(ident, None)
+            _last_cpu.pop(ident, None)
+            totals = _totals.setdefault(stage, {"runs": 0, "wall_s": 0.0, "cpu_s": 0.0})
+            totals["runs"] += 1
+            totals["wall_s"] += time.perf_counter() - started_wall
+            totals["cpu_s"] += time.thread_time() - started_cpu
+
+
+def status() -> dict:
+    with _lock:
+        stages = {
+            stage: {
+                "runs": totals["runs"],
+                "wall_s": round(totals["wall_s"], 3),
+                "cpu_s": round(totals["cpu_s"], 3),
+                "wall_samples": sum(count for (s, _), count in _stacks.items() if s == stage)
+            }
+            for stage, totals in _totals.items()
+        }
+    return {**_settings, "stages": stages}
+
+
+def collapsed_stacks(stage: Optional[str] = None) -> str:
+    """Wall-clock samples as collapsed stacks ("stage;frame;frame count"), the flamegraph.pl input format."""
+    with _lock:
+        lines = [
+            f"{s};{stack} {count}" if stack else f"{s} {count}"
+            for (s, stack), count in sorted(_stacks.items())
+            if stage is None or s == stage
+        ]
+    return "\n".join(lines) + "\n"
+
+
+def pstats_dump(stage: Optional[str] = None) -> Optional[bytes]:
+    """
+    CPU profile built from the CPU samples, in the marshal format written by
+    pstats.Stats.dump_stats, or None if nothing was recorded. Times are
+    sampled CPU seconds; call counts are sample counts.
+    """
+    with _lock:
+        selected = [(stack, *sample) for (s, stack), sample in _cpu_stacks.items() if (stage is None or s == stage) and stack]
+    if not selected:
+        return None
+
+    # function -> [calls, primitive calls, own time, cumulative time, {caller: [calls, primitive calls, own time, cumulative time]}]
+    stats: Dict[tuple, list] = {}
+    for stack, samples, seconds in selected:
+        for function in set(stack):
+            entry = stats.setdefault(function, [0, 0, 0.0, 0.0, {}])
+            entry[0] += samples
+            entry[1] += samples
+            entry[3] += seconds
+        stats[stack[-1]][2] += seconds
+        for caller, callee in set(zip(stack, stack[1:])):
+            edge = stats[callee][4].setdefault(caller, [0, 0, 0.0, 0.0])
+            edge[0] += samples
+            edge[1] += samples
+            edge[3] += seconds
+            if callee == stack[-1]:
+                edge[2] += seconds
+    dump = {
+        function: (calls, primitive, own, cumulative, {caller: tuple(edge) for caller, edge in callers.items()})
+        for function, (calls, primitive, own, cumulative, callers) in stats.items()
+    }
+    return marshal.dumps(dump)
@@ -0,0 +1,382 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+import httpx
+
+from app.config import (
+    YANDEX_API_KEY,
+    YANDEX_BASE_URL,
+    YANDEX_QUOTE_TIMEOUT,
+    YANDEX_QUOTE_CONNECT_TIMEOUT,
+    YANDEX_QUOTE_MAX_CONCURRENCY,
+    YANDEX_QUOTE_QUEUE_TIMEOUT,
+    YANDEX_QUOTE_DEADLINE,
+    YANDEX_QUOTE_MAX_TARIFFS,
+    YANDEX_QUOTE_CACHE_TTL,
+    YANDEX_QUOTE_CACHE_SIZE,
+    YANDEX_BATCH_CONCURRENCY,
+    DEFAULT_BRANCH
+)
+from services.geocoding_service import geocode_address, split_address
+from services.estimator_service import record_quote, estimate_price
+from services.health_service import get_breaker
+from services.branch_service import resolve_branch
+
+# Shared non-blocking client and concurrency cap for /check-price calls.
+# Both are created lazily so they bind to the running event loop.
+_client: Optional[httpx.AsyncClient] = None
+_semaphore: Optional[asyncio.Semaphore] = None
+
+# Recent successful quotes: key -> (stored_at, result), oldest first
+_quote_cache: Dict[tuple, Tuple[float, dict]] = {}
+QUOTE_CACHE_DUE_BUCKET = 5  # minutes; due times within one bucket share a quote
+
+DEFAULT_REQUIREMENTS = {
+    "taxi_class": "courier",
+    "cargo_options": ["thermobag"],
+    "pro_courier": True,
+    "door_to_door": True
+}
+
+
+def get_quote_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            base_url=YANDEX_BASE_URL,
+            headers={
+                "Authorization": f"Bearer {YANDEX_API_KEY}",
+                "Accept-Language": "ru",
+                "Content-Type": "application/json"
+            },
+            timeout=httpx.Timeout(YANDEX_QUOTE_TIMEOUT, connect=YANDEX_QUOTE_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=YANDEX_QUOTE_MAX_CONCURRENCY,
+                max_keepalive_connections=YANDEX_QUOTE_MAX_CONCURRENCY
+            )
+        )
+    return _client
+
+
+def _get_semaphore() -> asyncio.Semaphore:
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(YANDEX_QUOTE_MAX_CONCURRENCY)
+    return _semaphore
+
+
+async def close_quote_client():
+    """Closes the shared quote client on application shutdown."""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def build_check_price_body(
+    address: str,
+    time_minutes: int,
+    requirements: Optional[dict] = None,
+    branch: Optional[str] = None
+) -> dict:
+    """
+    Builds the Yandex /check-price request body for a delivery
+    from the branch (default branch if not given) to the given address.
+    `requirements` overrides fields of DEFAULT_REQUIREMENTS (taxi_class, cargo_options, ...).
+    """
+    _, branch_config = resolve_branch(branch)
+    pickup = branch_config["pickup"]
+
+    due_time = datetime.now(timezone.utc) + timedelta(minutes=time_minutes)
+    due = due_time.strftime("%Y-%m-%dT%H:%M:%S+00:00")
+
+    # Resolve the destination locally; unknown addresses keep the old city-centre default
+    location = geocode_address(address)
+    if location:
+        coordinates = location["coordinates"]
+        street = location["street"]
+        building = location["building"]
+    else:
+        coordinates = [71.401911, 51.132355]
+        street = address.split(',')[0]  # Extract street from address
+        building = address.split(',')[1] if ',' in address else ""
+
+    return {
+        "route_points": [
+            {
+                "id": 1,
+                "coordinates": pickup["coordinates"],
+                "fullname": pickup["fullname"],
+                "country": "Казахстан",
+                "city": "Астана",
+                "street": pickup["street"],
+                "building": pickup["building"],
+                "comment": "Ресторан Italita",
+                "contact": {
+                    "name": "Italita",
+                    "phone": pickup["phone"]
+                }
+            },
+            {
+                "id": 2,
+                "coordinates": coordinates,
+                "fullname": address,
+                "country": "Казахстан",
+                "city": "Астана",
+                "street": street,
+                "building": building,
+                "comment": "Получатель",
+                "contact": {
+                    "name": "Получатель",
+                    "phone": "+7 (777) 777 77 77"
+                }
+            }
+        ],
+        "requirements": {**DEFAULT_REQUIREMENTS, **(requirements or {})},
+        "delivery_description": "Доставка готовой еды",
+        "recipient_info": {
+            "phone": "+7 (777) 777 77 77",
+            "name": "Получатель"
+        },
+        "skip_door_to_door": False,
+        "client_requirements": {
+            "send_tracking_link": True,
+            "cargo_loaders": 1
+        },
+        "due": due
+    }
+
+
+async def check_yandex_price(body: dict, queue_timeout: float = YANDEX_QUOTE_QUEUE_TIMEOUT) -> dict:
+    """
+    Requests a price quote from Yandex without blocking the event loop.
+
+    At most YANDEX_QUOTE_MAX_CONCURRENCY quotes are in flight at once; a quote
+    that cannot get a slot within `queue_timeout` seconds is not sent.
+
+    Returns a dict with "status" set to one of:
+    - "ok": "price" holds the offer price
+    - "busy": the concurrency cap was reached
+    - "timeout": Yandex did not answer in time
+    - "unavailable": the Yandex circuit is open
+    - "error": "error" holds the failure reason
+    """
+    breaker = get_breaker("yandex")
+    if not breaker.allow():
+        return {"status": "unavailable", "price": None}
+
+    semaphore = _get_semaphore()
+    try:
+        await asyncio.wait_for(semaphore.acquire(), timeout=queue_timeout)
+    except asyncio.TimeoutError:
+        logging.warning("⚠️ Yandex quote concurrency cap reached, returning fallback")
+        breaker.release_trial()  # Yandex was never called
+        return {"status": "busy", "price": None}
+
+    started = time.monotonic()
+    try:
+        response = await get_quote_client().post("/check-price", json=body)
+        response.raise_for_status()
+        price = response.json().get("offer", {}).get("price")
+        breaker.record_success()
+        return {"status": "ok", "price": price, "latency_ms": round((time.monotonic() - started) * 1000)}
+    except httpx.TimeoutException:
+        breaker.record_failure()
+        logging.warning(f"⚠️ Yandex quote timed out after {time.monotonic() - started:.2f}s")
+        return {"status": "timeout", "price": None}
+    except httpx.HTTPStatusError as e:
+        # 4xx is about this request (e.g. an address Yandex cannot price), not Yandex health
+        if e.response.status_code >= 500:
+            breaker.record_failure()
+        else:
+            breaker.release_trial()
+        logging.error(f"❌ Yandex quote failed with status {e.response.status_code}: {e.response.text}")
+        return {"status": "error", "price": None, "error": str(e)}
+    except httpx.HTTPError as e:
+        breaker.record_failure()
+        logging.error(f"❌ Network error while fetching Yandex quote: {str(e)}")
+        return {"status": "error", "price": None, "error": str(e)}
+    except Exception as e:
+        breaker.release_trial()
+        logging.error(f"❌ Unexpected error while fetching Yandex quote: {str(e)}")
+        return {"status": "error", "price": None, "error": str(e)}
+    finally:
+        semaphore.release()
+
+
+def tariff_label(requirements: dict) -> str:
+    options = "+".join(requirements.get("cargo_options") or [])
+    return f"{requirements.get('taxi_class')}/{options}" if options else requirements.get("taxi_class")
+
+
+def quote_cache_key(address: str, time_minutes: int, requirements: Optional[dict] = None, branch: Optional[str] = None) -> tuple:
+    """
+    (place, due bucket, tariff) identifying interchangeable quotes. The tariff
+    part carries the branch ("courier/thermobag@Branch") except for the default
+    branch, so the estimator keeps one price history per pickup point.
+    """
+    street, building = split_address(address or "")
+    place = f"{street} {building}".strip() or (address or "").strip().lower()
+    bucket = int(time_minutes or 0) // QUOTE_CACHE_DUE_BUCKET
+    tariff = tariff_label({**DEFAULT_REQUIREMENTS, **(requirements or {})})
+    branch_name, _ = resolve_branch(branch)
+    if branch_name != DEFAULT_BRANCH:
+        tariff = f"{tariff}@{branch_name}"
+    return place, bucket, tariff
+
+
+def get_cached_quote(key: tuple) -> Optional[dict]:
+    cached = _quote_cache.get(key)
+    if not cached:
+        return None
+    stored_at, result = cached
+    if time.monotonic() - stored_at > YANDEX_QUOTE_CACHE_TTL:
+        _quote_cache.pop(key, None)
+        return None
+    return result
+
+
+def _store_quote(key: tuple, result: dict):
+    _quote_cache.pop(key, None)
+    _quote_cache[key] = (time.monotonic(), result)
+    while len(_quote_cache) > YANDEX_QUOTE_CACHE_SIZE:
+        _quote_cache.pop(next(iter(_quote_cache)))
+
+
+async def quote_address(
+    address: str,
+    time_minutes: int,
+    requirements: Optional[dict] = None,
+    queue_timeout: float = YANDEX_QUOTE_QUEUE_TIMEOUT,
+    branch: Optional[str] = None
+) -> dict:
+    """
+    Returns a quote for the address, served from the quote cache when the same
+    place, due bucket and tariff were priced within YANDEX_QUOTE_CACHE_TTL.
+    """
+    key = quote_cache_key(address, time_minutes, requirements, branch)
+    cached = get_cached_quote(key)
+    if cached:
+        return {**cached, "cached": True}
+
+    result = await check_yandex_price(build_check_price_body(address, time_minutes, requirements, branch), queue_timeout)
+    if result["status"] == "ok" and result.get("price") is not None:
+        _store_quote(key, result)
+        # Only quotes with a locally resolved destination are useful for estimating
+        location = geocode_address(address)
+        if location:
+            record_quote(location["coordinates"], time_minutes, key[2], result["price"])
+    return {**result, "cached": False}
+
+
+def estimate_quote(
+    address: str,
+    time_minutes: int,
+    requirements: Optional[dict] = None,
+    branch: Optional[str] = None
+) -> Optional[dict]:
+    """Instant local price estimate for the address, or None if it cannot be geocoded or has no history."""
+    location = geocode_address(address)
+    if not location:
+        return None
+    return estimate_price(location["coordinates"], time_minutes, quote_cache_key(address, time_minutes, requirements, branch)[2])
+
+
+async def compare_tariffs(
+    address: str,
+    time_minutes: int,
+    tariffs: List[dict],
+    deadline: float = YANDEX_QUOTE_DEADLINE,
+    branch: Optional[str] = None
+) -> dict:
+    """
+    Quotes several requirement sets (e.g. courier, express, other cargo_options)
+    concurrently and returns them side by side.
+
+    Every quote shares one overall deadline; quotes still running when it
+    expires are cancelled and reported with status "timeout", so the caller
+    always gets whatever finished in time.
+    """
+    requirement_sets = [{**DEFAULT_REQUIREMENTS, **tariff} for tariff in tariffs[:YANDEX_QUOTE_MAX_TARIFFS]]
+    started = time.monotonic()
+
+    async def quote(requirements: dict) -> dict:
+        result = await quote_address(address, time_minutes, requirements, branch=branch)
+        if result.get("cached"):
+            # The stored latency belongs to the call that filled the cache
+            return {**result, "latency_ms": 0}
+        result.setdefault("latency_ms", round((time.monotonic() - started) * 1000))
+        return result
+
+    tasks = [asyncio.create_task(quote(requirements)) for requirements in requirement_sets]
+    done, pending = await asyncio.wait(tasks, timeout=deadline)
+    for task in pending:
+        task.cancel()
+
+    quotes = []
+    for task, requirements in zip(tasks, requirement_sets):
+        if task in done and not task.cancelled() and task.exception() is None:
+            result = task.result()
+        else:
+            result = {"status": "timeout", "price": None, "latency_ms": round(deadline * 1000)}
+        quotes.append({
+            "tariff": tariff_label(requirements),
+            "taxi_class": requirements.get("taxi_class"),
+            "cargo_options": requirements.get("cargo_options") or [],
+            **result
+        })
+
+    priced = [q for q in quotes if q["status"] == "ok" and q["price"] is not None]
+    cheapest = min(priced, key=lambda q: float(q["price"]), default=None)
+    return {
+        "quotes": quotes,
+        "cheapest": cheapest["tariff"] if cheapest else None,
+        "complete": len(priced) == len(quotes),
+        "elapsed_ms": round((time.monotonic() - started) * 1000)
+    }
+
+
+async def stream_batch_quotes(items: List[dict], concurrency: int = YANDEX_BATCH_CONCURRENCY) -> AsyncIterator[dict]:
+    """
+    Quotes many {"address", "time", optional "branch"} items and yields one result per item as
+    soon as it is ready, in completion order (each carries its "index").
+
+    Items that hit the quote cache are yielded first. Duplicates within the
+    batch are quoted once. Remaining quotes run at most `concurrency` at a time
+    and wait for a free slot instead of falling back.
+    """
+    groups: Dict[tuple, List[int]] = {}
+    for index, item in enumerate(items):
+        key = quote_cache_key(item.get("address"), item.get("time"), branch=item.get("branch"))
+        cached = get_cached_quote(key)
+        if cached:
+            yield {"index": index, **item, **cached, "cached": True}
+            continue
+        groups.setdefault(key, []).append(index)
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def quote(indexes: List[int]) -> Tuple[List[int], dict]:
+        item = items[indexes[0]]
+        async with semaphore:
+            result = await quote_address(
+                item.get("address"),
+                item.get("time"),
+                queue_timeout=YANDEX_QUOTE_TIMEOUT,
+                branch=item.get("branch")
+            )
+        return indexes, result
+
+    tasks = [asyncio.create_task(quote(indexes)) for indexes in groups.values()]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            indexes, result = await next_done
+            for index in indexes:
+                yield {"index": index, **items[index], **result}
+    finally:
+        # Client went away or the stream was closed early
+        for task in tasks:
+            task.cancel()
@@ -0,0 +1,154 @@
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+from typing import Dict, Optional
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; gzip is always available
+    brotli = None
+
+# Compress only text-like assets larger than this
+COMPRESS_MIN_BYTES = 256
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml", "application/manifest+json")
+
+# CRA puts content-hashed bundles under static/; everything else (index.html, manifest) must revalidate
+IMMUTABLE_PREFIX = "static/"
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+
+class PrecompressedStaticFiles:
+    """
+    ASGI app serving the React build from memory.
+
+    Every file is read once at startup together with gzip and (when the brotli
+    package is installed) brotli variants, a strong ETag per variant and its
+    cache policy. Requests then pick the best encoding from Accept-Encoding
+    and answer If-None-Match with 304 when it names that variant's ETag. Unknown paths without an extension fall back to
+    index.html so client-side routes work.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.files: Dict[str, dict] = {}
+        self.load()
+
+    def load(self):
+        if not os.path.isdir(self.directory):
+            logging.warning(f"⚠️ Static build directory {self.directory} not found, static files disabled")
+            return
+
+        total = 0
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                full_path = os.path.join(root, name)
+                rel_path = os.path.relpath(full_path, self.directory).replace(os.sep, "/")
+                try:
+                    with open(full_path, "rb") as f:
+                        body = f.read()
+                except OSError as e:
+                    logging.error(f"❌ Could not read static file {full_path}: {str(e)}")
+                    continue
+                self.files[rel_path] = self._prepare(rel_path, body)
+                total += len(body)
+
+        logging.info(f"✅ Preloaded {len(self.files)} static files ({total // 1024} KB)")
+
+    def _prepare(self, rel_path: str, body: bytes) -> dict:
+        media_type = mimetypes.guess_type(rel_path)[0] or "application/octet-stream"
+        if media_type.startswith("text/") or media_type in ("application/javascript", "application/json"):
+            media_type += "; charset=utf-8"
+
+        variants = {"identity": body}
+        if len(body) >= COMPRESS_MIN_BYTES and media_type.startswith(COMPRESSIBLE_TYPES):
+            gzipped = gzip.compress(body, compresslevel=9, mtime=0)
+            if len(gzipped) < len(body):
+                variants["gzip"] = gzipped
+            if brotli is not None:
+                compressed = brotli.compress(body, quality=11)
+                if len(compressed) < len(body):
+                    variants["br"] = compressed
+
+        # Each encoding is its own representation and needs its own strong validator (RFC 9110 8.8.3)
+        digest = hashlib.sha256(body).hexdigest()[:32]
+        return {
+            "media_type": media_type,
+            "etags": {encoding: f'"{digest}"' if encoding == "identity" else f'"{digest}-{encoding}"' for encoding in variants},
+            "cache_control": IMMUTABLE_CACHE_CONTROL if rel_path.startswith(IMMUTABLE_PREFIX) else REVALIDATE_CACHE_CONTROL,
+            "variants": variants
+        }
+
+    def _lookup(self, path: str) -> Optional[dict]:
+        rel_path = path.lstrip("/")
+        if not rel_path or rel_path.endswith("/"):
+            rel_path += "index.html"
+        entry = self.files.get(rel_path)
+        if entry is None and "." not in rel_path.rsplit("/", 1)[-1]:
+            entry = self.files.get("index.html")
+        return entry
+
+    @staticmethod
+    def _choose_encoding(accept_encoding: str, variants: dict) -> str:
+        accepted = set()
+        for part in accept_encoding.lower().split(","):
+            name, _, params = part.partition(";")
+            quality = params.strip().removeprefix("q=")
+            try:
+                if params and float(quality) <= 0:
+                    continue
+            except ValueError:
+                pass
+            accepted.add(name.strip())
+
+        for encoding in ("br", "gzip"):
+            if encoding in variants and (encoding in accepted or "*" in accepted):
+                return encoding
+        return "identity"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return
+
+        if scope["method"] not in ("GET", "HEAD"):
+            await self._respond(send, 405, [(b"allow", b"GET, HEAD")], b"Method Not Allowed")
+            return
+
+        # Mounted apps get the full path; strip the mount prefix
+        path = scope["path"]
+        root_path = scope.get("root_path", "")
+        if root_path and path.startswith(root_path):
+            path = path[len(root_path):]
+        entry = self._lookup(path)
+        if entry is None:
+            await self._respond(send, 404, [(b"content-type", b"text/plain; charset=utf-8")], b"Not Found")
+            return
+
+        request_headers = {k.decode("latin-1"): v.decode("latin-1") for k, v in scope["headers"]}
+        encoding = self._choose_encoding(request_headers.get("accept-encoding", ""), entry["variants"])
+        etag = entry["etags"][encoding]
+        headers = [
+            (b"etag", etag.encode()),
+            (b"cache-control", entry["cache_control"].encode()),
+            (b"vary", b"Accept-Encoding")
+        ]
+
+        if_none_match = request_headers.get("if-none-match", "")
+        if etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")] or if_none_match.strip() == "*":
+            await self._respond(send, 304, headers, b"")
+            return
+
+        body = entry["variants"][encoding]
+        headers.append((b"content-type", entry["media_type"].encode()))
+        if encoding != "identity":
+            headers.append((b"content-encoding", encoding.encode()))
+
+        await self._respond(send, 200, headers, b"" if scope["method"] == "HEAD" else body, len(body))
+
+    @staticmethod
+    async def _respond(send, status: int, headers: list, body: bytes, content_length: Optional[int] = None):
+        headers = headers + [(b"content-length", str(len(body) if content_length is None else content_length).encode())]
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        await send({"type": "http.response.body", "body": body})
@@ -1,11 +1,18 @@
 import requests
 import logging
+import time
 from app.config import (
     AMOCRM_DOMAIN,
     AMOCRM_TOKEN,
-    AMOCRM_CATALOG_ID
+    AMOCRM_CATALOG_ID,
+    CATALOG_CACHE_TTL,
+    HTTP_TIMEOUT
 )
 from services.iiko_service import get_menu_item
+from services.health_service import get_breaker
+
+# Catalog elements fetched by the startup warm-up, reused by the first price sync
+_catalog_cache = {"elements": None, "fetched_at": 0.0}
 
 def fetch_catalog_elements():
     """Fetch all catalog elements (paginated) from AmoCRM."""
@@ -19,8 +26,9 @@ def fetch_catalog_elements():
                 "Authorization": f"Bearer {AMOCRM_TOKEN}",
                 "Content-Type": "application/json"
             }
-            response = requests.get(url, headers=headers)
+            response = requests.get(url, headers=headers, timeout=HTTP_TIMEOUT)
             response.raise_for_status()  # Raise exception for HTTP errors
+            get_breaker("amocrm").record_success()
 
             data = response.json().get("_embedded", {}).get("elements", [])
             if not data:
@@ -30,6 +38,7 @@ def fetch_catalog_elements():
             page += 1
 
         except requests.RequestException as e:
+            get_breaker("amocrm").record_failure()
             logging.error(f"❌ Failed to fetch catalog elements on page {page}: {str(e)}")
             break
         except Exception as e:
@@ -38,10 +47,24 @@ def fetch_catalog_elements():
 
     return elements
 
+def warm_catalog() -> bool:
+    """Prefetches the amoCRM catalog so the next price sync does not have to page through it."""
+    elements = fetch_catalog_elements()
+    if not elements:
+        return False
+    _catalog_cache["elements"] = elements
+    _catalog_cache["fetched_at"] = time.monotonic()
+    logging.info(f"✅ amoCRM catalog warmed with {len(elements)} elements")
+    return True
+
 def update_amo_prices_with_iiko():
     updated_items = []
     try:
-        elements = fetch_catalog_elements()
+        if _catalog_cache["elements"] and time.monotonic() - _catalog_cache["fetched_at"] < CATALOG_CACHE_TTL:
+            elements = _catalog_cache["elements"]
+            _catalog_cache["elements"] = None  # use the warm copy once, then fetch fresh
+        else:
+            elements = fetch_catalog_elements()
 
         for element in elements:
             try:
@@ -104,7 +127,7 @@ def update_price_in_amocrm(element_id: int, new_price: float):
             ]
         }]
 
-        response = requests.patch(url, headers=headers, json=payload)
+        response = requests.patch(url, headers=headers, json=payload, timeout=HTTP_TIMEOUT)
         response.raise_for_status()  # Raise exception for HTTP errors
 
         logging.info(f"✅ Price updated for element {element_id} → {new_price}")
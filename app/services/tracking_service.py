@@ -0,0 +1,119 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import List, Optional
+
+from app.config import SQLITE_PATH
+
+# Checkpoints of delivery trackers, so tracking survives restarts; a row is deleted when tracking ends
+_lock = threading.Lock()
+_db: Optional[sqlite3.Connection] = None
+
+
+def _get_db() -> sqlite3.Connection:
+    global _db
+    if _db is None:
+        _db = sqlite3.connect(SQLITE_PATH, check_same_thread=False)
+        _db.row_factory = sqlite3.Row
+        _db.execute("PRAGMA journal_mode=WAL")
+        _db.execute("PRAGMA synchronous=NORMAL")
+        _db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS delivery_tracking (
+                claim_id TEXT PRIMARY KEY,
+                lead_id INTEGER NOT NULL,
+                started_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                last_status TEXT,
+                links TEXT,
+                courier_info_sent INTEGER NOT NULL DEFAULT 0
+            )
+            """
+        )
+        _db.commit()
+    return _db
+
+
+def _row_to_checkpoint(row: sqlite3.Row) -> dict:
+    return {
+        "claim_id": row["claim_id"],
+        "lead_id": row["lead_id"],
+        "started_at": row["started_at"],
+        "updated_at": row["updated_at"],
+        "last_status": row["last_status"],
+        "links": json.loads(row["links"]) if row["links"] else None,
+        "courier_info_sent": bool(row["courier_info_sent"])
+    }
+
+
+def begin_tracking(claim_id: str, lead_id) -> Optional[dict]:
+    """Creates the checkpoint of a claim about to be tracked; an existing one is kept as is."""
+    try:
+        now = time.time()
+        with _lock:
+            db = _get_db()
+            db.execute(
+                "INSERT OR IGNORE INTO delivery_tracking (claim_id, lead_id, started_at, updated_at) VALUES (?, ?, ?, ?)",
+                (claim_id, int(lead_id), now, now)
+            )
+            db.commit()
+        return get_checkpoint(claim_id)
+    except Exception as e:
+        logging.error(f"❌ Failed to create tracking checkpoint for claim {claim_id}: {str(e)}")
+        return None
+
+
+def save_checkpoint(claim_id: str, **fields):
+    """
+    Records a tracking transition. Accepted fields: last_status, links,
+    courier_info_sent.
+    """
+    columns = {
+        "last_status": fields.get("last_status"),
+        "links": json.dumps(fields["links"], ensure_ascii=False) if fields.get("links") else None,
+        "courier_info_sent": int(bool(fields.get("courier_info_sent")))
+    }
+    columns = {name: value for name, value in columns.items() if name in fields}
+    if not columns:
+        return
+    try:
+        assignments = ", ".join(f"{name} = ?" for name in columns)
+        with _lock:
+            db = _get_db()
+            db.execute(
+                f"UPDATE delivery_tracking SET {assignments}, updated_at = ? WHERE claim_id = ?",
+                (*columns.values(), time.time(), claim_id)
+            )
+            db.commit()
+    except Exception as e:
+        logging.error(f"❌ Failed to save tracking checkpoint for claim {claim_id}: {str(e)}")
+
+
+def end_tracking(claim_id: str):
+    """Drops the checkpoint of a claim whose tracking reached an end (delivered, returned or out of budget)."""
+    try:
+        with _lock:
+            db = _get_db()
+            db.execute("DELETE FROM delivery_tracking WHERE claim_id = ?", (claim_id,))
+            db.commit()
+    except Exception as e:
+        logging.error(f"❌ Failed to drop tracking checkpoint for claim {claim_id}: {str(e)}")
+
+
+def get_checkpoint(claim_id: str) -> Optional[dict]:
+    with _lock:
+        row = _get_db().execute("SELECT * FROM delivery_tracking WHERE claim_id = ?", (claim_id,)).fetchone()
+    return _row_to_checkpoint(row) if row else None
+
+
+def unfinished_checkpoints() -> List[dict]:
+    """Claims whose tracking had not ended, oldest first."""
+    try:
+        with _lock:
+            rows = _get_db().execute("SELECT * FROM delivery_tracking ORDER BY started_at").fetchall()
+        return [_row_to_checkpoint(row) for row in rows]
+    except Exception as e:
+        logging.error(f"❌ Failed to load tracking checkpoints: {str(e)}")
+        return []
@@ -1,19 +1,26 @@
+import contextvars
 import logging
-import traceback
+import re
 import asyncio
 import time
+from typing import Callable, List, Optional
 from urllib.parse import parse_qs
 from datetime import datetime, timedelta, timezone
-from fastapi import BackgroundTasks
 
-from services.amocrm_service import get_lead_data, update_lead_status_in_amocrm, add_note_to_amocrm, get_child_lead_id
-from services.iiko_service import create_iiko_order_from_amocrm, get_menu_item, close_order_in_iiko
-from services.yandex_service import create_yandex_delivery, get_yandex_delivery_status, get_yandex_tracking_links, accept_yandex_delivery, track_yandex_delivery_sync, try_accept_yandex_delivery
-from app.config import AMOCRM_DOMAIN, AMOCRM_TOKEN
+from services.amocrm_service import get_lead_data, get_leads_data, update_lead_status_in_amocrm, add_note_to_amocrm, get_child_lead_id
+from services.iiko_service import create_iiko_order_from_amocrm, submit_iiko_order, submit_iiko_close, get_menu_item, close_order_in_iiko, park_iiko_close, IikoUnavailable
+from services.geocoding_service import remember_delivered_address
+from services.order_service import save_order, mark_stage
+from services.pipeline_service import Stage, run_stages
+from services.logging_service import log_context, log_payload, claim_id_var
+from services.deadline_service import Deadline
+from services.metrics_service import inc
+from services.executor_service import get_executor, ExecutorFull
+from services.yandex_service import create_yandex_delivery, get_yandex_delivery_status, get_yandex_tracking_links, accept_yandex_delivery, cancel_yandex_delivery, start_delivery_tracking, try_accept_yandex_delivery
+from app.config import AMOCRM_DOMAIN, AMOCRM_TOKEN, PIPELINE_STAGE_TIMEOUTS, ORDER_DEADLINE, HTTP_TIMEOUT
 import requests
 
-# Global variable to store the last parsed order (for /last-order endpoint)
-last_order = {}
+LEAD_EVENT_KEY = re.compile(r"^leads\[(add|status|update)\]\[\d+\]\[id\]$")
 
 def extract_field(custom_fields, name):
     try:
@@ -79,7 +86,7 @@ def parse_lead(lead: dict, child_lead_id):
                     add_note_to_amocrm(child_lead_id, "Продукт без productId пропущен", "amoCRM")
                     continue
 
-                menu_item = get_menu_item(product_id, size_id)
+                menu_item = get_menu_item(product_id, size_id, parsed_data["branch"])
                 if not menu_item:
                     logging.warning(f"❌ No matching menu item for productId={product_id}, sizeId={size_id}")
                     add_note_to_amocrm(child_lead_id, f"Нет соответствующего пункта меню для productId={product_id}, sizeId={size_id}", "amoCRM")
@@ -127,7 +134,7 @@ def update_lead_price(lead_id: int, new_price: float):
             "price": int(new_price)
         }]
 
-        response = requests.patch(url, headers=headers, json=payload)
+        response = requests.patch(url, headers=headers, json=payload, timeout=HTTP_TIMEOUT)
         response.raise_for_status()  # Raise an exception for HTTP errors
         logging.info(f"✅ Updated lead {lead_id} price to {new_price}")
 
@@ -162,7 +169,7 @@ def update_lead_name(lead_id: int, new_name: str):
             ]
         }]
 
-        response = requests.patch(url, headers=headers, json=payload)
+        response = requests.patch(url, headers=headers, json=payload, timeout=HTTP_TIMEOUT)
         response.raise_for_status()  # Raise an exception for HTTP errors
         logging.info(f"✅ Lead {lead_id} name updated to {new_name}")
 
@@ -171,86 +178,307 @@ def update_lead_name(lead_id: int, new_name: str):
     except Exception as e:
         logging.error(f"❌ Could not update lead {lead_id} name: {str(e)}")
 
-def process_webhook(decoded_body: str, background_tasks: BackgroundTasks):
+def extract_lead_ids(decoded_body: str) -> List[int]:
+    """
+    Returns the IDs of every lead event in an amoCRM webhook body
+    (leads[add|status|update][N][id] for any N), deduplicated, in body order.
+    """
+    lead_ids = []
+    for key, values in parse_qs(decoded_body).items():
+        if LEAD_EVENT_KEY.match(key):
+            for value in values:
+                if value.isdigit() and int(value) not in lead_ids:
+                    lead_ids.append(int(value))
+    return lead_ids
+
+def process_webhook(decoded_body: str, lead_ids: Optional[List[int]] = None, on_lead_done: Optional[Callable] = None, reserved: bool = False) -> List[int]:
     """
     Processes an incoming webhook from AmoCRM in the background.
+    Every lead in the batch (or only lead_ids, when admission control already
+    picked them) is fetched in one request and then queued as an independent
+    job on the "orders" executor, into slots reserved for them when reserved
+    is set. on_lead_done(lead_id) is called when a job ends. Returns the IDs
+    of the leads that were queued.
     """
+    received_at = time.time()
+    queued = []
     try:
-        logging.info(f"🔹 Raw Webhook: {decoded_body}")
-        parsed = parse_qs(decoded_body)
+        log_payload("Raw webhook", decoded_body)
+        if lead_ids is None:
+            lead_ids = extract_lead_ids(decoded_body)
 
-        lead_id = (
-            parsed.get("leads[add][0][id]", [None])[0]
-            or parsed.get("leads[status][0][id]", [None])[0]
-        )
-
-        if not lead_id:
+        if not lead_ids:
             logging.warning("❌ No lead ID found in webhook")
-            return
-
-        child_lead_id = get_child_lead_id(lead_id)
-
-        lead_data = get_lead_data(lead_id)
-        if not lead_data:
-            logging.error("❌ Lead data missing")
-            add_note_to_amocrm(child_lead_id, "Данные сделки отсутствуют", "amoCRM")
-            return
-
-        parsed_order = parse_lead(lead_data, child_lead_id)
-        if not parsed_order.get("menu"):
-            logging.error("❌ No valid menu items parsed — nothing to send to iiko")
-            add_note_to_amocrm(child_lead_id, "Нет корректных пунктов меню для отправки в iiko", "amoCRM")
-            return
-
-        global last_order
-        last_order = parsed_order
-
-        update_lead_price(child_lead_id, parsed_order["price"])
-
-        formatted_message = format_order_message(last_order)
-        add_note_to_amocrm(child_lead_id, formatted_message)
-        
-        iiko_response = create_iiko_order_from_amocrm(parsed_order, child_lead_id)
-        order_id = iiko_response.get("orderInfo", {}).get("id")
+            return queued
 
-        if not order_id:
-            logging.error("❌ No orderId found in iiko response")
-            add_note_to_amocrm(child_lead_id, "Не удалось найти orderId в ответе от iiko", "iiko")
-            return
-        logging.info(f"✅ iiko order {order_id} created successfully.")
-        add_note_to_amocrm(child_lead_id, f"Заказ {order_id} успешно создан в iiko.", "iiko")
-
-        close_order_in_iiko(order_id, child_lead_id)
-        logging.info(f"✅ iiko order {order_id} closed successfully.")
-        add_note_to_amocrm(child_lead_id, f"Заказ {order_id} успешно завершен в iiko.", "iiko")
-
-        claim_id = create_yandex_delivery(parsed_order, child_lead_id)
-        if not claim_id:
-            logging.error("❌ Failed to create Yandex delivery order")
-            add_note_to_amocrm(child_lead_id, "Не удалось создать заказ на доставку в Яндекс", "Yandex")
-            return
-
-        if not try_accept_yandex_delivery(claim_id, child_lead_id):
-            log_and_note(child_lead_id, "Ошибка при принятии доставки Яндекс", "Yandex")
+        prefetched = get_leads_data(lead_ids) if len(lead_ids) > 1 else {}
+        executor = get_executor("orders")
+        submit = executor.submit_reserved if reserved else executor.submit
+        for lead_id in lead_ids:
+            try:
+                job = submit(process_lead, lead_id, received_at, prefetched.get(lead_id))
+            except ExecutorFull as e:
+                logging.error("❌ Lead %s not processed: %s", lead_id, e)
+                inc("webhook_leads_dropped_total", help="Webhook leads dropped because the orders executor was full")
+                continue
+            if on_lead_done:
+                job.add_done_callback(lambda _, lead_id=lead_id: on_lead_done(lead_id))
+            queued.append(lead_id)
+    except Exception as e:
+        logging.exception("❌ Error in process_webhook")
+    return queued
+
+def _resolve_child_lead(ctx: dict):
+    ctx["child_lead_id"] = get_child_lead_id(ctx["lead_id"], ctx["deadline"])
+    if not ctx["child_lead_id"]:
+        # Everything downstream (notes, order store, iiko, outbox) is keyed by the child lead
+        log_and_note(ctx["lead_id"], "Не удалось найти дочернюю сделку, заказ не обработан", "amoCRM")
+        return False
+    mark_stage(ctx["child_lead_id"], "received", at=ctx["received_at"], parent_lead_id=int(ctx["lead_id"]))
+
+def _fetch_lead(ctx: dict):
+    ctx["lead_data"] = get_lead_data(ctx["lead_id"], ctx["lead_info"], ctx["deadline"])
+
+def _parse_order(ctx: dict):
+    child_lead_id = ctx["child_lead_id"]
+    if not ctx["lead_data"]:
+        logging.error("❌ Lead data missing")
+        add_note_to_amocrm(child_lead_id, "Данные сделки отсутствуют", "amoCRM")
+        return False
+    mark_stage(child_lead_id, "lead_resolved")
+
+    parsed_order = parse_lead(ctx["lead_data"], child_lead_id)
+    if not parsed_order.get("menu"):
+        logging.error("❌ No valid menu items parsed — nothing to send to iiko")
+        add_note_to_amocrm(child_lead_id, "Нет корректных пунктов меню для отправки в iiko", "amoCRM")
+        return False
+
+    ctx["parsed_order"] = parsed_order
+    save_order(child_lead_id, parsed_order=parsed_order, phone=parsed_order.get("phone"))
+
+def _update_price(ctx: dict):
+    update_lead_price(ctx["child_lead_id"], ctx["parsed_order"]["price"])
+
+def _note_order(ctx: dict):
+    add_note_to_amocrm(ctx["child_lead_id"], format_order_message(ctx["parsed_order"]))
+
+def _create_iiko_order(ctx: dict):
+    iiko_response = create_iiko_order_from_amocrm(ctx["parsed_order"], ctx["child_lead_id"])
+    if iiko_response and iiko_response.get("parked"):
+        # iiko is unreachable: the outbox sends the order and runs the rest of the pipeline later
+        ctx["parked"] = True
+        mark_stage(ctx["child_lead_id"], "iiko_queued")
+        return False
+    return _record_iiko_order(ctx, iiko_response)
+
+def _send_parked_order(ctx: dict):
+    try:
+        iiko_response = submit_iiko_order(ctx["iiko_payload"], ctx["child_lead_id"], ctx["parsed_order"].get("branch"))
+    except IikoUnavailable as e:
+        logging.warning("⚠️ Parked order is still not accepted by iiko: %s", e)
+        ctx["parked"] = True
+        return False
+    return _record_iiko_order(ctx, iiko_response)
+
+def _record_iiko_order(ctx: dict, iiko_response: Optional[dict]):
+    child_lead_id = ctx["child_lead_id"]
+    order_id = (iiko_response or {}).get("orderInfo", {}).get("id")
+
+    if not order_id:
+        logging.error("❌ No orderId found in iiko response")
+        add_note_to_amocrm(child_lead_id, "Не удалось найти orderId в ответе от iiko", "iiko")
+        return False
+    logging.info("✅ iiko order %s created successfully.", order_id)
+    add_note_to_amocrm(child_lead_id, f"Заказ {order_id} успешно создан в iiko.", "iiko")
+    mark_stage(child_lead_id, "iiko_created", iiko_order_id=order_id)
+    ctx["iiko_order_id"] = order_id
+
+def _close_iiko_order(ctx: dict):
+    order_id = ctx["iiko_order_id"]
+    try:
+        closed = close_order_in_iiko(order_id, ctx["child_lead_id"], branch=ctx["parsed_order"].get("branch"), deadline=ctx["deadline"])
+    except IikoUnavailable:
+        # iiko went away after taking the order: the outbox closes it and runs the courier stages later
+        park_iiko_close(order_id, ctx["child_lead_id"], ctx["parsed_order"])
+        ctx["parked"] = True
+        mark_stage(ctx["child_lead_id"], "iiko_close_queued")
+        return False
+    if not closed:
+        return False
+    _record_iiko_close(ctx)
+
+def _send_parked_close(ctx: dict):
+    try:
+        closed = submit_iiko_close(ctx["iiko_payload"], ctx["child_lead_id"])
+    except IikoUnavailable as e:
+        logging.warning("⚠️ Parked order close is still not accepted by iiko: %s", e)
+        ctx["parked"] = True
+        return False
+    if not closed:
+        return False
+    _record_iiko_close(ctx)
+
+def _record_iiko_close(ctx: dict):
+    order_id = ctx["iiko_order_id"]
+    logging.info("✅ iiko order %s closed successfully.", order_id)
+    add_note_to_amocrm(ctx["child_lead_id"], f"Заказ {order_id} успешно завершен в iiko.", "iiko")
+    mark_stage(ctx["child_lead_id"], "iiko_closed")
+
+def _create_claim(ctx: dict):
+    child_lead_id = ctx["child_lead_id"]
+    claim_id = create_yandex_delivery(ctx["parsed_order"], child_lead_id, ctx["deadline"])
+    if not claim_id:
+        logging.error("❌ Failed to create Yandex delivery order")
+        add_note_to_amocrm(child_lead_id, "Не удалось создать заказ на доставку в Яндекс", "Yandex")
+        return False
+    claim_id_var.set(claim_id)
+    mark_stage(child_lead_id, "claim_created", claim_id=claim_id)
+    ctx["claim_id"] = claim_id
+
+def _accept_claim(ctx: dict):
+    with log_context(claim_id=ctx["claim_id"]):
+        if not try_accept_yandex_delivery(ctx["claim_id"], ctx["child_lead_id"], deadline=ctx["deadline"]):
+            log_and_note(ctx["child_lead_id"], "Ошибка при принятии доставки Яндекс", "Yandex")
+            return False
+    remember_delivered_address(ctx["parsed_order"].get("address"))
+
+def _cancel_undispatched_claim(ctx: dict):
+    """
+    Cancels the Yandex claim of an order that will not be dispatched now,
+    e.g. created alongside an iiko close that then failed or was parked.
+    A parked close creates a new claim once it is sent.
+    """
+    claim_id = ctx.pop("claim_id", None)
+    if claim_id:
+        with log_context(claim_id=claim_id):
+            cancel_yandex_delivery(claim_id, ctx["child_lead_id"])
+
+# The order flow as a dependency graph. The lead fetch runs alongside the
+# child-lead lookup, the price update and order note alongside iiko creation,
+# and the Yandex claim is created (and estimated by Yandex) while iiko closes
+# the order; the courier is only accepted once both are done. Without a
+# child lead or a closed iiko order nothing downstream runs.
+ORDER_STAGES = (
+    Stage("child_lead", _resolve_child_lead, timeout=PIPELINE_STAGE_TIMEOUTS["child_lead"]),
+    Stage("lead_data", _fetch_lead),
+    Stage("parse", _parse_order, requires=("child_lead", "lead_data")),
+    Stage("price", _update_price, requires=("parse",), critical=False),
+    Stage("order_note", _note_order, requires=("parse",), critical=False),
+    Stage("iiko_create", _create_iiko_order, requires=("parse",)),
+    Stage("iiko_close", _close_iiko_order, requires=("iiko_create",), timeout=PIPELINE_STAGE_TIMEOUTS["iiko_close"]),
+    Stage("claim_create", _create_claim, requires=("iiko_create",)),
+    Stage("claim_accept", _accept_claim, requires=("iiko_close", "claim_create"), timeout=PIPELINE_STAGE_TIMEOUTS["claim_accept"])
+)
+
+# What is left of the order flow once the outbox got a parked order, or a parked close, into iiko
+PARKED_ORDER_STAGES = (
+    Stage("iiko_close", _close_iiko_order, timeout=PIPELINE_STAGE_TIMEOUTS["iiko_close"]),
+    Stage("claim_create", _create_claim),
+    Stage("claim_accept", _accept_claim, requires=("iiko_close", "claim_create"), timeout=PIPELINE_STAGE_TIMEOUTS["claim_accept"])
+)
+PARKED_CLOSE_STAGES = (
+    Stage("claim_create", _create_claim),
+    Stage("claim_accept", _accept_claim, requires=("claim_create",), timeout=PIPELINE_STAGE_TIMEOUTS["claim_accept"])
+)
+
+def process_lead(lead_id, received_at: float, lead_info: Optional[dict] = None):
+    """
+    Runs one lead from the webhook through the order stage graph.
+    lead_info is the lead already fetched for the whole batch, if any.
+    The whole run shares one ORDER_DEADLINE budget counted from receipt.
+    """
+    deadline = Deadline(ORDER_DEADLINE, started_at=received_at)
+    ctx = {"lead_id": lead_id, "lead_info": lead_info, "received_at": received_at, "child_lead_id": None, "deadline": deadline}
+    try:
+        with log_context(lead_id=lead_id):
+            outcomes = run_stages(ORDER_STAGES, ctx, deadline)
+        if ctx.get("parked"):
+            _cancel_undispatched_claim(ctx)
+            inc("orders_processed_total", help="Orders leaving the webhook pipeline by outcome", outcome="parked")
             return
-        
-        background_tasks.add_task(track_yandex_delivery_sync, claim_id, child_lead_id)
-        log_and_note(child_lead_id, f"Начато отслеживание доставки Яндекс с claim_id: {claim_id}", "Yandex")
+        _finish_order(lead_id, ctx, outcomes, ORDER_STAGES)
 
     except Exception as e:
-        logging.error(f"❌ Error in process_webhook: {traceback.format_exc()}")
-        log_and_note(child_lead_id, "Ошибка в процессе обработки вебхука", "amoCRM")
-
+        logging.exception("❌ Error processing lead %s", lead_id)
+        log_and_note(ctx["child_lead_id"], "Ошибка в процессе обработки вебхука", "amoCRM")
+        mark_stage(ctx["child_lead_id"], "failed")
 
-def get_last_order_data():
+def deliver_parked_order(entry: dict) -> str:
     """
-    Returns the most recent parsed order for the /last-order endpoint.
+    Sends an order (or an order close) parked in the outbox to iiko. Called
+    by the outbox drainer; returns "sent" once iiko accepted it, "failed",
+    or "retry" when iiko is unreachable again. The rest of the pipeline then
+    runs on the "orders" executor, so the drain never waits for couriers.
     """
+    child_lead_id = entry["lead_id"]
+    ctx = {
+        "lead_id": child_lead_id,
+        "child_lead_id": child_lead_id,
+        "parsed_order": entry["parsed_order"],
+        "iiko_payload": entry["iiko_payload"]
+    }
+    if entry["kind"] == "close":
+        ctx["iiko_order_id"] = entry["iiko_payload"]["orderId"]
+        send, stages = _send_parked_close, PARKED_CLOSE_STAGES
+    else:
+        send, stages = _send_parked_order, PARKED_ORDER_STAGES
+    with log_context(lead_id=child_lead_id):
+        if send(ctx) is False:
+            if ctx.get("parked"):
+                return "retry"
+            mark_stage(child_lead_id, "failed")
+            return "failed"
+        try:
+            get_executor("orders").submit(contextvars.copy_context().run, _continue_parked_order, ctx, stages)
+        except ExecutorFull:
+            _continue_parked_order(ctx, stages)
+    return "sent"
+
+def _continue_parked_order(ctx: dict, stages: tuple):
+    """Runs the rest of a sent parked order's pipeline under a fresh ORDER_DEADLINE."""
+    child_lead_id = ctx["child_lead_id"]
+    ctx["deadline"] = Deadline(ORDER_DEADLINE)
     try:
-        return last_order
+        outcomes = run_stages(stages, ctx, ctx["deadline"])
+        if ctx.get("parked"):
+            _cancel_undispatched_claim(ctx)
+            return
+        _finish_order(child_lead_id, ctx, outcomes, stages)
     except Exception as e:
-        logging.error(f"❌ Error getting last order data: {str(e)}")
-        return {}
+        logging.exception("❌ Error processing parked order of lead %s", child_lead_id)
+        log_and_note(child_lead_id, "Ошибка в процессе обработки сохраненного заказа", "amoCRM")
+        mark_stage(child_lead_id, "failed")
+
+def _finish_order(lead_id, ctx: dict, outcomes: dict, stages: tuple):
+    """Records how the stage graph ended and hands a dispatched delivery to tracking."""
+    child_lead_id = ctx["child_lead_id"]
+
+    if "expired" in outcomes.values():
+        logging.error("❌ Lead %s ran out of its %ss budget: %s", lead_id, ORDER_DEADLINE, outcomes)
+        log_and_note(child_lead_id, "Заказ не был обработан за отведенное время", "amoCRM")
+        if outcomes.get("claim_accept") != "ok":
+            _cancel_undispatched_claim(ctx)
+        mark_stage(child_lead_id, "expired")
+        inc("orders_processed_total", help="Orders leaving the webhook pipeline by outcome", outcome="expired")
+        return
+
+    failed = [name for name, outcome in outcomes.items() if outcome in ("failed", "timeout")]
+    if any(outcomes[stage.name] != "ok" for stage in stages if stage.critical):
+        for name in failed:
+            if outcomes[name] == "timeout":
+                log_and_note(child_lead_id, f"Этап обработки заказа '{name}' не завершился вовремя", "amoCRM")
+        _cancel_undispatched_claim(ctx)
+        mark_stage(child_lead_id, "failed")
+        inc("orders_processed_total", help="Orders leaving the webhook pipeline by outcome", outcome="failed")
+        return
+
+    inc("orders_processed_total", help="Orders leaving the webhook pipeline by outcome", outcome="dispatched")
+    try:
+        start_delivery_tracking(ctx["claim_id"], child_lead_id)
+    except ExecutorFull as e:
+        log_and_note(child_lead_id, f"Отслеживание доставки Яндекс не запущено (claim_id: {ctx['claim_id']}): {str(e)}", "Yandex")
+        return
+    log_and_note(child_lead_id, f"Начато отслеживание доставки Яндекс с claim_id: {ctx['claim_id']}", "Yandex")
 
 def format_order_message(order: dict) -> str:
     """
@@ -283,5 +511,6 @@ def format_order_message(order: dict) -> str:
         return "Ошибка формирования заказа для отправки"
     
 def log_and_note(lead_id, message, service):
-    logging.info(f"{service}: {message}")
-    add_note_to_amocrm(lead_id, message, service)
\ No newline at end of file
+    logging.info("%s: %s", service, message)
+    if lead_id:
+        add_note_to_amocrm(lead_id, message, service)
\ No newline at end of file
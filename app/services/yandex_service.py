@@ -3,9 +3,46 @@ import logging
 import uuid
 import time
 import asyncio
+import itertools
+import threading
 from datetime import datetime, timedelta, timezone
-from app.config import YANDEX_API_KEY, YANDEX_BASE_URL
+from typing import Dict, Optional
+from app.config import (
+    YANDEX_API_KEY,
+    YANDEX_BASE_URL,
+    YANDEX_CALLBACK_URL,
+    YANDEX_CALLBACK_TOKEN,
+    HTTP_TIMEOUT,
+    ORDER_DEADLINE,
+    DELIVERY_TRACKING_BUDGET,
+    DELIVERY_POLL_INTERVAL,
+    DELIVERY_RECONCILE_INTERVAL
+)
 from services.amocrm_service import update_lead_status_in_amocrm, add_note_to_amocrm
+from services.geocoding_service import geocode_address
+from services.order_service import mark_stage
+from services.branch_service import resolve_branch
+from services.logging_service import log_context
+from services.deadline_service import Deadline, DeadlineExceeded
+from services.profiling_service import should_profile, run_profiled
+from services.probe_service import retry_interval
+from services.executor_service import get_executor
+from services.tracking_service import begin_tracking, save_checkpoint, end_tracking, get_checkpoint, unfinished_checkpoints
+
+# Statuses in which a courier is assigned and tracking links can be fetched
+COURIER_STATUSES = (
+    "performer_found",
+    "pickup_arrived",
+    "ready_for_pickup_confirmation",
+    "pickuped",
+    "delivery_arrived",
+    "ready_for_delivery_confirmation",
+    "pay_waiting",
+    "delivered"
+)
+
+# Claim ID -> event that wakes its tracker when Yandex reports a status change
+_claim_wakeups: Dict[str, threading.Event] = {}
 
 def format_phone(number):
     # Check if the number starts with '7' or '8' and drop the first digit
@@ -13,9 +50,10 @@ def format_phone(number):
         number = number[1:]
     return f"+7 {number[:3]} {number[3:6]} {number[6:8]} {number[8:]}"
 
-def create_yandex_delivery(parsed_order, lead_id):
+def create_yandex_delivery(parsed_order, lead_id, deadline: Optional[Deadline] = None):
     """
     Creates a delivery order in Yandex using the parsed order from AmoCRM.
+    The request timeout is capped by the order deadline, if given.
     """
     try:
         request_id = str(uuid.uuid4())
@@ -26,6 +64,9 @@ def create_yandex_delivery(parsed_order, lead_id):
             "Content-Type": "application/json"
         }
 
+        _, branch_config = resolve_branch(parsed_order.get("branch"))
+        pickup = branch_config["pickup"]
+
         courier_phone = format_phone(parsed_order.get("courier_phone"))
         customer_phone = format_phone(parsed_order.get("phone"))
         customer_name = parsed_order.get("name")
@@ -75,6 +116,12 @@ def create_yandex_delivery(parsed_order, lead_id):
             "visit_order": 2
         }
 
+        # Send coordinates when the building is known locally so Yandex does not have to geocode it.
+        # A street-level match is only the street's centroid and would send the courier to the wrong point
+        location = geocode_address(address)
+        if location and location["precision"] == "building":
+            route_point_2["address"]["coordinates"] = location["coordinates"]
+
         if porch:
             route_point_2["address"]["porch"] = porch
         if floor:
@@ -90,11 +137,12 @@ def create_yandex_delivery(parsed_order, lead_id):
                     "point_id": 1,
                     "type": "source",
                     "address": {
-                        "fullname": "Казахстан, Астана, проспект Туран, 24, Italita",
+                        "fullname": pickup["fullname"],
                         "country": "Казахстан",
                         "city": "Астана",
-                        "street": "проспект Туран",
-                        "building": "24"
+                        "street": pickup["street"],
+                        "building": pickup["building"],
+                        "coordinates": pickup["coordinates"]
                     },
                     "comment": "Ресторан Italita",
                     "contact": {
@@ -119,13 +167,19 @@ def create_yandex_delivery(parsed_order, lead_id):
             "due": due,
             "auto_accept": False
         }
+        callback_url = build_callback_url()
+        if callback_url:
+            order_data["callback_properties"] = {"callback_url": callback_url}
 
-        response = requests.post(url, json=order_data, headers=headers)
+        response = requests.post(url, json=order_data, headers=headers, timeout=deadline.timeout() if deadline else HTTP_TIMEOUT)
         response.raise_for_status()
         logging.info("✅ Yandex delivery order created successfully.")
         add_note_to_amocrm(lead_id, "Заказ доставки успешно создан в Яндекс, ждем подтверждения", "Yandex")
         return response.json().get("id")
 
+    except DeadlineExceeded as e:
+        logging.error(f"❌ Yandex delivery was not created: {str(e)}")
+        return None
     except requests.RequestException as e:
         logging.error(f"❌ Network error while creating Yandex delivery: {str(e)}")
         add_note_to_amocrm(lead_id, f"Ошибка создания доставки в Яндекс", "Yandex")
@@ -135,7 +189,31 @@ def create_yandex_delivery(parsed_order, lead_id):
         add_note_to_amocrm(lead_id, f"Ошибка при создании доставки в Яндекс", "Yandex")
         return None
 
-def get_yandex_delivery_status(claim_id):
+def build_callback_url() -> Optional[str]:
+    """
+    The status callback URL registered with new claims. Yandex appends
+    claim_id and updated_ts to it, so it ends with "&"; the shared token
+    lets /yandex/callback tell real callbacks from forged ones.
+    """
+    if not YANDEX_CALLBACK_URL:
+        return None
+    url = YANDEX_CALLBACK_URL + ("&" if "?" in YANDEX_CALLBACK_URL else "?")
+    if YANDEX_CALLBACK_TOKEN:
+        url += f"token={YANDEX_CALLBACK_TOKEN}&"
+    return url
+
+def notify_claim_update(claim_id: str) -> bool:
+    """
+    Wakes the tracker of a claim so it fetches the new state at once.
+    Returns False when the claim is not being tracked here.
+    """
+    wake = _claim_wakeups.get(claim_id)
+    if wake is None:
+        return False
+    wake.set()
+    return True
+
+def get_yandex_delivery_status(claim_id, timeout: float = HTTP_TIMEOUT):
     """
     Retrieves the status of a Yandex delivery order.
     """
@@ -145,19 +223,19 @@ def get_yandex_delivery_status(claim_id):
             "Authorization": f"Bearer {YANDEX_API_KEY}",
             "Accept-Language": "ru"
         }
-        response = requests.post(url, headers=headers)
+        response = requests.post(url, headers=headers, timeout=timeout)
         response.raise_for_status()
         status = response.json().get("status")
         logging.info(f"ℹ️ Yandex delivery order status: {status}")
         return status
     except requests.RequestException as e:
-        logging.error(f"❌ Network error while fetching Yandex delivery status: {str(e)}, response: {response.text}")
+        logging.error(f"❌ Network error while fetching Yandex delivery status: {str(e)}, response: {getattr(e.response, 'text', None)}")
         return None
     except Exception as e:
         logging.error(f"❌ Unexpected error while fetching Yandex delivery status: {str(e)}")
         return None
 
-def accept_yandex_delivery(claim_id, lead_id, version=1):
+def accept_yandex_delivery(claim_id, lead_id, version=1, timeout: float = HTTP_TIMEOUT):
     """
     Accepts a Yandex delivery order.
     """
@@ -168,7 +246,7 @@ def accept_yandex_delivery(claim_id, lead_id, version=1):
             "Accept-Language": "ru",
             "Content-Type": "application/json"
         }
-        response = requests.post(url, json={"version": version}, headers=headers)
+        response = requests.post(url, json={"version": version}, headers=headers, timeout=timeout)
         response.raise_for_status()
         logging.info(f"🚚 Delivery {claim_id} has been accepted.")
         add_note_to_amocrm(lead_id, f"Доставка успешно подтверждена, ожидаем курьера...", "Yandex")
@@ -183,6 +261,33 @@ def accept_yandex_delivery(claim_id, lead_id, version=1):
         logging.error(f"❌ Exception while accepting Yandex delivery: {str(e)}")
         return False
 
+def cancel_yandex_delivery(claim_id, lead_id, version=1, timeout: float = HTTP_TIMEOUT):
+    """
+    Cancels a Yandex delivery order that will not be dispatched. Only free
+    cancellation is requested: a claim that already has a courier is left
+    to the operator.
+    """
+    try:
+        url = f"{YANDEX_BASE_URL}/claims/cancel?claim_id={claim_id}"
+        headers = {
+            "Authorization": f"Bearer {YANDEX_API_KEY}",
+            "Accept-Language": "ru",
+            "Content-Type": "application/json"
+        }
+        response = requests.post(url, json={"cancel_state": "free", "version": version}, headers=headers, timeout=timeout)
+        response.raise_for_status()
+        logging.info(f"🚫 Delivery {claim_id} has been cancelled.")
+        add_note_to_amocrm(lead_id, f"Заказ на доставку Яндекс {claim_id} отменен", "Yandex")
+        return True
+    except requests.RequestException as e:
+        logging.error(f"❌ Network error while cancelling Yandex delivery {claim_id}: {str(e)}, response: {getattr(e.response, 'text', None)}")
+        add_note_to_amocrm(lead_id, f"Не удалось отменить заказ на доставку Яндекс {claim_id}, отмените его вручную", "Yandex")
+        return False
+    except Exception as e:
+        logging.error(f"❌ Exception while cancelling Yandex delivery {claim_id}: {str(e)}")
+        add_note_to_amocrm(lead_id, f"Не удалось отменить заказ на доставку Яндекс {claim_id}, отмените его вручную", "Yandex")
+        return False
+
 def get_yandex_tracking_links(claim_id):
     """
     Retrieves tracking links for the Yandex delivery order.
@@ -195,7 +300,7 @@ def get_yandex_tracking_links(claim_id):
     }
 
     try:
-        response = requests.get(url, headers=headers)
+        response = requests.get(url, headers=headers, timeout=HTTP_TIMEOUT)
         response_data = response.json()
         tracking_links = response_data.get("tracking_links")
         if tracking_links:
@@ -266,7 +371,7 @@ def get_courier_phone(claim_id: str, point_id: int) -> str:
             "point_id": point_id
         }
 
-        response = requests.post(url, headers=headers, json=payload)
+        response = requests.post(url, headers=headers, json=payload, timeout=HTTP_TIMEOUT)
         response.raise_for_status()
         phone_data = response.json()
 
@@ -349,14 +454,15 @@ def get_courier_info(claim_id: str, response_data: dict) -> dict:
             "price": "Unknown Price"
         }
     
-def get_yandex_claim_info(claim_id: str) -> dict:
+def get_yandex_claim_info(claim_id: str, timeout: float = HTTP_TIMEOUT) -> dict:
+    """The full claim snapshot from claims/info, or {} when it could not be fetched."""
     try:
         url = f"{YANDEX_BASE_URL}/claims/info?claim_id={claim_id}"
         headers = {
             "Authorization": f"Bearer {YANDEX_API_KEY}",
             "Accept-Language": "ru"
         }
-        response = requests.post(url, headers=headers)
+        response = requests.post(url, headers=headers, timeout=timeout)
         response.raise_for_status()
         logging.info(f"✅ Successfully fetched claim info for {claim_id}")
         return response.json()
@@ -377,53 +483,126 @@ def format_price(price: float, currency: str = "KZT") -> str:
         logging.error(f"❌ Error formatting price: {str(e)}")
         return "Unknown Price"
 
+def start_delivery_tracking(claim_id, lead_id):
+    """
+    Checkpoints the claim and queues its tracker on the "tracking" executor.
+    Raises ExecutorFull when the queue is full; the checkpoint stays, so
+    tracking is picked up on the next start.
+    """
+    begin_tracking(claim_id, lead_id)
+    return get_executor("tracking").submit(track_yandex_delivery_sync, claim_id, lead_id)
+
+def resume_delivery_tracking() -> int:
+    """Restarts the trackers of all claims whose tracking had not ended before the last shutdown."""
+    resumed = 0
+    for checkpoint in unfinished_checkpoints():
+        try:
+            get_executor("tracking").submit(track_yandex_delivery_sync, checkpoint["claim_id"], checkpoint["lead_id"])
+            resumed += 1
+        except Exception as e:
+            logging.error(f"❌ Could not resume tracking of claim {checkpoint['claim_id']}: {str(e)}")
+    if resumed:
+        logging.info(f"🚚 Resumed tracking of {resumed} deliveries")
+    return resumed
+
 def track_yandex_delivery_sync(claim_id, lead_id):
-    MAX_RETRIES = 180      # e.g. 20 attempts
-    WAIT_TIME = 30        # e.g. 60 seconds between checks
-    have_tracking_links = False
-    courier_info_fetched = False
-    last_status = None
+    wake = _claim_wakeups[claim_id] = threading.Event()
+    try:
+        with log_context(lead_id=lead_id, claim_id=claim_id):
+            if should_profile():
+                return run_profiled("delivery_tracking", _track_yandex_delivery, claim_id, lead_id, wake)
+            return _track_yandex_delivery(claim_id, lead_id, wake)
+    finally:
+        if _claim_wakeups.get(claim_id) is wake:
+            del _claim_wakeups[claim_id]
+
+def claim_revision(claim: dict) -> tuple:
+    """What identifies one state of a claim: Yandex bumps its version, revision or updated_ts on every change."""
+    return claim.get("version"), claim.get("revision"), claim.get("updated_ts"), claim.get("status")
+
+def _send_tracking_links(claim_id, lead_id) -> bool:
+    links = get_yandex_tracking_links(claim_id)
+    if not links:
+        return False
+    save_checkpoint(claim_id, links=links)
+    for link in links:
+        add_note_to_amocrm(lead_id, f"🔗 Ссылка для отслеживания заказа: {link}")
+    logging.info(f"🚚 Tracking links found: {links}")
+    return True
 
-    for attempt in range(MAX_RETRIES):
+def _wait_for_update(deadline: Deadline, wake: Optional[threading.Event]) -> bool:
+    """
+    Waits until the next poll, or until a status callback wakes the tracker.
+    With callbacks registered the poll is only a low-frequency safety net.
+    The wait is shortened near the end so the last minutes are still polled.
+    """
+    if deadline.remaining() < 1:
+        return False
+    interval = DELIVERY_RECONCILE_INTERVAL if YANDEX_CALLBACK_URL else DELIVERY_POLL_INTERVAL
+    return deadline.sleep(min(interval, deadline.remaining() / 1.25), wake=wake)
+
+def _track_yandex_delivery(claim_id, lead_id, wake: Optional[threading.Event] = None):
+    # Resume from the checkpoint: the budget counts from the first start and notes already sent are not repeated
+    checkpoint = get_checkpoint(claim_id) or begin_tracking(claim_id, lead_id) or {}
+    deadline = Deadline(DELIVERY_TRACKING_BUDGET, started_at=checkpoint.get("started_at"))
+    have_tracking_links = bool(checkpoint.get("links"))
+    courier_info_fetched = bool(checkpoint.get("courier_info_sent"))
+    last_status = checkpoint.get("last_status")
+    last_revision = None
+
+    # Ticks come from polls and status callbacks; the tracking budget alone bounds the loop
+    for attempt in itertools.count():
         try:
-            # Fetch the current status once per iteration
-            status = get_yandex_delivery_status(claim_id)
-            
+            # One claims/info snapshot per tick feeds status, courier, ETA and price alike
+            claim = get_yandex_claim_info(claim_id)
+            status = claim.get("status")
+
+            # Nothing changed since the last tick: only missing tracking links are still worth a request
+            revision = claim_revision(claim)
+            if status and revision == last_revision:
+                if not have_tracking_links and status in COURIER_STATUSES:
+                    have_tracking_links = _send_tracking_links(claim_id, lead_id)
+                if not _wait_for_update(deadline, wake):
+                    break
+                continue
+            if status:
+                last_revision = revision
+
             # Log the status change (or any new status if first iteration)
             if status and status != last_status:
                 logging.info(f"🚚 Status changed to '{status}' for claim {claim_id}.")
                 status_message = get_status_message_russian(status)
                 add_note_to_amocrm(lead_id, f"Статус доставки изменен: {status_message}", "Yandex")
                 last_status = status
+                save_checkpoint(claim_id, last_status=status)
 
-            if not have_tracking_links:
-                    links = get_yandex_tracking_links(claim_id)
-                    if links:
-                        have_tracking_links = True
-                        for link in links:
-                            add_note_to_amocrm(lead_id, f"🔗 Ссылка для отслеживания заказа: {link}")
-                        logging.info(f"🚚 Tracking links found: {links}")
+            # Tracking links exist only once a courier is assigned
+            if not have_tracking_links and status in COURIER_STATUSES:
+                    have_tracking_links = _send_tracking_links(claim_id, lead_id)
 
             if not courier_info_fetched and status in ["performer_found", "pickup_arrived", "pickuped"]:
-                    yandex_response = get_yandex_claim_info(claim_id)
-                    if yandex_response:
-                        courier_info = get_courier_info(claim_id, yandex_response)
-                        add_note_to_amocrm(
-                            lead_id,
-                            f"Курьер: {courier_info['courier_name']}, Телефон: {courier_info['courier_phone']}, "
-                            f"Прибытие через: {courier_info['eta_minutes']} мин"
-                        )
-                        courier_info_fetched = True
+                    mark_stage(lead_id, "courier_found")
+                    courier_info = get_courier_info(claim_id, claim)
+                    add_note_to_amocrm(
+                        lead_id,
+                        f"Курьер: {courier_info['courier_name']}, Телефон: {courier_info['courier_phone']}, "
+                        f"Прибытие через: {courier_info['eta_minutes']} мин"
+                    )
+                    courier_info_fetched = True
+                    save_checkpoint(claim_id, courier_info_sent=True)
             
             if status == "delivered_finish":
                 logging.info(f"✅ Delivery {claim_id} completed.")
                 add_note_to_amocrm(lead_id, f"Доставка {claim_id} завершена", "Yandex")
+                mark_stage(lead_id, "delivered")
+                end_tracking(claim_id)
                 return True
                 
             if status == "cancelled_by_taxi":
                 logging.warning(f"❌ Cancelled by taxi driver: {claim_id}. Checking if auto-resumed.")
                 add_note_to_amocrm(lead_id, f"Доставка отменена курьером: {claim_id}", "Yandex")
-                time.sleep(WAIT_TIME)
+                if not _wait_for_update(deadline, wake):
+                    break
                 continue  # Check if the status changes
 
             if status in ["returning", "return_arrived"]:
@@ -433,37 +612,54 @@ def track_yandex_delivery_sync(claim_id, lead_id):
             if status in ["returned", "returned_finish"]:
                 logging.info(f"🔁 Return completed: {claim_id}.")
                 add_note_to_amocrm(lead_id, f"Возврат завершен: {claim_id}", "Yandex")
+                mark_stage(lead_id, "returned")
+                end_tracking(claim_id)
                 return False
 
             # Log any failure to fetch status
             if status is None:
-                logging.warning(f"⚠️ Could not fetch status for delivery {claim_id}, attempt {attempt+1} of {MAX_RETRIES}.")
+                logging.warning(f"⚠️ Could not fetch status for delivery {claim_id}, attempt {attempt+1}.")
 
             # Sleep before the next retry
-            time.sleep(WAIT_TIME)
+            if not _wait_for_update(deadline, wake):
+                break
 
         except Exception as e:
             logging.error(f"❌ Error in track_yandex_delivery_sync: {e}")
             add_note_to_amocrm(lead_id, f"Ошибка отслеживания доставки Яндекс: {str(e)}", "Yandex")
+            if not _wait_for_update(deadline, wake):
+                break
             continue
 
     # If we exit the loop without successful completion
-    logging.error(f"❌ Delivery {claim_id} was not completed after {MAX_RETRIES} checks.")
-    add_note_to_amocrm(lead_id, f"Доставка не завершена после {MAX_RETRIES} попыток.", "Yandex")
+    logging.error(f"❌ Delivery {claim_id} was not completed within {DELIVERY_TRACKING_BUDGET}s of tracking.")
+    add_note_to_amocrm(lead_id, f"Доставка не завершена за отведенное время отслеживания.", "Yandex")
+    mark_stage(lead_id, "expired")
+    end_tracking(claim_id)
     return False
 
-def try_accept_yandex_delivery(claim_id, lead_id, retries=5, wait_time=2):
+def try_accept_yandex_delivery(claim_id, lead_id, retries=5, wait_time=2, deadline: Optional[Deadline] = None):
+    """
+    Accepts the claim once Yandex has estimated it, polling its status with
+    jittered backoff (starting at wait_time seconds, longer while Yandex
+    probes are slow) until retries or the deadline run out.
+    """
+    deadline = deadline or Deadline(ORDER_DEADLINE)
     for attempt in range(retries):
         try:
-            status = get_yandex_delivery_status(claim_id)
+            status = get_yandex_delivery_status(claim_id, deadline.timeout())
             if status == "ready_for_approval":
-                if accept_yandex_delivery(claim_id, lead_id):
+                if accept_yandex_delivery(claim_id, lead_id, timeout=deadline.timeout()):
                     return True
             elif status in ["performer_lookup", "performer_found"]:
                 return True
-            time.sleep(wait_time)
+        except DeadlineExceeded as e:
+            logging.error(f"❌ Yandex delivery {claim_id} was not accepted: {str(e)}")
+            return False
         except Exception as e:
             logging.error(f"❌ Error accepting Yandex delivery: {str(e)}")
+        if attempt + 1 < retries and not deadline.backoff(attempt, retry_interval("yandex", wait_time), wait_time * 8):
+            break
     return False
 
 def get_status_message_russian(status):
@@ -1,11 +1,43 @@
-import React, { useState } from 'react';
+import React, { useEffect, useState } from 'react';
 import axios from 'axios';
+import OrderBoard from './OrderBoard';
+
+const SUGGEST_DEBOUNCE_MS = 150;
 
 function App() {
   const [address, setAddress] = useState('');
   const [time, setTime] = useState('');
   const [price, setPrice] = useState(null);
+  const [estimate, setEstimate] = useState(null);
   const [error, setError] = useState('');
+  const [suggestions, setSuggestions] = useState([]);
+
+  useEffect(() => {
+    if (address.trim().length < 2) {
+      setSuggestions([]);
+      return undefined;
+    }
+
+    const controller = new AbortController();
+    const timer = setTimeout(async () => {
+      try {
+        const response = await axios.get('/api/address_suggest', {
+          params: { q: address },
+          signal: controller.signal,
+        });
+        setSuggestions(response.data.suggestions || []);
+      } catch (err) {
+        if (!axios.isCancel(err)) {
+          setSuggestions([]);
+        }
+      }
+    }, SUGGEST_DEBOUNCE_MS);
+
+    return () => {
+      clearTimeout(timer);
+      controller.abort();
+    };
+  }, [address]);
 
   const calculatePrice = async () => {
     if (!address || !time) {
@@ -13,11 +45,18 @@ function App() {
       return;
     }
 
+    const request = { address, time: parseInt(time) };
+    setPrice(null);
+    setEstimate(null);
+
+    // The local estimate answers instantly; show it while Yandex is quoting
+    axios
+      .post('/api/estimate_price', request)
+      .then((response) => setEstimate(response.data.estimate))
+      .catch(() => {});
+
     try {
-      const response = await axios.post('/api/calculate_price', {
-        address,
-        time: parseInt(time),
-      });
+      const response = await axios.post('/api/calculate_price', request);
 
       if (response.data.price) {
         setPrice(`Estimated Price: ${response.data.price} KZT`);
@@ -26,6 +65,10 @@ function App() {
         setError('Error calculating price.');
       }
     } catch (err) {
+      const fallback = err.response && err.response.data && err.response.data.estimate;
+      if (fallback) {
+        setEstimate(fallback);
+      }
       setError('Error fetching price from server.');
     }
   };
@@ -40,8 +83,15 @@ function App() {
           value={address}
           onChange={(e) => setAddress(e.target.value)}
           placeholder="Enter destination address"
+          list="address-suggestions"
+          autoComplete="off"
           style={{ marginLeft: '10px', marginBottom: '10px', padding: '5px' }}
         />
+        <datalist id="address-suggestions">
+          {suggestions.map((suggestion) => (
+            <option key={suggestion.address} value={suggestion.address} />
+          ))}
+        </datalist>
       </div>
       <div>
         <label>Time (minutes):</label>
@@ -56,8 +106,14 @@ function App() {
       <button onClick={calculatePrice} style={{ padding: '5px 10px' }}>
         Calculate Price
       </button>
+      {estimate && !price && (
+        <div style={{ marginTop: '10px', color: 'gray' }}>
+          Approximate Price: ~{estimate.price} KZT ({estimate.confidence} confidence)
+        </div>
+      )}
       {price && <div style={{ marginTop: '10px', color: 'green' }}>{price}</div>}
       {error && <div style={{ marginTop: '10px', color: 'red' }}>{error}</div>}
+      <OrderBoard />
     </div>
   );
 }
@@ -0,0 +1,103 @@
+import React, { useEffect, useState } from 'react';
+
+const STAGES = [
+  ['received', 'Received'],
+  ['lead_resolved', 'Lead'],
+  ['iiko_queued', 'iiko queued'],
+  ['iiko_created', 'iiko created'],
+  ['iiko_close_queued', 'iiko close queued'],
+  ['iiko_closed', 'iiko closed'],
+  ['claim_created', 'Claim'],
+  ['courier_found', 'Courier'],
+  ['delivered', 'Delivered'],
+];
+
+const FINAL_STATUSES = ['delivered', 'returned', 'failed', 'expired'];
+const PROBLEM_STATUSES = ['failed', 'returned', 'expired'];
+const FINISHED_VISIBLE_MS = 5 * 60 * 1000;
+
+function formatTime(seconds) {
+  return new Date(seconds * 1000).toLocaleTimeString();
+}
+
+function OrderBoard() {
+  const [orders, setOrders] = useState({});
+  const [connected, setConnected] = useState(false);
+
+  useEffect(() => {
+    const source = new EventSource('/events/orders');
+
+    source.onopen = () => setConnected(true);
+    source.onerror = () => setConnected(false);
+
+    source.addEventListener('snapshot', (event) => {
+      const snapshot = JSON.parse(event.data);
+      setOrders(Object.fromEntries(snapshot.map((order) => [order.lead_id, order])));
+    });
+
+    source.addEventListener('stage', (event) => {
+      const order = JSON.parse(event.data);
+      setOrders((current) => {
+        const next = { ...current, [order.lead_id]: order };
+        // Keep finished orders on the board for a few minutes only
+        const cutoff = Date.now() - FINISHED_VISIBLE_MS;
+        Object.values(next).forEach((o) => {
+          if (FINAL_STATUSES.includes(o.status) && o.stages[o.status] * 1000 < cutoff) {
+            delete next[o.lead_id];
+          }
+        });
+        return next;
+      });
+    });
+
+    return () => source.close();
+  }, []);
+
+  const rows = Object.values(orders).sort((a, b) => (a.stages.received || 0) - (b.stages.received || 0));
+
+  return (
+    <div style={{ marginTop: '30px' }}>
+      <h2>
+        Live Orders{' '}
+        <span style={{ fontSize: '12px', color: connected ? 'green' : 'gray' }}>
+          {connected ? '● live' : '○ reconnecting'}
+        </span>
+      </h2>
+      {rows.length === 0 ? (
+        <div style={{ color: 'gray' }}>No active orders.</div>
+      ) : (
+        <table style={{ borderCollapse: 'collapse', fontSize: '14px' }}>
+          <thead>
+            <tr>
+              <th style={{ textAlign: 'left', padding: '4px 8px' }}>Lead</th>
+              <th style={{ textAlign: 'left', padding: '4px 8px' }}>Client</th>
+              <th style={{ textAlign: 'left', padding: '4px 8px' }}>Address</th>
+              {STAGES.map(([stage, label]) => (
+                <th key={stage} style={{ padding: '4px 8px' }}>{label}</th>
+              ))}
+            </tr>
+          </thead>
+          <tbody>
+            {rows.map((order) => (
+              <tr
+                key={order.lead_id}
+                style={{ color: PROBLEM_STATUSES.includes(order.status) ? 'red' : 'inherit' }}
+              >
+                <td style={{ padding: '4px 8px' }}>{order.lead_id}</td>
+                <td style={{ padding: '4px 8px' }}>{order.name || '—'}</td>
+                <td style={{ padding: '4px 8px' }}>{order.address || '—'}</td>
+                {STAGES.map(([stage]) => (
+                  <td key={stage} style={{ padding: '4px 8px', textAlign: 'center' }}>
+                    {order.stages[stage] ? formatTime(order.stages[stage]) : ''}
+                  </td>
+                ))}
+              </tr>
+            ))}
+          </tbody>
+        </table>
+      )}
+    </div>
+  );
+}
+
+export default OrderBoard;
@@ -0,0 +1,79 @@
+"""
+Builds the address gazetteer read by geocoding_service (CSV: street,
+building, lon, lat) from OpenStreetMap house numbers.
+
+Steps:
+1. From the repository root, run
+       python scripts/build_gazetteer.py
+   It asks the Overpass API for every address (addr:street +
+   addr:housenumber) inside the city area and writes app/data/astana_gazetteer.csv.
+2. Check the printed street and building counts (Astana has several
+   thousand streets), commit the CSV and redeploy, or restart the service:
+   the gazetteer is loaded at startup.
+
+Use --area to build it for another city (its Wikidata ID), --output to
+write elsewhere and --overpass-url to use a different Overpass instance.
+Buildings missing from OpenStreetMap still geocode to their street's
+centroid, which is used for price estimates but never sent on a claim.
+"""
+import argparse
+import csv
+import sys
+
+import requests
+
+OVERPASS_URL = "https://overpass-api.de/api/interpreter"
+ASTANA_WIKIDATA = "Q1520"
+QUERY = """
+[out:json][timeout:300];
+area["wikidata"="{area}"]->.city;
+nwr(area.city)["addr:street"]["addr:housenumber"];
+out center tags;
+"""
+
+
+def fetch_addresses(area: str, overpass_url: str) -> list:
+    response = requests.post(overpass_url, data={"data": QUERY.format(area=area)}, timeout=600)
+    response.raise_for_status()
+    return response.json().get("elements", [])
+
+
+def to_rows(elements: list) -> list:
+    """One (street, building, lon, lat) row per distinct address; nodes use their point, ways and relations their center."""
+    rows = {}
+    for element in elements:
+        tags = element.get("tags", {})
+        point = element if "lon" in element else element.get("center")
+        if not point:
+            continue
+        street = tags["addr:street"].strip()
+        # "12;14" tags one building with several numbers
+        for building in tags["addr:housenumber"].split(";"):
+            building = building.strip()
+            if street and building:
+                rows.setdefault((street, building), (round(point["lon"], 6), round(point["lat"], 6)))
+    return [(street, building, lon, lat) for (street, building), (lon, lat) in sorted(rows.items())]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Build the address gazetteer from OpenStreetMap")
+    parser.add_argument("--area", default=ASTANA_WIKIDATA, help="Wikidata ID of the city (default: Astana)")
+    parser.add_argument("--output", default="app/data/astana_gazetteer.csv")
+    parser.add_argument("--overpass-url", default=OVERPASS_URL)
+    args = parser.parse_args()
+
+    rows = to_rows(fetch_addresses(args.area, args.overpass_url))
+    if not rows:
+        print("No addresses returned; the gazetteer was not changed", file=sys.stderr)
+        return 1
+
+    with open(args.output, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["street", "building", "lon", "lat"])
+        writer.writerows(rows)
+    print(f"Wrote {len(rows)} buildings on {len({row[0] for row in rows})} streets to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,70 @@
+import pytest
+
+from services import admission_service, order_service
+from services.admission_service import admit, release, forget
+
+
+@pytest.fixture(autouse=True)
+def fresh_admission(monkeypatch, sqlite_path):
+    monkeypatch.setattr(admission_service, "_in_flight", set())
+    monkeypatch.setattr(admission_service, "_recent", admission_service.OrderedDict())
+    monkeypatch.setattr(admission_service, "WEBHOOK_MAX_IN_FLIGHT", 3)
+    monkeypatch.setattr(admission_service, "WEBHOOK_DEDUP_TTL", 600)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(admission_service.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_new_leads_are_accepted_and_in_flight():
+    assert admit([1, 2]) == ("accepted", [1, 2])
+    assert admission_service.admission_snapshot()["in_flight"] == 2
+
+
+def test_lead_in_flight_is_a_duplicate():
+    admit([1])
+    assert admit([1]) == ("duplicate", [])
+
+
+def test_only_new_leads_of_a_batch_are_processed():
+    admit([1])
+    assert admit([1, 2]) == ("accepted", [2])
+
+
+def test_released_lead_stays_deduplicated_until_the_ttl(clock):
+    admit([1])
+    release([1])
+    clock[0] += 599
+    assert admit([1]) == ("duplicate", [])
+    clock[0] += 2
+    assert admit([1]) == ("accepted", [1])
+
+
+def test_forgotten_lead_is_admitted_again():
+    admit([1])
+    forget([1])
+    assert admit([1]) == ("accepted", [1])
+
+
+def test_batch_over_the_in_flight_budget_is_shed_without_recording():
+    admit([1, 2])
+    assert admit([3, 4]) == ("shed", [])
+    assert 3 not in admission_service._recent
+    release([1])
+    assert admit([3, 4]) == ("accepted", [3, 4])
+
+
+def test_lead_with_an_order_is_a_duplicate_after_the_ttl(clock):
+    order_service.mark_stage(501, "received", parent_lead_id=500)
+    clock[0] += 10_000
+    # The webhook's lead, and its child lead edited by the pipeline's own PATCHes
+    assert admit([500]) == ("duplicate", [])
+    assert admit([501]) == ("duplicate", [])
+    assert admit([500, 502]) == ("accepted", [502])
+
+
+def test_empty_webhook_is_accepted_with_nothing_to_process():
+    assert admit([]) == ("accepted", [])
@@ -0,0 +1,62 @@
+import threading
+import time
+
+import pytest
+
+from services.deadline_service import Deadline, DeadlineExceeded
+
+
+def test_remaining_counts_time_spent_before_creation():
+    deadline = Deadline(10, started_at=time.time() - 4)
+    assert 5.9 < deadline.remaining() <= 6
+
+
+def test_timeout_is_capped_by_what_is_left():
+    assert Deadline(100).timeout(cap=10) == 10
+    assert Deadline(2).timeout(cap=10) <= 2
+
+
+def test_timeout_raises_once_spent():
+    deadline = Deadline(10, started_at=time.time() - 11)
+    assert deadline.expired()
+    with pytest.raises(DeadlineExceeded):
+        deadline.timeout()
+
+
+def test_sleep_waits_within_the_jitter():
+    started = time.monotonic()
+    assert Deadline(5).sleep(0.1, jitter=0.2)
+    assert 0.08 <= time.monotonic() - started < 0.2
+
+
+def test_sleep_refuses_to_outlive_the_budget():
+    started = time.monotonic()
+    assert not Deadline(0.05).sleep(1, jitter=0)
+    assert time.monotonic() - started < 0.05
+
+
+def test_sleep_ends_early_when_woken():
+    wake = threading.Event()
+    threading.Timer(0.05, wake.set).start()
+    started = time.monotonic()
+    assert Deadline(5).sleep(2, wake=wake)
+    assert time.monotonic() - started < 1
+    assert not wake.is_set()
+
+
+def test_backoff_grows_and_is_capped(monkeypatch):
+    delays = []
+    monkeypatch.setattr("services.deadline_service.random.uniform", lambda low, high: high)
+    monkeypatch.setattr("services.deadline_service.time.sleep", delays.append)
+    deadline = Deadline(100)
+    for attempt in range(5):
+        assert deadline.backoff(attempt, base=1, cap=6)
+    assert delays == [1, 2, 4, 6, 6]
+
+
+def test_backoff_refuses_to_outlive_the_budget(monkeypatch):
+    delays = []
+    monkeypatch.setattr("services.deadline_service.time.sleep", delays.append)
+    monkeypatch.setattr("services.deadline_service.random.uniform", lambda low, high: high)
+    assert not Deadline(3).backoff(2, base=1, cap=10)
+    assert delays == []
@@ -0,0 +1,67 @@
+import asyncio
+
+from services import events_service
+
+
+def _collect(subscriber, snapshot, frames):
+    async def run():
+        received = []
+        async for frame in events_service.stream_events(subscriber, snapshot, keepalive=0.01):
+            received.append(frame)
+            if len(received) == frames:
+                break
+        return received
+
+    return asyncio.run(run())
+
+
+def test_slow_subscriber_is_dropped_once_its_buffer_overflows():
+    subscriber = events_service.subscribe()
+    subscriber.queue = asyncio.Queue(maxsize=2)
+
+    events_service._fan_out({"stage": "received"})
+    events_service._fan_out({"stage": "lead_resolved"})
+    assert not subscriber.dropped
+
+    events_service._fan_out({"stage": "iiko_created"})
+    assert subscriber.dropped
+    assert subscriber not in events_service._subscribers
+
+    # Nothing more is queued for a dropped subscriber
+    subscriber.queue.get_nowait()
+    subscriber.offer({"stage": "iiko_closed"})
+    assert subscriber.queue.qsize() == 1
+
+
+def test_fast_subscriber_keeps_receiving():
+    fast = events_service.subscribe()
+    slow = events_service.subscribe()
+    slow.queue = asyncio.Queue(maxsize=1)
+
+    for stage in ("received", "lead_resolved", "iiko_created"):
+        events_service._fan_out({"stage": stage})
+        fast.queue.get_nowait()
+
+    assert slow.dropped
+    assert not fast.dropped
+    assert fast in events_service._subscribers
+    events_service.unsubscribe(fast)
+
+
+def test_stream_sends_snapshot_then_events_and_keepalives():
+    subscriber = events_service.subscribe()
+    subscriber.offer({"stage": "received", "lead_id": 1})
+
+    frames = _collect(subscriber, [{"lead_id": 1}], 3)
+
+    assert frames[0] == 'event: snapshot\ndata: [{"lead_id": 1}]\n\n'
+    assert frames[1] == 'event: stage\ndata: {"stage": "received", "lead_id": 1}\n\n'
+    assert frames[2] == ": keepalive\n\n"
+    assert subscriber not in events_service._subscribers
+
+
+def test_stream_of_a_dropped_subscriber_ends_after_the_snapshot():
+    subscriber = events_service.subscribe()
+    subscriber.dropped = True
+
+    assert _collect(subscriber, [], 5) == ["event: snapshot\ndata: []\n\n"]
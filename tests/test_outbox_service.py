@@ -0,0 +1,137 @@
+import pytest
+
+from services import outbox_service
+from services.outbox_service import drain_outbox, has_waiting, outbox_snapshot, park_order
+
+
+@pytest.fixture(autouse=True)
+def outbox(monkeypatch, sqlite_path):
+    notes, stages = [], []
+    monkeypatch.setattr(outbox_service, "add_note_to_amocrm", lambda lead_id, text, source: notes.append(lead_id))
+    monkeypatch.setattr(outbox_service, "mark_stage", lambda lead_id, stage: stages.append((lead_id, stage)))
+    monkeypatch.setattr(outbox_service, "OUTBOX_MAX_ATTEMPTS", 3)
+    outbox_service._drain_stop.clear()
+    return {"notes": notes, "stages": stages}
+
+
+def park(lead_id, branch="center", kind="create"):
+    return park_order(lead_id, f"{kind}:{lead_id}", branch, {"lead": lead_id}, {"order": lead_id}, kind=kind)
+
+
+def always_available(branch):
+    return True
+
+
+def statuses():
+    rows = outbox_service._get_db().execute("SELECT lead_id, status, attempts FROM iiko_outbox ORDER BY id").fetchall()
+    return [tuple(row) for row in rows]
+
+
+def test_same_key_is_parked_once():
+    assert park(1)
+    assert not park(1)
+    assert outbox_snapshot()["pending"] == 1
+
+
+def test_order_without_a_lead_is_refused():
+    with pytest.raises(ValueError):
+        park(None)
+
+
+def test_waiting_is_per_branch():
+    park(1, branch="center")
+    assert has_waiting()
+    assert has_waiting("center")
+    assert not has_waiting("north")
+
+
+def test_drain_sends_in_arrival_order():
+    sent = []
+    for lead_id in (1, 2, 3):
+        park(lead_id)
+
+    def deliver(entry):
+        sent.append(entry["lead_id"])
+        return "sent"
+
+    assert drain_outbox(deliver, always_available) == 3
+    assert sent == [1, 2, 3]
+    assert statuses() == [(1, "sent", 1), (2, "sent", 1), (3, "sent", 1)]
+    assert not has_waiting()
+
+
+def test_retry_puts_the_entry_back_and_stops_its_branch():
+    for lead_id in (1, 2):
+        park(lead_id)
+    tried = []
+
+    def deliver(entry):
+        tried.append(entry["lead_id"])
+        return "retry"
+
+    assert drain_outbox(deliver, always_available) == 0
+    # The newer order is not sent ahead of the one iiko did not take
+    assert tried == [1]
+    assert statuses() == [(1, "pending", 1), (2, "pending", 0)]
+
+
+def test_delivery_error_counts_as_a_retry():
+    park(1)
+
+    def deliver(entry):
+        raise ConnectionError("iiko is down")
+
+    drain_outbox(deliver, always_available)
+    entry = outbox_service._pending_entries()[0]
+    assert entry["attempts"] == 1
+    assert entry["last_error"] == "iiko is down"
+
+
+def test_entry_fails_after_the_last_attempt(outbox):
+    park(1)
+    park(2)
+    for _ in range(3):
+        drain_outbox(lambda entry: "retry" if entry["lead_id"] == 1 else "sent", always_available)
+    assert statuses()[0] == (1, "failed", 3)
+    assert outbox["notes"] == [1]
+    assert outbox["stages"] == [(1, "failed")]
+    # Once the older order is given up, the branch moves on
+    assert statuses()[1] == (2, "sent", 1)
+
+
+def test_failed_delivery_is_not_retried(outbox):
+    park(1)
+    drain_outbox(lambda entry: "failed", always_available)
+    assert statuses() == [(1, "failed", 1)]
+    assert outbox["notes"] == []
+
+
+def test_outage_of_one_branch_does_not_hold_up_another():
+    park(1, branch="center")
+    park(2, branch="north")
+    park(3, branch="north")
+    sent = []
+
+    def deliver(entry):
+        if entry["branch"] == "center":
+            return "retry"
+        sent.append(entry["lead_id"])
+        return "sent"
+
+    assert drain_outbox(deliver, always_available) == 2
+    assert sent == [2, 3]
+    assert has_waiting("center")
+
+
+def test_unavailable_branch_is_skipped():
+    park(1, branch="center")
+    park(2, branch="north")
+    sent = []
+
+    def deliver(entry):
+        sent.append(entry["lead_id"])
+        return "sent"
+
+    drain_outbox(deliver, lambda branch: branch == "north")
+    assert sent == [2]
+    assert statuses()[0] == (1, "pending", 0)
@@ -0,0 +1,124 @@
+import threading
+import time
+
+import pytest
+
+from services import pipeline_service
+from services.deadline_service import Deadline
+from services.executor_service import BoundedExecutor
+from services.pipeline_service import Stage, run_stages
+
+
+@pytest.fixture
+def stage_pool(monkeypatch):
+    pools = []
+
+    def use(workers):
+        pool = BoundedExecutor("test_stages", workers)
+        pools.append(pool)
+        monkeypatch.setattr(pipeline_service, "get_executor", lambda name: pool)
+        return pool
+
+    use(4)
+    yield use
+    for pool in pools:
+        for executor in pool._pools:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+def recorder(log, name, result=None, delay=0.0):
+    def fn(ctx):
+        if delay:
+            time.sleep(delay)
+        log.append(name)
+        return result
+    return fn
+
+
+def test_stages_run_after_their_dependencies(stage_pool):
+    log = []
+    stages = (
+        Stage("a", recorder(log, "a", delay=0.05)),
+        Stage("b", recorder(log, "b"), requires=("a",)),
+        Stage("c", recorder(log, "c"), requires=("a", "b"))
+    )
+    assert run_stages(stages, {}) == {"a": "ok", "b": "ok", "c": "ok"}
+    assert log == ["a", "b", "c"]
+
+
+def test_independent_stages_run_concurrently(stage_pool):
+    both_started = threading.Barrier(2, timeout=1)
+
+    def meet(ctx):
+        both_started.wait()
+
+    assert run_stages((Stage("a", meet), Stage("b", meet)), {}) == {"a": "ok", "b": "ok"}
+
+
+def test_critical_failure_skips_dependents(stage_pool):
+    log = []
+    stages = (
+        Stage("a", recorder(log, "a", result=False)),
+        Stage("b", recorder(log, "b"), requires=("a",)),
+        Stage("c", recorder(log, "c"), requires=("b",))
+    )
+    assert run_stages(stages, {}) == {"a": "failed", "b": "skipped", "c": "skipped"}
+    assert log == ["a"]
+
+
+def test_non_critical_failure_lets_dependents_run(stage_pool):
+    def boom(ctx):
+        raise RuntimeError("price update failed")
+
+    stages = (Stage("price", boom, critical=False), Stage("note", lambda ctx: None, requires=("price",)))
+    assert run_stages(stages, {}) == {"price": "failed", "note": "ok"}
+
+
+def test_stages_share_the_context(stage_pool):
+    ctx = {}
+    stages = (
+        Stage("a", lambda ctx: ctx.__setitem__("claim_id", "c1")),
+        Stage("b", lambda ctx: ctx.__setitem__("seen", ctx["claim_id"]), requires=("a",))
+    )
+    run_stages(stages, ctx)
+    assert ctx["seen"] == "c1"
+
+
+def test_slow_stage_times_out_and_skips_dependents(stage_pool):
+    stages = (Stage("slow", recorder([], "slow", delay=0.5), timeout=0.05), Stage("next", lambda ctx: None, requires=("slow",)))
+    started = time.monotonic()
+    assert run_stages(stages, {}) == {"slow": "timeout", "next": "skipped"}
+    assert time.monotonic() - started < 0.4
+
+
+def test_timeout_counts_from_when_the_stage_starts(stage_pool):
+    stage_pool(1)
+    # "queued" waits 0.2s for the only worker, longer than its own 0.1s timeout
+    stages = (
+        Stage("busy", recorder([], "busy", delay=0.2), timeout=1),
+        Stage("queued", lambda ctx: None, timeout=0.1)
+    )
+    assert run_stages(stages, {}) == {"busy": "ok", "queued": "ok"}
+
+
+def test_stage_still_queued_at_the_deadline_is_cancelled(stage_pool):
+    pool = stage_pool(1)
+    log = []
+    stages = (Stage("busy", recorder(log, "busy", delay=0.3)), Stage("queued", recorder(log, "queued")))
+
+    assert run_stages(stages, {}, Deadline(0.1)) == {"busy": "expired", "queued": "expired"}
+    time.sleep(0.4)
+    assert log == ["busy"]
+    assert pool.queued == 0
+
+
+def test_nothing_starts_once_the_deadline_passed(stage_pool):
+    log = []
+    stages = (Stage("a", recorder(log, "a", delay=0.15)), Stage("b", recorder(log, "b"), requires=("a",)))
+    outcomes = run_stages(stages, {}, Deadline(0.1))
+    assert outcomes["b"] == "expired"
+    assert "b" not in log
+
+
+def test_unknown_dependency_is_skipped(stage_pool):
+    assert run_stages((Stage("a", lambda ctx: None, requires=("missing",)),), {}) == {"a": "skipped"}
@@ -0,0 +1,131 @@
+import asyncio
+import gzip
+
+import pytest
+
+from services import static_service
+from services.static_service import PrecompressedStaticFiles
+
+INDEX = b"<html>" + b"<p>order board</p>" * 50 + b"</html>"
+BUNDLE = b"console.log('board');" * 40
+
+
+@pytest.fixture
+def static_app(tmp_path):
+    (tmp_path / "static" / "js").mkdir(parents=True)
+    (tmp_path / "index.html").write_bytes(INDEX)
+    (tmp_path / "static" / "js" / "main.abc123.js").write_bytes(BUNDLE)
+    (tmp_path / "favicon.ico").write_bytes(b"\x00" * 1000)
+    return PrecompressedStaticFiles(str(tmp_path))
+
+
+def request(app, path="/", method="GET", headers=None):
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {
+        "type": "http",
+        "method": method,
+        "path": path,
+        "headers": [(k.encode(), v.encode()) for k, v in (headers or {}).items()]
+    }
+    asyncio.run(app(scope, None, send))
+    start, body = messages
+    return start["status"], {k.decode(): v.decode() for k, v in start["headers"]}, body["body"]
+
+
+def test_identity_without_accept_encoding(static_app):
+    status, headers, body = request(static_app)
+    assert status == 200
+    assert body == INDEX
+    assert "content-encoding" not in headers
+    assert headers["content-type"] == "text/html; charset=utf-8"
+    assert headers["vary"] == "Accept-Encoding"
+    assert headers["cache-control"] == static_service.REVALIDATE_CACHE_CONTROL
+
+
+def test_gzip_is_served_when_accepted(static_app):
+    status, headers, body = request(static_app, headers={"accept-encoding": "gzip, deflate"})
+    assert status == 200
+    assert headers["content-encoding"] == "gzip"
+    assert gzip.decompress(body) == INDEX
+    assert headers["content-length"] == str(len(body))
+
+
+@pytest.mark.skipif(static_service.brotli is None, reason="brotli is not installed")
+def test_brotli_is_preferred_over_gzip(static_app):
+    status, headers, body = request(static_app, headers={"accept-encoding": "gzip, br"})
+    assert headers["content-encoding"] == "br"
+    assert static_service.brotli.decompress(body) == INDEX
+
+
+def test_refused_encoding_is_not_used(static_app):
+    _, headers, body = request(static_app, headers={"accept-encoding": "gzip;q=0, br;q=0"})
+    assert "content-encoding" not in headers
+    assert body == INDEX
+
+
+def test_incompressible_files_have_only_identity(static_app):
+    _, headers, body = request(static_app, "/favicon.ico", headers={"accept-encoding": "gzip, br"})
+    assert "content-encoding" not in headers
+    assert len(body) == 1000
+
+
+def test_each_encoding_has_its_own_etag(static_app):
+    _, identity, _ = request(static_app)
+    _, gzipped, _ = request(static_app, headers={"accept-encoding": "gzip"})
+    assert identity["etag"] != gzipped["etag"]
+    assert gzipped["etag"].endswith('-gzip"')
+
+
+def test_if_none_match_gives_304_for_the_chosen_encoding(static_app):
+    _, headers, _ = request(static_app, headers={"accept-encoding": "gzip"})
+
+    status, not_modified, body = request(static_app, headers={"accept-encoding": "gzip", "if-none-match": headers["etag"]})
+    assert status == 304
+    assert body == b""
+    assert not_modified["etag"] == headers["etag"]
+
+    # The gzip validator does not revalidate the identity representation
+    status, _, body = request(static_app, headers={"if-none-match": headers["etag"]})
+    assert status == 200
+    assert body == INDEX
+
+
+def test_weak_and_listed_etags_match(static_app):
+    _, headers, _ = request(static_app)
+    status, _, _ = request(static_app, headers={"if-none-match": f'"other", W/{headers["etag"]}'})
+    assert status == 304
+
+
+def test_hashed_bundles_are_immutable(static_app):
+    status, headers, _ = request(static_app, "/static/js/main.abc123.js")
+    assert status == 200
+    assert headers["cache-control"] == static_service.IMMUTABLE_CACHE_CONTROL
+    assert headers["content-type"].endswith("javascript; charset=utf-8")
+
+
+def test_head_sends_headers_without_body(static_app):
+    status, headers, body = request(static_app, method="HEAD")
+    assert status == 200
+    assert body == b""
+    assert headers["content-length"] == str(len(INDEX))
+
+
+def test_client_routes_fall_back_to_index(static_app):
+    status, _, body = request(static_app, "/orders/42")
+    assert status == 200
+    assert body == INDEX
+
+
+def test_unknown_file_is_404(static_app):
+    status, _, _ = request(static_app, "/missing.js")
+    assert status == 404
+
+
+def test_other_methods_are_refused(static_app):
+    status, headers, _ = request(static_app, method="POST")
+    assert status == 405
+    assert headers["allow"] == "GET, HEAD"
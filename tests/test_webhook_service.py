@@ -0,0 +1,44 @@
+from urllib.parse import urlencode
+
+from services.webhook_service import extract_lead_ids
+
+
+def body(*pairs):
+    return urlencode(pairs)
+
+
+def test_single_status_event():
+    assert extract_lead_ids(body(("leads[status][0][id]", "101"), ("leads[status][0][status_id]", "5"))) == [101]
+
+
+def test_every_event_type_and_index_in_body_order():
+    decoded = body(
+        ("leads[add][0][id]", "103"),
+        ("leads[status][0][id]", "101"),
+        ("leads[status][1][id]", "102"),
+        ("leads[update][0][id]", "104")
+    )
+    assert extract_lead_ids(decoded) == [103, 101, 102, 104]
+
+
+def test_duplicate_ids_are_kept_once():
+    decoded = body(("leads[status][0][id]", "101"), ("leads[update][0][id]", "101"), ("leads[status][1][id]", "102"))
+    assert extract_lead_ids(decoded) == [101, 102]
+
+
+def test_other_entities_and_fields_are_ignored():
+    decoded = body(
+        ("contacts[add][0][id]", "7"),
+        ("leads[status][0][pipeline_id]", "9"),
+        ("leads[delete][0][id]", "8"),
+        ("account[id]", "1")
+    )
+    assert extract_lead_ids(decoded) == []
+
+
+def test_non_numeric_ids_are_ignored():
+    assert extract_lead_ids(body(("leads[status][0][id]", "abc"), ("leads[status][1][id]", "12"))) == [12]
+
+
+def test_empty_body():
+    assert extract_lead_ids("") == []